@@ -1,111 +1,375 @@
 import re
-from typing import List, Dict
+import json
+import time
+import asyncio
+from contextvars import ContextVar
+from typing import List, Dict, Tuple, Optional, Callable, Awaitable
 import os
-from openai import OpenAI
 from loguru import logger
+from llm_client import LLMClient, FailoverLLMClient
+from circuit_breaker import CircuitBreaker
+from llm_cache import LLMResponseCache
+from prompt_registry import PromptRegistry
+from model_profiles import load_model_profiles, estimate_cost, IntentMetrics
+from intent_classifier import IntentClassifier
+from utils.matcher import RuleMatcher
+from utils.config_watcher import JsonConfigWatcher
+from llm_usage import current_scope as current_usage_scope
+from llm_scheduler import LLMScheduler
+from safety_filter import SafetyFilter
+
+
+# 未提供 prompts/summary_prompt.txt 时使用的摘要提示词
+DEFAULT_SUMMARY_PROMPT = """你是闲鱼卖家的对话记录员。请根据【已有摘要】和【最新对话】更新这段买卖对话的摘要。
+要求：
+1. 只保留后续回复需要的事实：双方认可或提出过的价格、已承诺的发货/包邮/售后事项、买家关心的问题和顾虑；
+2. 使用简短的中文要点，总长度不超过150字；
+3. 不要编造对话中没有的信息，直接输出摘要内容。"""
+
+
+# 内置意图规则，按字典顺序确定优先级（技术类优先于价格类）
+DEFAULT_INTENT_RULES = {
+    'tech': {
+        'keywords': ['参数', '规格', '型号', '连接', '对比'],
+        'patterns': [r'和.+比']
+    },
+    'price': {
+        'keywords': ['便宜', '价', '砍价', '少点'],
+        'patterns': [r'\d+元', r'能少\d+']
+    }
+}
+
+# 意图匹配前去掉标点、空白等非文字字符
+NON_WORD_PATTERN = re.compile(r'[^\w\u4e00-\u9fa5]')
+
+# 当前回复累计的token用量和费用，由各Agent的大模型调用写入
+_reply_usage: ContextVar[Optional[Dict]] = ContextVar('reply_usage', default=None)
 
 
 class XianyuReplyBot:
     def __init__(self):
-        # 初始化OpenAI客户端
-        self.client = OpenAI(
+        # 初始化大模型异步客户端，所有Agent共用连接池
+        primary = LLMClient(
             api_key=os.getenv("API_KEY"),
             base_url=os.getenv("MODEL_BASE_URL", "https://dashscope.aliyuncs.com/compatible-mode/v1"),
+            timeout=float(os.getenv("LLM_TIMEOUT", "30")),                                # 单次请求超时，默认30秒
+            connect_timeout=float(os.getenv("LLM_CONNECT_TIMEOUT", "5")),                 # 建立连接超时，默认5秒
+            max_connections=int(os.getenv("LLM_MAX_CONNECTIONS", "20")),                  # 连接池大小，默认20
+            max_keepalive_connections=int(os.getenv("LLM_KEEPALIVE_CONNECTIONS", "10")),  # 保持的长连接数，默认10
+            keepalive_expiry=float(os.getenv("LLM_KEEPALIVE_EXPIRY", "30")),              # 长连接空闲保持时间，默认30秒
+            max_retries=int(os.getenv("LLM_MAX_RETRIES", "3")),                           # 429/5xx最大重试次数，默认3
+            http2=os.getenv("LLM_HTTP2", "true").lower() == "true",                       # 是否启用HTTP/2
         )
-        self._init_system_prompts()
+        # 备用服务：主服务熔断或请求失败时使用，未配置时只切换备用模型或直接降级
+        fallback = None
+        fallback_base_url = os.getenv("LLM_FALLBACK_BASE_URL")
+        if fallback_base_url:
+            fallback = LLMClient(
+                api_key=os.getenv("LLM_FALLBACK_API_KEY") or os.getenv("API_KEY"),
+                base_url=fallback_base_url,
+                timeout=float(os.getenv("LLM_TIMEOUT", "30")),
+                connect_timeout=float(os.getenv("LLM_CONNECT_TIMEOUT", "5")),
+                max_retries=1,
+                http2=os.getenv("LLM_HTTP2", "true").lower() == "true",
+            )
+        self.client = FailoverLLMClient(
+            primary,
+            CircuitBreaker(
+                window=int(os.getenv("CIRCUIT_WINDOW", "20")),                  # 统计的最近调用次数，默认20
+                min_calls=int(os.getenv("CIRCUIT_MIN_CALLS", "5")),             # 判断熔断的最少调用次数，默认5
+                error_rate=float(os.getenv("CIRCUIT_ERROR_RATE", "0.5")),       # 熔断错误率阈值，默认50%
+                latency_p95=float(os.getenv("CIRCUIT_LATENCY_P95", "20")),      # 熔断P95耗时阈值，默认20秒
+                open_seconds=float(os.getenv("CIRCUIT_OPEN_SECONDS", "30")),    # 熔断冷却时间，默认30秒
+            ),
+            fallback=fallback,
+            fallback_model=os.getenv("LLM_FALLBACK_MODEL") or None,  # 备用模型，如 qwen-turbo
+        )
+        # 完全相同的大模型请求（重复投递、重试等）直接复用结果
+        self.response_cache = None
+        if os.getenv("LLM_CACHE", "true").lower() == "true":
+            self.response_cache = LLMResponseCache(
+                max_entries=int(os.getenv("LLM_CACHE_SIZE", "512")),  # 最多缓存的结果数，默认512
+                ttl=int(os.getenv("LLM_CACHE_TTL", "600")),           # 结果有效期，默认10分钟
+                path=os.getenv("LLM_CACHE_PATH") or None,             # 持久化文件路径，默认不持久化
+            )
+        # 提示词布局：prefix 将固定的系统提示词放在最前，便于命中服务端的前缀缓存；inline 为原有布局
+        self.prompt_layout = os.getenv("PROMPT_LAYOUT", "prefix").lower()
+        # 各Agent的模型、max_tokens和温度配置，简单意图可使用更快更便宜的模型
+        self.model_profiles = load_model_profiles(os.getenv("MODEL_PROFILES_PATH", "prompts/model_profiles.json"))
+        self.intent_metrics = IntentMetrics()  # 按意图统计耗时和费用
+        self.usage_sinks = []  # 每次大模型调用的用量记录回调，如写入数据库按会话、商品统计
+        # 调用配额调度：按模型账号的RPM/TPM限额排队发出请求，议价优先，未配置限额时不排队
+        self.scheduler = None
+        rpm = int(os.getenv("LLM_RPM", "0"))  # 每分钟请求数上限，默认0不限制
+        tpm = int(os.getenv("LLM_TPM", "0"))  # 每分钟token数上限，默认0不限制
+        if rpm > 0 or tpm > 0:
+            self.scheduler = LLMScheduler(
+                rpm=rpm,
+                tpm=tpm,
+                burst_seconds=float(os.getenv("LLM_BURST_SECONDS", "5")),  # 空闲后允许瞬时发出的配额秒数，默认5秒
+            )
+        # 投机生成：需要大模型分类时同时生成默认回复草稿，意图为默认时省去一次串行调用
+        self.speculative_draft = os.getenv("SPECULATIVE_DRAFT", "false").lower() == "true"
+        self.speculation_stats = {
+            'drafts': 0, 'used': 0, 'discarded': 0,
+            'wasted_prompt_tokens': 0, 'wasted_completion_tokens': 0, 'wasted_cost': 0.0,
+        }
+        # 提示词注册表：文件修改后自动加载新版本，无需重建Agent
+        self.prompts = PromptRegistry(
+            "prompts",
+            files={
+                'classify': "classify_prompt.txt",
+                'price': "price_prompt.txt",
+                'tech': "tech_prompt.txt",
+                'default': "default_prompt.txt",
+                'summary': "summary_prompt.txt",
+            },
+            defaults={'summary': DEFAULT_SUMMARY_PROMPT},                      # 摘要提示词可选
+            check_interval=float(os.getenv("PROMPT_RELOAD_INTERVAL", "2")),  # 检查提示词文件修改的间隔，默认2秒
+        )
+        # 安全过滤：违规词编译为一个自动机，识别全角和用空格、符号隔开的写法，规则文件修改后自动生效
+        self.safety_filter = SafetyFilter(rules_path=os.getenv("SAFETY_RULES_PATH", "prompts/safety_rules.json"))
         self._init_agents()
-        self.router = IntentRouter(self.agents['classify'])
+        self.router = IntentRouter(
+            self.agents['classify'],
+            local_classifier=self._load_intent_model(),
+            local_threshold=float(os.getenv("INTENT_CONFIDENCE", "0.9")),  # 本地意图模型置信度阈值，默认0.9
+            rules_path=os.getenv("INTENT_RULES_PATH", "prompts/intent_rules.json"),  # 意图规则配置，修改后自动生效
+        )
+        self.context_builder = ContextBuilder(
+            token_budget=int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500")),  # 对话历史token预算
+            recent_turns=int(os.getenv("CONTEXT_RECENT_TURNS", "6")),     # 原文保留的最近消息数
+        )
         self.last_intent = None  # 记录最后一次意图
 
 
     def _init_agents(self):
         """初始化各领域Agent"""
+        agent_classes = {
+            'classify': ClassifyAgent,
+            'price': PriceAgent,
+            'tech': TechAgent,
+            'default': DefaultAgent,
+            'summary': SummaryAgent,
+        }
         self.agents = {
-            'classify':ClassifyAgent(self.client, self.classify_prompt, self._safe_filter),
-            'price': PriceAgent(self.client, self.price_prompt, self._safe_filter),
-            'tech': TechAgent(self.client, self.tech_prompt, self._safe_filter),
-            'default': DefaultAgent(self.client, self.default_prompt, self._safe_filter),
+            name: agent_class(
+                self.client, self.prompts, name, self.safety_filter,
+                response_cache=self.response_cache,
+                prompt_layout=self.prompt_layout,
+                profile=self.model_profiles['agents'].get(name),
+                pricing=self.model_profiles['pricing'],
+                usage_sink=self._emit_usage,
+                scheduler=self.scheduler,
+            )
+            for name, agent_class in agent_classes.items()
         }
 
-    def _init_system_prompts(self):
-        """初始化各Agent专用提示词，直接从文件中加载"""
-        prompt_dir = "prompts"
-        
+    def _emit_usage(self, record: Dict):
+        """将一次大模型调用的用量记录分发给各回调，回调出错不影响回复"""
+        for sink in self.usage_sinks:
+            try:
+                sink(record)
+            except Exception as e:
+                logger.error(f"记录大模型用量时出错: {e}")
+
+    def _load_intent_model(self):
+        """加载本地意图模型，模型文件不存在时返回None（全部交给大模型分类）"""
+        model_path = os.getenv("INTENT_MODEL_PATH", "data/intent_model.json")  # 本地意图模型路径
+        if not os.path.exists(model_path):
+            logger.info("未找到本地意图模型，规则未命中时使用大模型分类")
+            return None
         try:
-            # 加载分类提示词
-            with open(os.path.join(prompt_dir, "classify_prompt.txt"), "r", encoding="utf-8") as f:
-                self.classify_prompt = f.read()
-                logger.debug(f"已加载分类提示词，长度: {len(self.classify_prompt)} 字符")
-            
-            # 加载价格提示词
-            with open(os.path.join(prompt_dir, "price_prompt.txt"), "r", encoding="utf-8") as f:
-                self.price_prompt = f.read()
-                logger.debug(f"已加载价格提示词，长度: {len(self.price_prompt)} 字符")
-            
-            # 加载技术提示词
-            with open(os.path.join(prompt_dir, "tech_prompt.txt"), "r", encoding="utf-8") as f:
-                self.tech_prompt = f.read()
-                logger.debug(f"已加载技术提示词，长度: {len(self.tech_prompt)} 字符")
-            
-            # 加载默认提示词
-            with open(os.path.join(prompt_dir, "default_prompt.txt"), "r", encoding="utf-8") as f:
-                self.default_prompt = f.read()
-                logger.debug(f"已加载默认提示词，长度: {len(self.default_prompt)} 字符")
-                
-            logger.info("成功加载所有提示词")
+            classifier = IntentClassifier.load(model_path)
+            logger.info(f"已加载本地意图模型: {model_path}，意图: {classifier.labels}")
+            return classifier
         except Exception as e:
-            logger.error(f"加载提示词时出错: {e}")
-            raise
+            logger.error(f"加载本地意图模型时出错: {e}")
+            return None
 
-    def _safe_filter(self, text: str) -> str:
-        """安全过滤模块"""
-        blocked_phrases = ["微信", "QQ", "支付宝", "银行卡", "线下"]
-        return "[安全提醒]请通过平台沟通" if any(p in text for p in blocked_phrases) else text
+    def reload_intent_model(self):
+        """重新加载本地意图模型（重新训练后调用）"""
+        self.router.local_classifier = self._load_intent_model()
 
     def format_history(self, context: List[Dict]) -> str:
-        """格式化对话历史，返回完整的对话记录"""
-        # 过滤掉系统消息，只保留用户和助手的对话
-        user_assistant_msgs = [msg for msg in context if msg['role'] in ['user', 'assistant']]
-        return "\n".join([f"{msg['role']}: {msg['content']}" for msg in user_assistant_msgs])
+        """格式化对话历史，按token预算保留最近的对话"""
+        return self.context_builder.build(context)
 
-    def generate_reply(self, user_msg: str, item_desc: str, context: List[Dict]) -> str:
+    async def generate_reply(self, user_msg: str, item_desc: str, context: List[Dict]) -> str:
         """生成回复主流程"""
-        # 记录用户消息
-        # logger.debug(f'用户所发消息: {user_msg}')
-        
-        formatted_context = self.format_history(context)
-        # logger.debug(f'对话历史: {formatted_context}')
-        
-        # 1. 路由决策
-        detected_intent = self.router.detect(user_msg, item_desc, formatted_context)
+        reply, intent, _ = await self.generate_reply_with_intent(user_msg, item_desc, context)
+        self.last_intent = intent  # 保存当前意图
+        return reply
 
+    async def generate_reply_with_intent(self, user_msg: str, item_desc: str, context: List[Dict],
+                                         on_first_sentence: Optional[Callable[[str], Awaitable[None]]] = None) -> Tuple[str, str, str]:
+        """
+        生成回复并返回本次识别的意图及其来源
 
+        并发生成回复时不能依赖共享的 last_intent，调用方应使用本方法的返回值
 
-        # 2. 获取对应Agent
+        Args:
+            on_first_sentence: 流式生成时的异步回调，首个完整句子通过安全检查后立即调用，
+                               为空时不使用流式生成
 
-        internal_intents = {'classify'}  # 定义不对外开放的Agent
+        Returns:
+            tuple: (回复内容, 意图, 意图来源)，已通过回调发送的句子也包含在回复内容中；
+                   意图来源为 rule（规则）、local（本地意图模型）或 llm（大模型分类）
+        """
+        # 整个回复过程固定使用同一版本的提示词，期间热更新不影响本次回复
+        with self.prompts.pinned() as prompts:
+            logger.debug(f'使用提示词版本: {prompts.version}')
+            # 统计本次回复的耗时和费用
+            started_at = time.monotonic()
+            usage = {'prompt_tokens': 0, 'completion_tokens': 0, 'cost': 0.0}
+            usage_token = _reply_usage.set(usage)
+            try:
+                # 记录用户消息
+                # logger.debug(f'用户所发消息: {user_msg}')
+        
+                formatted_context = self.format_history(context)
+                # logger.debug(f'对话历史: {formatted_context}')
+        
+                # 1. 路由决策：规则和本地模型未命中时，投机模式下并行生成默认回复草稿
+                bargain_count = self._extract_bargain_count(context)
+                detected_intent, intent_source = self.router.match_with_source(user_msg)
+                draft = None
+                if detected_intent is None:
+                    intent_source = 'llm'
+                    # 调用配额排队时不再投机生成，把配额留给确定需要的请求
+                    if self.speculative_draft and not (self.scheduler and self.scheduler.backlog):
+                        draft = self._start_draft(user_msg, item_desc, formatted_context, bargain_count)
+                    try:
+                        detected_intent = await self.router.classify(user_msg, item_desc, formatted_context)
+                    except Exception:
+                        if draft is not None:
+                            draft['task'].cancel()
+                        raise
+
+                # 2. 获取对应Agent
+                agent, intent = self._resolve_agent(detected_intent)
+                logger.info(f'意图识别完成: {intent}')
+        
+                # 3. 获取议价次数
+                logger.info(f'议价次数: {bargain_count}')
+
+                # 4. 生成回复，意图为默认时直接使用草稿
+                reply = None
+                if draft is not None:
+                    reply = await self._finish_draft(draft, use=(intent == 'default'))
+                if reply is None:
+                    reply = await agent.generate(
+                        user_msg=user_msg,
+                        item_desc=item_desc,
+                        context=formatted_context,
+                        bargain_count=bargain_count,
+                        on_first_sentence=on_first_sentence
+                    )
+            finally:
+                _reply_usage.reset(usage_token)
+            
+            latency = time.monotonic() - started_at
+            self.intent_metrics.record(intent, latency, usage['prompt_tokens'], usage['completion_tokens'], usage['cost'])
+            logger.debug(f"意图 {intent} 回复耗时 {latency:.2f}s，token {usage['prompt_tokens']}+{usage['completion_tokens']}，费用 {usage['cost']:.5f}元")
+            return reply, intent, intent_source
+    
+    def _resolve_agent(self, detected_intent: str) -> Tuple['BaseAgent', str]:
+        """根据识别出的意图选择Agent，未知意图和内部Agent交给默认Agent"""
+        internal_intents = {'classify', 'summary'}  # 定义不对外开放的Agent
 
         if detected_intent in self.agents and detected_intent not in internal_intents:
-            agent = self.agents[detected_intent]
-            logger.info(f'意图识别完成: {detected_intent}')
-            self.last_intent = detected_intent  # 保存当前意图
+            return self.agents[detected_intent], detected_intent
+        return self.agents['default'], 'default'
+
+    def _start_draft(self, user_msg: str, item_desc: str, context: str, bargain_count: int) -> Dict:
+        """
+        与大模型意图分类并行生成默认回复草稿
+
+        草稿不使用流式发送（意图确定前不能发出任何内容），token用量单独累计，
+        采用时并入本次回复，取消时计入投机浪费。
+        """
+        draft_usage = {'prompt_tokens': 0, 'completion_tokens': 0, 'cost': 0.0}
+        usage_token = _reply_usage.set(draft_usage)
+        try:
+            task = asyncio.create_task(self.agents['default'].generate(
+                user_msg=user_msg,
+                item_desc=item_desc,
+                context=context,
+                bargain_count=bargain_count,
+            ))
+        finally:
+            _reply_usage.reset(usage_token)
+        self.speculation_stats['drafts'] += 1
+        messages = self.agents['default']._build_messages(user_msg, item_desc, context)
+        estimated_prompt_tokens = sum(ContextBuilder.estimate_tokens(msg['content']) for msg in messages)
+        return {'task': task, 'usage': draft_usage, 'estimated_prompt_tokens': estimated_prompt_tokens}
+
+    async def _finish_draft(self, draft: Dict, use: bool) -> Optional[str]:
+        """
+        采用或取消默认回复草稿
+
+        Returns:
+            str: 采用且生成成功时返回草稿内容，否则返回None（由对应Agent重新生成）
+        """
+        task, draft_usage = draft['task'], draft['usage']
+        stats = self.speculation_stats
+        reply_usage = _reply_usage.get()
+        if use:
+            try:
+                reply = await task
+            except Exception as e:
+                logger.warning(f"默认回复草稿生成失败，重新生成: {e}")
+                reply = None
+            if reply is not None:
+                stats['used'] += 1
+                if reply_usage is not None:
+                    for key in draft_usage:
+                        reply_usage[key] += draft_usage[key]
+                return reply
+
+        stats['discarded'] += 1
+        if task.done():
+            if not task.cancelled() and task.exception() is None:
+                wasted_prompt = draft_usage['prompt_tokens']
+            else:
+                wasted_prompt = 0
         else:
-            agent = self.agents['default']
-            logger.info(f'意图识别完成: default')
-            self.last_intent = 'default'  # 保存当前意图
+            # 已发出的请求仍可能计费，按估算的提示词token计入浪费
+            task.cancel()
+            wasted_prompt = draft['estimated_prompt_tokens']
+        stats['wasted_prompt_tokens'] += wasted_prompt
+        stats['wasted_completion_tokens'] += draft_usage['completion_tokens']
+        stats['wasted_cost'] += draft_usage['cost']
+        return None
+
+    def get_scheduler_stats(self) -> Optional[Dict]:
+        """调用配额调度器的队列状态，未配置限额时返回None"""
+        return self.scheduler.stats() if self.scheduler else None
+
+    def get_speculation_stats(self) -> Dict:
+        """投机生成统计：草稿数、采用数、丢弃数和浪费的token"""
+        stats = dict(self.speculation_stats)
+        stats['hit_rate'] = stats['used'] / stats['drafts'] if stats['drafts'] else 0.0
+        return stats
+
+    async def summarize(self, item_desc: str, previous_summary: Optional[str], messages: List[Dict]) -> str:
+        """
+        基于已有摘要和之后的新消息生成新的会话摘要
         
-        # 3. 获取议价次数
-        bargain_count = self._extract_bargain_count(context)
-        logger.info(f'议价次数: {bargain_count}')
-
-        # 4. 生成回复
-        return agent.generate(
-            user_msg=user_msg,
-            item_desc=item_desc,
-            context=formatted_context,
-            bargain_count=bargain_count
+        Args:
+            item_desc: 商品描述
+            previous_summary: 已有摘要，没有时为空
+            messages: 已有摘要之后的对话消息
+            
+        Returns:
+            str: 新的摘要内容
+        """
+        history = "\n".join(
+            f"{msg['role']}: {msg['content']}" for msg in messages if msg['role'] in ['user', 'assistant']
         )
-    
+        with self.prompts.pinned():
+            return await self.agents['summary'].summarize(item_desc, previous_summary, history)
+
     def _extract_bargain_count(self, context: List[Dict]) -> int:
         """
         从上下文中提取议价次数信息
@@ -128,61 +392,173 @@ class XianyuReplyBot:
                     pass
         return 0
 
+    def get_intent_metrics(self) -> Dict[str, Dict]:
+        """按意图统计的回复耗时（平均/P50/P95）、token用量和费用"""
+        return self.intent_metrics.snapshot()
+
+    def get_usage_stats(self) -> Dict[str, Dict]:
+        """各Agent的token用量及服务端前缀缓存命中情况"""
+        return {name: agent.get_usage_stats() for name, agent in self.agents.items()}
+
     def reload_prompts(self):
-        """重新加载所有提示词"""
+        """立即重新加载所有提示词（进行中的回复继续使用原版本）"""
         logger.info("正在重新加载提示词...")
-        self._init_system_prompts()
-        self._init_agents()
+        self.prompts.reload(force=True)
         logger.info("提示词重新加载完成")
 
 
+class ContextBuilder:
+    """
+    按token预算构建对话历史
+
+    最近的若干条消息保留原文，更早的消息压缩为摘要片段，超出预算的部分直接省略，
+    议价次数始终保留。上下文中带有滚动摘要时，上下文只包含摘要之后的消息，与摘要一起发送。
+    """
+
+    SUMMARY_PREFIX = "对话摘要: "
+
+    def __init__(self, token_budget: int = 1500, recent_turns: int = 6, snippet_chars: int = 30):
+        """
+        Args:
+            token_budget: 对话历史的token预算
+            recent_turns: 优先保留原文的最近消息数
+            snippet_chars: 较早消息压缩后保留的字符数
+        """
+        self.token_budget = token_budget
+        self.recent_turns = recent_turns
+        self.snippet_chars = snippet_chars
+
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        """粗略估算token数：中文字符约1个token，其余字符约4个字符1个token"""
+        cjk = sum(1 for ch in text if '\u4e00' <= ch <= '\u9fff')
+        return cjk + (len(text) - cjk + 3) // 4
+
+    def build(self, context: List[Dict]) -> str:
+        """构建对话历史文本"""
+        # 过滤掉系统消息，只保留用户和助手的对话
+        user_assistant_msgs = [msg for msg in context if msg['role'] in ['user', 'assistant']]
+        bargain_line = self._bargain_line(context)
+        budget = self.token_budget - (self.estimate_tokens(bargain_line) if bargain_line else 0)
+
+        # 更早的对话已包含在摘要中，摘要占用预算
+        summary = self.extract_summary(context)
+        summary_line = f"【对话摘要】{summary}" if summary else ""
+        if summary:
+            budget -= self.estimate_tokens(summary_line)
+
+        lines = []
+        omitted = 0
+        # 从最新的消息往前装入预算
+        for index, msg in enumerate(reversed(user_assistant_msgs)):
+            line = f"{msg['role']}: {msg['content']}"
+            if index >= self.recent_turns and len(msg['content']) > self.snippet_chars:
+                line = f"{msg['role']}: {msg['content'][:self.snippet_chars]}…"
+            if index == 0 and self.estimate_tokens(line) >= budget:
+                # 最新一条消息始终保留，超长时截断
+                line = line[:max(budget - 1, 0)] + "…"
+            cost = self.estimate_tokens(line) + 1
+            if cost > budget:
+                omitted = len(user_assistant_msgs) - index
+                break
+            budget -= cost
+            lines.append(line)
+
+        lines.reverse()
+        if omitted:
+            lines.insert(0, f"（更早的{omitted}条消息已省略）")
+        if summary_line:
+            lines.insert(0, summary_line)
+        if bargain_line:
+            lines.append(bargain_line)
+        return "\n".join(lines)
+
+    @classmethod
+    def extract_summary(cls, context: List[Dict]) -> str:
+        """提取上下文中的滚动摘要"""
+        for msg in context:
+            if msg['role'] == 'system' and msg['content'].startswith(cls.SUMMARY_PREFIX):
+                return msg['content'][len(cls.SUMMARY_PREFIX):]
+        return ""
+
+    @staticmethod
+    def _bargain_line(context: List[Dict]) -> str:
+        """提取议价次数信息"""
+        for msg in context:
+            if msg['role'] == 'system' and '议价次数' in msg['content']:
+                return f"system: {msg['content']}"
+        return ""
+
+
 class IntentRouter:
     """意图路由决策器"""
 
-    def __init__(self, classify_agent):
-        self.rules = {
-            'tech': {  # 技术类优先判定
-                'keywords': ['参数', '规格', '型号', '连接', '对比'],
-                'patterns': [
-                    r'和.+比'             
-                ]
-            },
-            'price': {
-                'keywords': ['便宜', '价', '砍价', '少点'],
-                'patterns': [r'\d+元', r'能少\d+']
-            }
-        }
+    def __init__(self, classify_agent, local_classifier=None, local_threshold=0.9,
+                 rules_path=None, reload_interval=1.0):
+        """
+        Args:
+            classify_agent: 大模型分类Agent
+            local_classifier: 本地意图模型，为空时规则未命中直接使用大模型
+            local_threshold: 本地意图模型置信度阈值
+            rules_path: 规则配置文件（JSON），文件修改后自动重新加载，不存在时使用内置规则
+            reload_interval: 检查规则文件是否修改的最小间隔（秒）
+        """
+        self._set_rules(DEFAULT_INTENT_RULES)
+        self._rules_file = JsonConfigWatcher(rules_path, self._apply_rules_file, reload_interval, name="意图规则")
+        self._rules_file.reload()
         self.classify_agent = classify_agent
+        self.local_classifier = local_classifier
+        self.local_threshold = local_threshold
+
+    def _set_rules(self, rules):
+        """编译规则并整体替换，正在进行的匹配不受影响"""
+        self.matcher = RuleMatcher(rules)
+        self.rules = rules
+
+    def _apply_rules_file(self, rules):
+        """应用规则文件中的规则"""
+        self._set_rules(rules)
+        logger.info(f"已加载意图规则: {self._rules_file.path}，优先级: {list(rules)}")
+
+    async def detect(self, user_msg: str, item_desc, context) -> str:
+        """四级路由策略（技术优先）：关键词、正则、本地意图模型、大模型"""
+        intent = self.match(user_msg)
+        if intent is not None:
+            return intent
+        return await self.classify(user_msg, item_desc, context)
+
+    def match(self, user_msg: str) -> Optional[str]:
+        """本地路由：关键词、正则和本地意图模型，均未命中时返回None"""
+        return self.match_with_source(user_msg)[0]
+
+    def match_with_source(self, user_msg: str) -> Tuple[Optional[str], Optional[str]]:
+        """
+        本地路由并返回命中来源
 
-    def detect(self, user_msg: str, item_desc, context) -> str:
-        """三级路由策略（技术优先）"""
-        text_clean = re.sub(r'[^\w\u4e00-\u9fa5]', '', user_msg)
+        Returns:
+            tuple: (意图, 来源)，来源为 rule 或 local，均未命中时为 (None, None)
+        """
+        self._rules_file.check()
         
-        # 1. 技术类关键词优先检查
-        if any(kw in text_clean for kw in self.rules['tech']['keywords']):
-            # logger.debug(f"技术类关键词匹配: {[kw for kw in self.rules['tech']['keywords'] if kw in text_clean]}")
-            return 'tech'
-            
-        # 2. 技术类正则优先检查
-        for pattern in self.rules['tech']['patterns']:
-            if re.search(pattern, text_clean):
-                # logger.debug(f"技术类正则匹配: {pattern}")
-                return 'tech'
-
-        # 3. 价格类检查
-        for intent in ['price']:
-            if any(kw in text_clean for kw in self.rules[intent]['keywords']):
-                # logger.debug(f"价格类关键词匹配: {[kw for kw in self.rules[intent]['keywords'] if kw in text_clean]}")
-                return intent
-            
-            for pattern in self.rules[intent]['patterns']:
-                if re.search(pattern, text_clean):
-                    # logger.debug(f"价格类正则匹配: {pattern}")
-                    return intent
+        # 1-3. 关键词和正则按优先级一次匹配
+        text_clean = NON_WORD_PATTERN.sub('', user_msg)
+        intent = self.matcher.match(text_clean)
+        if intent is not None:
+            # logger.debug(f"规则匹配: {intent}")
+            return intent, 'rule'
         
-        # 4. 大模型兜底
+        # 4. 本地意图模型，置信度足够高时跳过大模型分类
+        if self.local_classifier is not None:
+            intent, confidence = self.local_classifier.predict(user_msg)
+            if intent is not None and confidence >= self.local_threshold:
+                logger.debug(f"本地意图模型命中: {intent} ({confidence:.3f})")
+                return intent, 'local'
+        return None, None
+
+    async def classify(self, user_msg: str, item_desc, context) -> str:
+        """大模型兜底分类"""
         # logger.debug("使用大模型进行意图分类")
-        return self.classify_agent.generate(
+        return await self.classify_agent.generate(
             user_msg=user_msg,
             item_desc=item_desc,
             context=context
@@ -192,78 +568,231 @@ class IntentRouter:
 class BaseAgent:
     """Agent基类"""
 
-    def __init__(self, client, system_prompt, safety_filter):
+    # 句子结束标点，流式生成时据此判断首个完整句子
+    SENTENCE_END = re.compile(r'[。！？!?~～…\n]')
+
+    def __init__(self, client, prompts, prompt_name, safety_filter, response_cache=None, prompt_layout="prefix",
+                 profile=None, pricing=None, usage_sink=None, scheduler=None):
         self.client = client
-        self.system_prompt = system_prompt
+        self.prompts = prompts
+        self.prompt_name = prompt_name
         self.safety_filter = safety_filter
-
-    def generate(self, user_msg: str, item_desc: str, context: str, bargain_count: int = 0) -> str:
+        self.response_cache = response_cache
+        self.prompt_layout = prompt_layout
+        self.profile = profile or {}
+        self.pricing = pricing or {}
+        self.usage_sink = usage_sink
+        self.scheduler = scheduler
+        self.usage = {'calls': 0, 'prompt_tokens': 0, 'cached_tokens': 0, 'completion_tokens': 0, 'cost': 0.0}
+
+    @property
+    def model(self) -> str:
+        """本Agent使用的模型，未配置时使用 MODEL_NAME"""
+        return self.profile.get('model') or os.getenv("MODEL_NAME", "qwen-max")
+
+    def _temperature(self, default: float) -> float:
+        """本Agent的温度，配置中未指定时使用Agent自身的默认值"""
+        return self.profile.get('temperature', default)
+
+    @property
+    def system_prompt(self) -> str:
+        """本次回复固定版本中的系统提示词"""
+        return self.prompts.active()[self.prompt_name]
+
+    async def generate(self, user_msg: str, item_desc: str, context: str, bargain_count: int = 0,
+                       on_first_sentence: Optional[Callable[[str], Awaitable[None]]] = None) -> str:
         """生成回复模板方法"""
         messages = self._build_messages(user_msg, item_desc, context)
-        response = self._call_llm(messages)
+        response = await self._call_llm(messages, temperature=self._temperature(0.4), on_first_sentence=on_first_sentence)
         return self.safety_filter(response)
 
     def _build_messages(self, user_msg: str, item_desc: str, context: str) -> List[Dict]:
-        """构建消息链"""
+        """
+        构建消息链
+
+        prefix 布局下固定的系统提示词在最前，商品信息和对话历史追加在后，
+        同一Agent的请求共享相同的前缀，可命中服务端的提示词前缀缓存。
+        """
+        if self.prompt_layout == "prefix":
+            system_content = f"{self.system_prompt}\n【商品信息】{item_desc}\n【你与客户对话历史】{context}"
+        else:
+            system_content = f"【商品信息】{item_desc}\n【你与客户对话历史】{context}\n{self.system_prompt}"
         return [
-            {"role": "system", "content": f"【商品信息】{item_desc}\n【你与客户对话历史】{context}\n{self.system_prompt}"},
+            {"role": "system", "content": system_content},
             {"role": "user", "content": user_msg}
         ]
 
-    def _call_llm(self, messages: List[Dict], temperature: float = 0.4) -> str:
-        """调用大模型"""
-        response = self.client.chat.completions.create(
-            model=os.getenv("MODEL_NAME", "qwen-max"),
-            messages=messages,
-            temperature=temperature,
-            max_tokens=500,
-            top_p=0.8
+    async def _call_llm(self, messages: List[Dict], temperature: float = 0.4, extra_body: Optional[Dict] = None,
+                        on_first_sentence: Optional[Callable[[str], Awaitable[None]]] = None) -> str:
+        """调用大模型，传入on_first_sentence时使用流式生成"""
+        params = {
+            "model": self.model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": self.profile.get('max_tokens', 500),
+            "top_p": 0.8,
+        }
+        if extra_body:
+            params["extra_body"] = extra_body
+        if self.response_cache is None:
+            return await self._request_llm(params, on_first_sentence)
+
+        # 流式生成因违规内容提前终止的结果不缓存
+        return await self.response_cache.run(
+            LLMResponseCache.make_key(params),
+            lambda: self._request_llm(params, on_first_sentence),
+            cacheable=self.safety_filter.allows,
         )
+
+    async def _request_llm(self, params: Dict, on_first_sentence: Optional[Callable[[str], Awaitable[None]]] = None) -> str:
+        """实际发起大模型请求，配置了调度器时先等待调用配额"""
+        estimated_tokens = 0
+        if self.scheduler is not None:
+            estimated_tokens = sum(ContextBuilder.estimate_tokens(msg['content']) for msg in params['messages'])
+            estimated_tokens += params.get('max_tokens', 0)
+            await self.scheduler.acquire(self.prompt_name, estimated_tokens, self.profile.get('priority'))
+
+        if on_first_sentence is not None:
+            return await self._stream_llm(params, on_first_sentence, estimated_tokens)
+
+        started_at = time.monotonic()
+        response = await self.client.create(**params)
+        self._record_usage(response.usage, started_at, estimated_tokens)
         return response.choices[0].message.content
 
+    def _record_usage(self, usage, started_at: float, estimated_tokens: int = 0):
+        """
+        累计token用量，cached_tokens为命中服务端前缀缓存的提示词token数
+
+        Args:
+            usage: 接口返回的用量信息
+            started_at: 请求开始时间（time.monotonic），用于计算耗时
+            estimated_tokens: 调度器预扣的token数，按实际用量修正配额
+        """
+        if usage is None:
+            return
+        model = self.model
+        details = getattr(usage, 'prompt_tokens_details', None)
+        prompt_tokens = usage.prompt_tokens or 0
+        completion_tokens = usage.completion_tokens or 0
+        cached_tokens = (getattr(details, 'cached_tokens', None) or 0) if details else 0
+        cost = estimate_cost(self.pricing, model, prompt_tokens, completion_tokens)
+        self.usage['calls'] += 1
+        self.usage['prompt_tokens'] += prompt_tokens
+        self.usage['completion_tokens'] += completion_tokens
+        self.usage['cached_tokens'] += cached_tokens
+        self.usage['cost'] += cost
+        if self.scheduler is not None and estimated_tokens:
+            self.scheduler.settle(estimated_tokens, prompt_tokens + completion_tokens)
+
+        if self.usage_sink is not None:
+            scope = current_usage_scope()
+            self.usage_sink({
+                'chat_id': scope.get('chat_id'),
+                'item_id': scope.get('item_id'),
+                'intent': self.prompt_name,
+                'model': model,
+                'prompt_tokens': prompt_tokens,
+                'cached_tokens': cached_tokens,
+                'completion_tokens': completion_tokens,
+                'latency_ms': int((time.monotonic() - started_at) * 1000),
+                'cost': cost,
+            })
+
+        reply_usage = _reply_usage.get()
+        if reply_usage is not None:
+            reply_usage['prompt_tokens'] += prompt_tokens
+            reply_usage['completion_tokens'] += completion_tokens
+            reply_usage['cost'] += cost
+
+    def get_usage_stats(self) -> Dict:
+        """token用量统计，包含前缀缓存命中率"""
+        prompt_tokens = self.usage['prompt_tokens']
+        return dict(self.usage, cache_hit_rate=self.usage['cached_tokens'] / prompt_tokens if prompt_tokens else 0.0)
+
+    async def _stream_llm(self, params: Dict, on_first_sentence: Callable[[str], Awaitable[None]],
+                          estimated_tokens: int = 0) -> str:
+        """
+        流式调用大模型
+
+        新增文本逐段增量做安全检查，一旦出现违规内容立即终止生成；首个完整句子在检查器确认
+        不会与后续文本组成违规词后立即回调发送。
+        未违规时返回的文本已标记为检查过，调用方的最终过滤不再重复扫描。
+        """
+        text = ""
+        checked = 0
+        sent = False
+        scanner = self.safety_filter.scanner()
+        started_at = time.monotonic()
+        stream = await self.client.create(stream=True, stream_options={"include_usage": True}, **params)
+        try:
+            async for chunk in stream:
+                # 开启include_usage后最后一个分片只携带用量信息
+                if getattr(chunk, 'usage', None):
+                    self._record_usage(chunk.usage, started_at, estimated_tokens)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content or ""
+                text += delta
+                if scanner.feed(delta):
+                    logger.warning(f"流式生成中检测到违规内容，提前终止生成: {scanner.blocked}")
+                    break
+                if sent:
+                    continue
+
+                # 在已确定安全的前缀内找最后一个句子结束位置，违规词可能跨标点匹配，未确定的部分暂不发送
+                boundary = None
+                for match in self.SENTENCE_END.finditer(text, checked, scanner.settled):
+                    boundary = match.end()
+                if boundary is None:
+                    continue
+                checked = boundary
+
+                prefix = text[:boundary]
+                if prefix.strip():
+                    await on_first_sentence(prefix)
+                    sent = True
+        finally:
+            await stream.close()
+        return scanner.result(text)
+
 
 class PriceAgent(BaseAgent):
     """议价处理Agent"""
 
-    def generate(self, user_msg: str, item_desc: str, context: str, bargain_count: int=0) -> str:
+    async def generate(self, user_msg: str, item_desc: str, context: str, bargain_count: int=0,
+                       on_first_sentence: Optional[Callable[[str], Awaitable[None]]] = None) -> str:
         """重写生成逻辑"""
         dynamic_temp = self._calc_temperature(bargain_count)
         messages = self._build_messages(user_msg, item_desc, context)
         messages[0]['content'] += f"\n▲当前议价轮次：{bargain_count}"
 
-        response = self.client.chat.completions.create(
-            model=os.getenv("MODEL_NAME", "qwen-max"),
-            messages=messages,
-            temperature=dynamic_temp,
-            max_tokens=500,
-            top_p=0.8
-        )
-        return self.safety_filter(response.choices[0].message.content)
+        response = await self._call_llm(messages, temperature=dynamic_temp, on_first_sentence=on_first_sentence)
+        return self.safety_filter(response)
 
     def _calc_temperature(self, bargain_count: int) -> float:
-        """动态温度策略"""
-        return min(0.3 + bargain_count * 0.15, 0.9)
+        """动态温度策略，配置中的温度作为起始温度"""
+        return min(self._temperature(0.3) + bargain_count * 0.15, 0.9)
 
 
 class TechAgent(BaseAgent):
     """技术咨询Agent"""
-    def generate(self, user_msg: str, item_desc: str, context: str, bargain_count: int=0) -> str:
+    async def generate(self, user_msg: str, item_desc: str, context: str, bargain_count: int=0,
+                       on_first_sentence: Optional[Callable[[str], Awaitable[None]]] = None) -> str:
         """重写生成逻辑"""
         messages = self._build_messages(user_msg, item_desc, context)
         # messages[0]['content'] += "\n▲知识库：\n" + self._fetch_tech_specs()
 
-        response = self.client.chat.completions.create(
-            model=os.getenv("MODEL_NAME", "qwen-max"),
-            messages=messages,
-            temperature=0.4,
-            max_tokens=500,
-            top_p=0.8,
+        response = await self._call_llm(
+            messages,
+            temperature=self._temperature(0.4),
             extra_body={
                 "enable_search": True,
-            }
+            },
+            on_first_sentence=on_first_sentence
         )
 
-        return self.safety_filter(response.choices[0].message.content)
+        return self.safety_filter(response)
 
 
     # def _fetch_tech_specs(self) -> str:
@@ -274,15 +803,29 @@ class TechAgent(BaseAgent):
 class ClassifyAgent(BaseAgent):
     """意图识别Agent"""
 
-    def generate(self, **args) -> str:
-        response = super().generate(**args)
+    async def generate(self, **args) -> str:
+        response = await super().generate(**args)
         return response
 
 
 class DefaultAgent(BaseAgent):
     """默认处理Agent"""
 
-    def _call_llm(self, messages: List[Dict], *args) -> str:
+    async def _call_llm(self, messages: List[Dict], *args, **kwargs) -> str:
         """限制默认回复长度"""
-        response = super()._call_llm(messages, temperature=0.7)
-        return response
\ No newline at end of file
+        kwargs.pop('temperature', None)
+        response = await super()._call_llm(messages, temperature=self._temperature(0.7), **kwargs)
+        return response
+
+
+class SummaryAgent(BaseAgent):
+    """会话摘要Agent"""
+
+    async def summarize(self, item_desc: str, previous_summary: str, history: str) -> str:
+        """生成滚动摘要，结果仅供内部使用，不经过安全过滤"""
+        messages = [
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": f"【商品信息】{item_desc}\n【已有摘要】{previous_summary or '无'}\n【最新对话】\n{history}"}
+        ]
+        response = await self._call_llm(messages, temperature=self._temperature(0.2))
+        return response.strip()
@@ -0,0 +1,124 @@
+import time
+from collections import deque
+from loguru import logger
+
+
+class CircuitBreaker:
+    """
+    熔断器
+
+    统计最近若干次调用的错误率和耗时分位数：错误率或P95耗时超过阈值时熔断（open），
+    熔断期间直接拒绝请求，由调用方快速降级；冷却时间过后进入半开（half_open），
+    只放行一个探测请求，成功则恢复（closed），失败则继续熔断。
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name='llm', window=20, min_calls=5, error_rate=0.5, latency_p95=20.0, open_seconds=30.0):
+        """
+        初始化熔断器
+
+        Args:
+            name: 名称，用于日志
+            window: 统计的最近调用次数
+            min_calls: 窗口内至少有这么多次调用才判断是否熔断
+            error_rate: 熔断的错误率阈值
+            latency_p95: 熔断的P95耗时阈值（秒），为0时不按耗时熔断
+            open_seconds: 熔断后的冷却时间（秒）
+        """
+        self.name = name
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.latency_p95 = latency_p95
+        self.open_seconds = open_seconds
+        self._results = deque(maxlen=window)  # (是否成功, 耗时)
+        self.state = self.CLOSED
+        self._opened_at = 0.0
+        self._probing = False
+        self._probe_started = 0.0
+        self.rejected = 0
+        self.trips = 0
+
+    def allow(self):
+        """
+        判断是否放行本次请求
+
+        Returns:
+            bool: 放行返回True，熔断中返回False
+        """
+        if self.state == self.CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == self.OPEN and now - self._opened_at >= self.open_seconds:
+            self.state = self.HALF_OPEN
+            self._probing = False
+        # 探测请求被取消等情况下不会回报结果，超过冷却时间后允许再次探测
+        if self.state == self.HALF_OPEN and (not self._probing or now - self._probe_started >= self.open_seconds):
+            self._probing = True
+            self._probe_started = now
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self, latency):
+        """记录一次成功调用"""
+        if self.state == self.HALF_OPEN:
+            logger.info(f"熔断器 {self.name} 探测成功，恢复正常")
+            self._results.clear()
+            self.state = self.CLOSED
+            self._probing = False
+        self._results.append((True, latency))
+        self._evaluate()
+
+    def record_failure(self, latency=0.0):
+        """记录一次失败调用"""
+        if self.state == self.HALF_OPEN:
+            self._trip("探测请求失败")
+            return
+        self._results.append((False, latency))
+        self._evaluate()
+
+    def _evaluate(self):
+        """根据窗口内的统计判断是否需要熔断"""
+        if self.state != self.CLOSED or len(self._results) < self.min_calls:
+            return
+        failures = sum(1 for ok, _ in self._results if not ok)
+        if failures / len(self._results) >= self.error_rate:
+            self._trip(f"错误率 {failures}/{len(self._results)}")
+            return
+        if self.latency_p95:
+            p95 = self.percentile(0.95)
+            if p95 >= self.latency_p95:
+                self._trip(f"P95耗时 {p95:.1f}s")
+
+    def _trip(self, reason):
+        """进入熔断状态"""
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._probing = False
+        self._results.clear()
+        self.trips += 1
+        logger.warning(f"熔断器 {self.name} 已熔断（{reason}），{self.open_seconds:.0f}秒内请求直接降级")
+
+    def percentile(self, ratio):
+        """窗口内成功调用耗时的分位数"""
+        latencies = sorted(latency for ok, latency in self._results if ok)
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(ratio * len(latencies)))]
+
+    def stats(self):
+        """熔断器状态和统计信息"""
+        total = len(self._results)
+        failures = sum(1 for ok, _ in self._results if not ok)
+        return {
+            'state': self.state,
+            'calls': total,
+            'error_rate': failures / total if total else 0.0,
+            'p50_latency': self.percentile(0.5),
+            'p95_latency': self.percentile(0.95),
+            'rejected': self.rejected,
+            'trips': self.trips,
+        }
@@ -1,29 +1,345 @@
 import sqlite3
 import os
 import json
-from datetime import datetime
+import gzip
+import asyncio
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from loguru import logger
 
 
+# 常用语句保持固定文本，配合连接的语句缓存(cached_statements)复用预编译结果
+SQL_INSERT_MESSAGE = "INSERT INTO messages (user_id, item_id, role, content, timestamp, chat_id, intent, intent_source) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+# 会话内按自增id排序（ISO时间戳可能重复），idx_chat_id 隐含rowid，等价于 (chat_id, id) 覆盖索引
+SQL_COUNT_MESSAGES = "SELECT COUNT(*) FROM messages WHERE chat_id = ?"
+SQL_OLDEST_TO_KEEP = "SELECT id FROM messages WHERE chat_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?"
+SQL_TRIM_MESSAGES = "DELETE FROM messages WHERE chat_id = ? AND id < ?"
+# 只读取摘要之后的消息，更早的消息已包含在摘要中
+SQL_SELECT_CONTEXT = "SELECT id, role, content FROM messages WHERE chat_id = ? AND id > ? ORDER BY id DESC LIMIT ?"
+SQL_UPSERT_ITEM = """
+INSERT INTO items (item_id, data, price, description, last_updated)
+VALUES (?, ?, ?, ?, ?)
+ON CONFLICT(item_id)
+DO UPDATE SET data = ?, price = ?, description = ?, last_updated = ?
+"""
+SQL_SELECT_ITEM = "SELECT data, last_updated FROM items WHERE item_id = ?"
+SQL_SELECT_ITEM_FACTS = "SELECT price, description FROM items WHERE item_id = ?"
+SQL_INCREMENT_BARGAIN = """
+INSERT INTO chat_bargain_counts (chat_id, count, last_updated)
+VALUES (?, 1, ?)
+ON CONFLICT(chat_id)
+DO UPDATE SET count = count + 1, last_updated = ?
+"""
+SQL_SELECT_BARGAIN = "SELECT count FROM chat_bargain_counts WHERE chat_id = ?"
+SQL_UPSERT_SUMMARY = """
+INSERT INTO chat_summaries (chat_id, summary, last_message_id, last_updated)
+VALUES (?, ?, ?, ?)
+ON CONFLICT(chat_id)
+DO UPDATE SET summary = ?, last_message_id = ?, last_updated = ?
+"""
+SQL_SELECT_SUMMARY = "SELECT summary, last_message_id FROM chat_summaries WHERE chat_id = ?"
+SQL_SELECT_IDLE_CHATS = "SELECT chat_id FROM messages WHERE chat_id IS NOT NULL GROUP BY chat_id HAVING MAX(timestamp) < ?"
+SQL_SELECT_CHAT_ROWS = "SELECT id, chat_id, user_id, item_id, role, content, timestamp, intent, intent_source FROM messages WHERE chat_id = ? ORDER BY id"
+SQL_DELETE_CHAT_UPTO = "DELETE FROM messages WHERE chat_id = ? AND id <= ?"
+ARCHIVE_COLUMNS = ("id", "chat_id", "user_id", "item_id", "role", "content", "timestamp", "intent", "intent_source")
+SQL_SELECT_LABELED_ROWS = "SELECT chat_id, role, content, intent, intent_source FROM messages WHERE chat_id IS NOT NULL ORDER BY chat_id, id"
+# 不作为训练样本的意图来源：本地模型自己的预测（避免自我强化错误）和回复缓存的重复标注
+UNTRAINABLE_INTENT_SOURCES = ("local", "cache")
+SQL_INSERT_LLM_USAGE = """
+INSERT INTO llm_usage (timestamp, chat_id, item_id, intent, model, prompt_tokens, cached_tokens, completion_tokens, latency_ms, cost)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+LLM_USAGE_FIELDS = ("timestamp", "chat_id", "item_id", "intent", "model", "prompt_tokens", "cached_tokens",
+                    "completion_tokens", "latency_ms", "cost")
+SQL_LLM_USAGE_REPORT = """
+SELECT {group_by}, COUNT(*), SUM(prompt_tokens), SUM(cached_tokens), SUM(completion_tokens), AVG(latency_ms), SUM(cost)
+FROM llm_usage WHERE timestamp >= ? GROUP BY {group_by} ORDER BY SUM(cost) DESC, SUM(prompt_tokens + completion_tokens) DESC LIMIT ?
+"""
+SQL_DELETE_OLD_LLM_USAGE = "DELETE FROM llm_usage WHERE timestamp < ?"
+SQL_SELECT_JOURNAL_SEQ = "SELECT last_seq FROM journal_state WHERE id = 1"
+SQL_UPDATE_JOURNAL_SEQ = "UPDATE journal_state SET last_seq = ? WHERE id = 1"
+
+
+class ContextWindowCache:
+    """
+    会话上下文窗口的LRU缓存
+    
+    按会话缓存最近的消息窗口、议价次数和对话摘要，同时限制缓存的会话数和估算内存占用，
+    超出时淘汰最久未访问的会话。缓存未命中时由调用方从数据库加载，加载期间
+    如有新消息写入则放弃本次回填，避免缓存中出现过期数据。
+    """
+
+    ENTRY_OVERHEAD = 256  # 每个会话条目的固定开销估算(字节)
+    MESSAGE_OVERHEAD = 64  # 每条消息的固定开销估算(字节)
+
+    def __init__(self, max_history=100, max_chats=1000, max_bytes=64 * 1024 * 1024):
+        """
+        初始化缓存
+        
+        Args:
+            max_history: 每个会话缓存的最大消息数
+            max_chats: 最多缓存的会话数
+            max_bytes: 缓存估算内存上限(字节)
+        """
+        self.max_history = max_history
+        self.max_chats = max_chats
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # chat_id -> {'messages': deque, 'bargain_count': int, 'summary': str, 'bytes': int}
+        self._loading = {}  # chat_id -> 加载期间是否有新写入
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _message_size(self, role, content):
+        """估算单条消息的内存占用"""
+        return sys.getsizeof(content) + len(role) + self.MESSAGE_OVERHEAD
+
+    def get(self, chat_id):
+        """
+        获取缓存的会话窗口
+        
+        Returns:
+            tuple: (消息列表, 议价次数, 对话摘要)，未命中返回None
+        """
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is None:
+                self.misses += 1
+                self._loading.setdefault(chat_id, False)
+                return None
+            self._entries.move_to_end(chat_id)
+            self.hits += 1
+            messages = [{"role": role, "content": content} for role, content in entry['messages']]
+            return messages, entry['bargain_count'], entry['summary']
+
+    def fill(self, chat_id, messages, bargain_count, summary=None):
+        """未命中后回填从数据库加载的会话窗口，加载期间有新写入时放弃回填"""
+        with self._lock:
+            dirty = self._loading.pop(chat_id, True)
+            if dirty or chat_id in self._entries:
+                return
+            window = deque(maxlen=self.max_history)
+            size = self.ENTRY_OVERHEAD + (sys.getsizeof(summary) if summary else 0)
+            for msg in messages[-self.max_history:]:
+                window.append((msg['role'], msg['content']))
+                size += self._message_size(msg['role'], msg['content'])
+            self._entries[chat_id] = {'messages': window, 'bargain_count': bargain_count, 'summary': summary, 'bytes': size}
+            self.total_bytes += size
+            self._evict()
+
+    def cancel_load(self, chat_id):
+        """未命中后加载失败时调用，清理加载状态"""
+        with self._lock:
+            self._loading.pop(chat_id, None)
+
+    def append(self, chat_id, role, content):
+        """写入新消息（write-through），仅更新已缓存的会话"""
+        with self._lock:
+            if chat_id in self._loading:
+                self._loading[chat_id] = True
+            entry = self._entries.get(chat_id)
+            if entry is None:
+                return
+            window = entry['messages']
+            if len(window) == window.maxlen:
+                old_role, old_content = window[0]
+                delta = -self._message_size(old_role, old_content)
+            else:
+                delta = 0
+            window.append((role, content))
+            delta += self._message_size(role, content)
+            entry['bytes'] += delta
+            self.total_bytes += delta
+            self._entries.move_to_end(chat_id)
+            self._evict()
+
+    def increment_bargain_count(self, chat_id):
+        """议价次数加一，仅更新已缓存的会话"""
+        with self._lock:
+            if chat_id in self._loading:
+                self._loading[chat_id] = True
+            entry = self._entries.get(chat_id)
+            if entry is not None:
+                entry['bargain_count'] += 1
+
+    def get_bargain_count(self, chat_id):
+        """获取缓存的议价次数，未缓存返回None"""
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            return entry['bargain_count'] if entry is not None else None
+
+    def evict(self, chat_id):
+        """移除指定会话的缓存"""
+        with self._lock:
+            if chat_id in self._loading:
+                self._loading[chat_id] = True
+            entry = self._entries.pop(chat_id, None)
+            if entry is not None:
+                self.total_bytes -= entry['bytes']
+
+    def _evict(self):
+        """淘汰最久未访问的会话直到满足容量限制（调用方需持有锁）"""
+        while self._entries and (len(self._entries) > self.max_chats or self.total_bytes > self.max_bytes):
+            _, entry = self._entries.popitem(last=False)
+            self.total_bytes -= entry['bytes']
+
+    def stats(self):
+        """缓存统计信息"""
+        with self._lock:
+            return {
+                'chats': len(self._entries),
+                'bytes': self.total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
 class ChatContextManager:
     """
     聊天上下文管理器
     
     负责存储和检索用户与商品之间的对话历史，使用SQLite数据库进行持久化存储。
     支持按会话ID检索对话历史，以及议价次数统计。
+    
+    数据库使用WAL模式，写操作共用一个长连接（加锁串行），读操作使用每个线程独立的
+    只读连接，读不会被写阻塞，也避免了每次操作都重新建立连接的开销。
+    
+    开启写缓冲(write_behind)时，新消息先追加到磁盘上的日志文件并放入内存缓冲，
+    由后台线程按时间或数量批量写入数据库（多个会话的插入和清理合并为一个事务）。
+    进程崩溃后启动时会重放日志中尚未落库的消息，已落库的序号记录在journal_state表中，
+    保证不会重复写入。
+    
+    历史清理按会话记录消息数，超出 max_history + retention_slack 后才一次性删除多余的旧消息，
+    插入成本不随表规模增长。
+    
+    离线工具（模型训练、用量报表）应以 read_only=True 打开，只读连接不会重放或截断
+    运行中的机器人的写缓冲日志，也不会修改数据库结构。
+    
+    长期不活跃的会话可通过 archive_idle_chats 归档到gzip压缩的JSONL文件并从热表中删除，
+    数据库使用增量vacuum回收空间，使热数据保持在页缓存可容纳的规模。
+    
+    每个会话可保存一份滚动更新的对话摘要（成交价、发货承诺、买家顾虑等），
+    获取上下文时以系统消息的形式附在对话历史之前。
+    
+    最近访问的会话窗口缓存在内存中（LRU，限制会话数和内存），新消息同时写入缓存和存储，
+    活跃会话组装上下文时无需读库。
     """
     
-    def __init__(self, max_history=100, db_path="data/chat_history.db"):
+    MAX_COUNTED_CHATS = 10000  # 内存中记录消息数的会话数上限，超出后淘汰最久未写入的会话
+    MAX_FLUSH_BACKOFF = 30.0  # 后台落库出错后的最长重试间隔（秒）
+    
+    def __init__(self, max_history=100, db_path="data/chat_history.db", cache_size_kb=8192,
+                 write_behind=True, flush_interval=0.5, flush_batch_size=200,
+                 journal_path=None, journal_fsync=False,
+                 context_cache_chats=1000, context_cache_bytes=64 * 1024 * 1024,
+                 retention_slack=None, read_only=False):
         """
         初始化聊天上下文管理器
         
         Args:
             max_history: 每个对话保留的最大消息数
             db_path: SQLite数据库文件路径
+            cache_size_kb: 每个连接的页缓存大小(KB)
+            write_behind: 是否开启消息写缓冲
+            flush_interval: 写缓冲刷新间隔（秒）
+            flush_batch_size: 缓冲消息达到该数量时立即刷新
+            journal_path: 写缓冲日志文件路径，默认与数据库同目录
+            journal_fsync: 每条日志是否fsync，关闭时可防进程崩溃，开启时可防断电
+            context_cache_chats: 上下文缓存的最大会话数，为0时不缓存
+            context_cache_bytes: 上下文缓存的估算内存上限(字节)
+            retention_slack: 允许超出max_history的消息数，超出后批量清理，默认为max_history的1/4
+            read_only: 以只读方式打开已有数据库（离线工具使用），不开启写缓冲，不初始化表结构
         """
         self.max_history = max_history
         self.db_path = db_path
-        self._init_db()
+        self.cache_size_kb = cache_size_kb
+        self.retention_slack = retention_slack if retention_slack is not None else max(1, max_history // 4)
+        self._chat_counts = OrderedDict()  # chat_id -> 库中消息数（LRU，未命中时从库中统计），仅在持有写锁时读写
+        self._write_lock = threading.RLock()
+        self._local = threading.local()
+        self._readers = []
+        self._readers_lock = threading.Lock()
+        self.context_cache = ContextWindowCache(max_history, context_cache_chats, context_cache_bytes) if context_cache_chats > 0 else None
+        self.read_only = read_only
+        if read_only:
+            if not os.path.exists(db_path):
+                raise FileNotFoundError(db_path)
+            self._conn = self._connect(read_only=True)
+        else:
+            self._init_db()
+        
+        # 写缓冲相关状态
+        self.write_behind = write_behind and not read_only
+        self.flush_interval = flush_interval
+        self.flush_batch_size = flush_batch_size
+        self.journal_path = journal_path or os.path.splitext(db_path)[0] + ".journal.jsonl"
+        self.journal_fsync = journal_fsync
+        self._pending = []
+        # 待落库的大模型用量记录，不写日志（崩溃时最多丢失一个刷新周期的统计）；
+        # deque的追加和弹出是原子操作，在事件循环中记录用量无需加锁
+        self._usage_pending = deque()
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flush_event = threading.Event()
+        self._closed = False
+        self._journal = None
+        self._journal_stale = False  # 日志中是否还有已落库的消息（重写日志失败后为True）
+        self._flush_thread = None
+        if self.write_behind:
+            self._open_journal()
+        
+    def _connect(self, read_only=False):
+        """创建一个配置好WAL和缓存参数的数据库连接"""
+        if self.read_only:
+            # 只读模式下以只读方式打开文件，不切换日志模式
+            conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, check_same_thread=False,
+                                   cached_statements=128, timeout=10)
+            conn.execute(f"PRAGMA cache_size=-{int(self.cache_size_kb)}")
+            conn.execute("PRAGMA query_only=1")
+            return conn
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=128, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # WAL模式下NORMAL只在检查点时fsync，崩溃不会损坏数据库
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{int(self.cache_size_kb)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        if read_only:
+            conn.execute("PRAGMA query_only=1")
+        return conn
+
+    def _reader(self):
+        """获取当前线程的只读连接"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect(read_only=True)
+            self._local.conn = conn
+            with self._readers_lock:
+                self._readers.append(conn)
+        return conn
+
+    def close(self):
+        """刷新写缓冲并关闭所有数据库连接"""
+        if self.write_behind and not self._closed:
+            self._closed = True
+            self._flush_event.set()
+            self._flush_thread.join()
+            self.flush()
+            self._journal.close()
+        with self._write_lock:
+            self._conn.close()
+        with self._readers_lock:
+            for conn in self._readers:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            self._readers.clear()
+        self._local = threading.local()
         
     def _init_db(self):
         """初始化数据库表结构"""
@@ -32,9 +348,17 @@ class ChatContextManager:
         if db_dir and not os.path.exists(db_dir):
             os.makedirs(db_dir)
             
-        conn = sqlite3.connect(self.db_path)
+        self._conn = self._connect()
+        conn = self._conn
         cursor = conn.cursor()
         
+        # 开启增量vacuum，归档删除数据后可逐步回收空间（切换模式需一次完整VACUUM才能生效）
+        if cursor.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            if cursor.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0]:
+                logger.info("正在转换数据库为增量vacuum模式，数据较多时可能需要一些时间...")
+            cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            cursor.execute("VACUUM")
+        
         # 创建消息表
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS messages (
@@ -44,7 +368,9 @@ class ChatContextManager:
             role TEXT NOT NULL,
             content TEXT NOT NULL,
             timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            chat_id TEXT
+            chat_id TEXT,
+            intent TEXT,
+            intent_source TEXT
         )
         ''')
         
@@ -55,6 +381,16 @@ class ChatContextManager:
             cursor.execute('ALTER TABLE messages ADD COLUMN chat_id TEXT')
             logger.info("已为messages表添加chat_id字段")
         
+        # 助手回复记录识别出的意图，作为本地意图模型的训练标注
+        if 'intent' not in columns:
+            cursor.execute('ALTER TABLE messages ADD COLUMN intent TEXT')
+            logger.info("已为messages表添加intent字段")
+        
+        # 意图的来源（rule/llm/local/cache），训练时排除本地模型自己的预测
+        if 'intent_source' not in columns:
+            cursor.execute('ALTER TABLE messages ADD COLUMN intent_source TEXT')
+            logger.info("已为messages表添加intent_source字段")
+        
         # 创建索引以加速查询
         cursor.execute('''
         CREATE INDEX IF NOT EXISTS idx_user_item ON messages (user_id, item_id)
@@ -64,6 +400,10 @@ class ChatContextManager:
         CREATE INDEX IF NOT EXISTS idx_chat_id ON messages (chat_id)
         ''')
         
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_chat_timestamp ON messages (chat_id, timestamp)
+        ''')
+        
         cursor.execute('''
         CREATE INDEX IF NOT EXISTS idx_timestamp ON messages (timestamp)
         ''')
@@ -77,6 +417,22 @@ class ChatContextManager:
         )
         ''')
         
+        # 创建会话摘要表，保存滚动更新的对话摘要
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_summaries (
+            chat_id TEXT PRIMARY KEY,
+            summary TEXT NOT NULL,
+            last_message_id INTEGER NOT NULL DEFAULT 0,
+            last_updated DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        
+        # 摘要记录已包含的最后一条消息ID，之后的消息原文保留在上下文中
+        cursor.execute("PRAGMA table_info(chat_summaries)")
+        if 'last_message_id' not in [column[1] for column in cursor.fetchall()]:
+            cursor.execute('ALTER TABLE chat_summaries ADD COLUMN last_message_id INTEGER NOT NULL DEFAULT 0')
+            logger.info("已为chat_summaries表添加last_message_id字段")
+        
         # 创建商品信息表
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS items (
@@ -88,82 +444,372 @@ class ChatContextManager:
         )
         ''')
         
+        # 大模型调用用量表，按会话、商品、意图统计token和费用
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS llm_usage (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp DATETIME NOT NULL,
+            chat_id TEXT,
+            item_id TEXT,
+            intent TEXT,
+            model TEXT,
+            prompt_tokens INTEGER NOT NULL DEFAULT 0,
+            cached_tokens INTEGER NOT NULL DEFAULT 0,
+            completion_tokens INTEGER NOT NULL DEFAULT 0,
+            latency_ms INTEGER NOT NULL DEFAULT 0,
+            cost REAL NOT NULL DEFAULT 0
+        )
+        ''')
+        
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_llm_usage_timestamp ON llm_usage (timestamp)
+        ''')
+        
+        # 写缓冲日志的落库进度
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS journal_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            last_seq INTEGER NOT NULL DEFAULT 0
+        )
+        ''')
+        cursor.execute("INSERT OR IGNORE INTO journal_state (id, last_seq) VALUES (1, 0)")
+        
         conn.commit()
-        conn.close()
         logger.info(f"聊天历史数据库初始化完成: {self.db_path}")
+
+    def _open_journal(self):
+        """重放未落库的日志并打开日志文件，启动后台刷新线程"""
+        last_seq = self._conn.execute(SQL_SELECT_JOURNAL_SEQ).fetchone()[0]
+        self._seq = last_seq
+        
+        replay = []
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # 崩溃时最后一行可能只写了一半
+                        logger.warning("写缓冲日志中存在不完整的记录，已跳过")
+                        continue
+                    self._seq = max(self._seq, record['seq'])
+                    if record['seq'] > last_seq:
+                        replay.append(record)
         
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+        if replay:
+            self._pending.extend(replay)
+            self.flush()
+            logger.info(f"已从写缓冲日志恢复 {len(replay)} 条未落库消息")
+        else:
+            self._rewrite_journal()
+        
+        self._flush_thread = threading.Thread(target=self._flush_loop, name="ctx-flusher", daemon=True)
+        self._flush_thread.start()
 
+    def _flush_loop(self):
+        """
+        后台刷新线程，按时间间隔或缓冲数量触发批量落库
+        
+        落库或重写日志出错（磁盘满、权限等）时记录日志并按指数退避重试，线程不会退出
+        """
+        backoff = 0.0
+        retry_at = 0.0
+        while not self._closed:
+            self._flush_event.wait(self.flush_interval)
+            self._flush_event.clear()
+            if time.monotonic() < retry_at:
+                continue
+            try:
+                self.flush()
+                backoff = 0.0
+            except Exception as e:
+                backoff = min(max(backoff * 2, self.flush_interval, 1.0), self.MAX_FLUSH_BACKOFF)
+                retry_at = time.monotonic() + backoff
+                with self._pending_lock:
+                    pending = len(self._pending)
+                logger.error(f"写缓冲落库出错，{backoff:.1f}秒后重试（待落库 {pending} 条）: {e}")
+
+    def flush(self):
+        """
+        将写缓冲中的消息批量写入数据库
+        
+        Returns:
+            int: 本次落库的消息数量
+        """
+        with self._flush_lock:
+            with self._pending_lock:
+                batch = list(self._pending)
+            usage_batch = []
+            while self._usage_pending:
+                usage_batch.append(self._usage_pending.popleft())
+            if not batch and not usage_batch:
+                # 上次重写日志失败时，日志中仍有已落库的消息，重试清理
+                if self._journal_stale:
+                    self._rewrite_journal()
+                    self._journal_stale = False
+                return 0
             
-    def save_item_info(self, item_id, item_data):
+            with self._write_lock:
+                conn = self._conn
+                try:
+                    if usage_batch:
+                        conn.executemany(SQL_INSERT_LLM_USAGE, [
+                            tuple(record.get(field) for field in LLM_USAGE_FIELDS) for record in usage_batch
+                        ])
+                    if not batch:
+                        conn.commit()
+                        return 0
+                    
+                    for record in batch:
+                        cursor = conn.execute(
+                            SQL_INSERT_MESSAGE,
+                            (record['user_id'], record['item_id'], record['role'], record['content'],
+                             record['timestamp'], record['chat_id'], record.get('intent'), record.get('intent_source'))
+                        )
+                        record['rowid'] = cursor.lastrowid
+                    
+                    # 每个涉及的会话只做一次保留检查
+                    added = {}
+                    for record in batch:
+                        added[record['chat_id']] = added.get(record['chat_id'], 0) + 1
+                    counts = self._apply_retention(conn, added)
+                    
+                    conn.execute(SQL_UPDATE_JOURNAL_SEQ, (batch[-1]['seq'],))
+                    conn.commit()
+                    self._remember_counts(counts)
+                except Exception as e:
+                    logger.error(f"批量写入消息时出错: {e}")
+                    conn.rollback()
+                    for record in batch:
+                        record.pop('rowid', None)
+                    self._usage_pending.extendleft(reversed(usage_batch))
+                    return 0
+            
+            with self._pending_lock:
+                del self._pending[:len(batch)]
+            self._journal_stale = True
+            self._rewrite_journal()
+            self._journal_stale = False
+            logger.debug(f"写缓冲已落库 {len(batch)} 条消息")
+            return len(batch)
+
+    def _rewrite_journal(self):
         """
-        保存商品信息到数据库
+        用当前仍未落库的消息重写日志文件（调用方需持有_flush_lock或处于初始化阶段）
         
-        Args:
-            item_id: 商品ID
-            item_data: 商品信息字典
+        临时文件的写入和fsync在_pending_lock之外进行，持锁期间只补写这段时间新追加的消息并替换文件，
+        不会让新消息的写入等待磁盘。
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        with self._pending_lock:
+            if not self._pending:
+                self._journal.seek(0)
+                self._journal.truncate()
+                return
+            snapshot = list(self._pending)
         
+        tmp_path = self.journal_path + ".tmp"
+        f = open(tmp_path, "w", encoding="utf-8")
         try:
-            # 从商品数据中提取有用信息
-            price = float(item_data.get('soldPrice', 0))
-            description = item_data.get('desc', '')
+            for record in snapshot:
+                f.write(self._journal_line(record))
+            f.flush()
+            os.fsync(f.fileno())
+            with self._pending_lock:
+                # 只有flush会从头部移除消息，此期间新消息都追加在快照之后
+                for record in self._pending[len(snapshot):]:
+                    f.write(self._journal_line(record))
+                f.flush()
+                if self.journal_fsync:
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.journal_path)
+                self._journal.close()
+                self._journal = f
+        except Exception:
+            f.close()
+            raise
+
+    @staticmethod
+    def _journal_line(record):
+        """序列化一条日志记录"""
+        return json.dumps({k: v for k, v in record.items() if k != 'rowid'}, ensure_ascii=False) + "\n"
+
+    def _apply_retention(self, conn, added):
+        """
+        根据新增消息数更新会话计数，超出阈值的会话批量清理旧消息（调用方需持有写锁）
+        
+        Args:
+            conn: 写连接，需处于本次写入的事务中
+            added: chat_id -> 本次新增的消息数
             
-            # 将整个商品数据转换为JSON字符串
-            data_json = json.dumps(item_data, ensure_ascii=False)
+        Returns:
+            dict: 事务提交后应写回的会话消息数
+        """
+        counts = {}
+        for chat_id, count in added.items():
+            if chat_id in self._chat_counts:
+                total = self._chat_counts[chat_id] + count
+            else:
+                # 首次遇到的会话从库中统计（已包含本事务中的插入）
+                total = conn.execute(SQL_COUNT_MESSAGES, (chat_id,)).fetchone()[0]
+            
+            if total > self.max_history + self.retention_slack:
+                oldest_to_keep = conn.execute(SQL_OLDEST_TO_KEEP, (chat_id, self.max_history - 1)).fetchone()
+                if oldest_to_keep:
+                    conn.execute(SQL_TRIM_MESSAGES, (chat_id, oldest_to_keep[0]))
+                total = min(total, self.max_history)
+            counts[chat_id] = total
+        return counts
+
+    def _remember_counts(self, counts):
+        """事务提交后写回会话消息数，只保留最近写入的会话（调用方需持有写锁）"""
+        for chat_id, total in counts.items():
+            self._chat_counts[chat_id] = total
+            self._chat_counts.move_to_end(chat_id)
+        while len(self._chat_counts) > self.MAX_COUNTED_CHATS:
+            self._chat_counts.popitem(last=False)
             
-            cursor.execute(
-                """
-                INSERT INTO items (item_id, data, price, description, last_updated) 
-                VALUES (?, ?, ?, ?, ?)
-                ON CONFLICT(item_id) 
-                DO UPDATE SET data = ?, price = ?, description = ?, last_updated = ?
-                """,
-                (
-                    item_id, data_json, price, description, datetime.now().isoformat(),
-                    data_json, price, description, datetime.now().isoformat()
-                )
-            )
             
-            conn.commit()
-            logger.debug(f"商品信息已保存: {item_id}")
+    def archive_idle_chats(self, idle_days=30, archive_dir=None, batch_size=200):
+        """
+        归档长期不活跃的会话
+        
+        将最后一条消息早于 idle_days 天的会话写入gzip压缩的JSONL分段文件，
+        从消息表中删除后执行增量vacuum回收空间。每批会话单独一个事务和分段文件。
+        
+        Args:
+            idle_days: 不活跃天数阈值
+            archive_dir: 归档目录，默认为数据库目录下的archive
+            batch_size: 每个分段文件包含的会话数
+            
+        Returns:
+            int: 归档的会话数
+        """
+        archive_dir = archive_dir or os.path.join(os.path.dirname(self.db_path) or ".", "archive")
+        cutoff = (datetime.now() - timedelta(days=idle_days)).isoformat()
+        
+        # 先落库写缓冲，保证判断不活跃时不遗漏未落库的消息
+        if self.write_behind:
+            self.flush()
+        
+        try:
+            chat_ids = [row[0] for row in self._reader().execute(SQL_SELECT_IDLE_CHATS, (cutoff,)).fetchall()]
         except Exception as e:
-            logger.error(f"保存商品信息时出错: {e}")
-            conn.rollback()
-        finally:
-            conn.close()
+            logger.error(f"查询不活跃会话时出错: {e}")
+            return 0
+        if not chat_ids:
+            return 0
+        os.makedirs(archive_dir, exist_ok=True)
+        
+        archived = 0
+        segment_prefix = datetime.now().strftime("%Y%m%d-%H%M%S")
+        for start in range(0, len(chat_ids), batch_size):
+            batch = chat_ids[start:start + batch_size]
+            path = os.path.join(archive_dir, f"messages-{segment_prefix}-{start // batch_size:04d}.jsonl.gz")
+            with self._write_lock:
+                conn = self._conn
+                try:
+                    last_ids = {}
+                    with open(path, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb") as gz:
+                        for chat_id in batch:
+                            for row in conn.execute(SQL_SELECT_CHAT_ROWS, (chat_id,)).fetchall():
+                                gz.write((json.dumps(dict(zip(ARCHIVE_COLUMNS, row)), ensure_ascii=False) + "\n").encode("utf-8"))
+                                last_ids[chat_id] = row[0]
+                        gz.close()
+                        raw.flush()
+                        os.fsync(raw.fileno())
+                    
+                    # 只删除已写入归档的消息，归档期间新到的消息保留在热表中
+                    for chat_id, last_id in last_ids.items():
+                        conn.execute(SQL_DELETE_CHAT_UPTO, (chat_id, last_id))
+                    conn.commit()
+                except Exception as e:
+                    logger.error(f"归档会话时出错: {e}")
+                    conn.rollback()
+                    if os.path.exists(path):
+                        os.remove(path)
+                    continue
+                
+                for chat_id in batch:
+                    self._chat_counts.pop(chat_id, None)
+                    if self.context_cache:
+                        self.context_cache.evict(chat_id)
+            archived += len(last_ids)
+        
+        with self._write_lock:
+            try:
+                self._conn.execute("PRAGMA incremental_vacuum").fetchall()
+                self._conn.commit()
+                self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+            except Exception as e:
+                logger.error(f"增量vacuum时出错: {e}")
+        
+        logger.info(f"已归档 {archived} 个不活跃会话到 {archive_dir}")
+        return archived
+            
+    def save_item_info(self, item_id, item_data):
+        """
+        保存商品信息到数据库
+        
+        Args:
+            item_id: 商品ID
+            item_data: 商品信息字典
+            
+        Returns:
+            bool: 商品是新增的或价格、描述有变化（调用方据此清理依赖商品信息的缓存）
+        """
+        with self._write_lock:
+            conn = self._conn
+            try:
+                # 从商品数据中提取有用信息
+                price = float(item_data.get('soldPrice', 0))
+                description = item_data.get('desc', '')
+                previous = conn.execute(SQL_SELECT_ITEM_FACTS, (item_id,)).fetchone()
+                changed = previous is None or previous[0] != price or previous[1] != description
+                
+                # 将整个商品数据转换为JSON字符串
+                data_json = json.dumps(item_data, ensure_ascii=False)
+                now = datetime.now().isoformat()
+                
+                conn.execute(
+                    SQL_UPSERT_ITEM,
+                    (
+                        item_id, data_json, price, description, now,
+                        data_json, price, description, now
+                    )
+                )
+                
+                conn.commit()
+                logger.debug(f"商品信息已保存: {item_id}")
+                return changed
+            except Exception as e:
+                logger.error(f"保存商品信息时出错: {e}")
+                conn.rollback()
+                return False
     
-    def get_item_info(self, item_id):
+    def get_item_info(self, item_id, max_age=None):
         """
         从数据库获取商品信息
         
         Args:
             item_id: 商品ID
+            max_age: 最长有效时间（秒），超过后视为需要刷新，为空时不检查
             
         Returns:
-            dict: 商品信息字典，如果不存在返回None
+            dict: 商品信息字典，如果不存在或已过期返回None
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
         try:
-            cursor.execute(
-                "SELECT data FROM items WHERE item_id = ?",
-                (item_id,)
-            )
-            
-            result = cursor.fetchone()
-            if result:
-                return json.loads(result[0])
-            return None
+            result = self._reader().execute(SQL_SELECT_ITEM, (item_id,)).fetchone()
+            if not result:
+                return None
+            if max_age and datetime.fromisoformat(result[1]) < datetime.now() - timedelta(seconds=max_age):
+                return None
+            return json.loads(result[0])
         except Exception as e:
             logger.error(f"获取商品信息时出错: {e}")
             return None
-        finally:
-            conn.close()
 
-    def add_message_by_chat(self, chat_id, user_id, item_id, role, content):
+    def add_message_by_chat(self, chat_id, user_id, item_id, role, content, intent=None, intent_source=None):
         """
         基于会话ID添加新消息到对话历史
         
@@ -173,84 +819,134 @@ class ChatContextManager:
             item_id: 商品ID
             role: 消息角色 (user/assistant)
             content: 消息内容
+            intent: 自动回复时识别出的意图，人工消息为空
+            intent_source: 意图的来源（rule/llm/local/cache）
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        if self.write_behind:
+            self._append_pending(chat_id, user_id, item_id, role, content, intent, intent_source)
+            return
         
-        try:
-            # 插入新消息，使用chat_id作为额外标识
-            cursor.execute(
-                "INSERT INTO messages (user_id, item_id, role, content, timestamp, chat_id) VALUES (?, ?, ?, ?, ?, ?)",
-                (user_id, item_id, role, content, datetime.now().isoformat(), chat_id)
-            )
-            
-            # 检查是否需要清理旧消息（基于chat_id）
-            cursor.execute(
-                """
-                SELECT id FROM messages 
-                WHERE chat_id = ? 
-                ORDER BY timestamp DESC 
-                LIMIT ?, 1
-                """, 
-                (chat_id, self.max_history)
-            )
-            
-            oldest_to_keep = cursor.fetchone()
-            if oldest_to_keep:
-                cursor.execute(
-                    "DELETE FROM messages WHERE chat_id = ? AND id < ?",
-                    (chat_id, oldest_to_keep[0])
+        with self._write_lock:
+            conn = self._conn
+            try:
+                # 插入新消息，使用chat_id作为额外标识
+                conn.execute(
+                    SQL_INSERT_MESSAGE,
+                    (user_id, item_id, role, content, datetime.now().isoformat(), chat_id, intent, intent_source)
                 )
-            
-            conn.commit()
+                
+                # 检查是否需要清理旧消息（基于chat_id）
+                counts = self._apply_retention(conn, {chat_id: 1})
+                
+                conn.commit()
+                self._remember_counts(counts)
+            except Exception as e:
+                logger.error(f"添加消息到数据库时出错: {e}")
+                conn.rollback()
+                return
+        if self.context_cache:
+            self.context_cache.append(chat_id, role, content)
+
+    def _append_pending(self, chat_id, user_id, item_id, role, content, intent=None, intent_source=None):
+        """追加消息到写缓冲：先写日志文件，再放入内存缓冲和上下文缓存"""
+        try:
+            with self._pending_lock:
+                self._seq += 1
+                record = {
+                    'seq': self._seq,
+                    'chat_id': chat_id,
+                    'user_id': user_id,
+                    'item_id': item_id,
+                    'role': role,
+                    'content': content,
+                    'timestamp': datetime.now().isoformat(),
+                }
+                if intent:
+                    record['intent'] = intent
+                if intent_source:
+                    record['intent_source'] = intent_source
+                self._journal.write(self._journal_line(record))
+                self._journal.flush()
+                if self.journal_fsync:
+                    os.fsync(self._journal.fileno())
+                self._pending.append(record)
+                # 与缓冲追加在同一临界区内更新缓存，保证与未命中加载的快照一致
+                if self.context_cache:
+                    self.context_cache.append(chat_id, role, content)
+                full = len(self._pending) >= self.flush_batch_size
+            if full:
+                self._flush_event.set()
         except Exception as e:
-            logger.error(f"添加消息到数据库时出错: {e}")
-            conn.rollback()
-        finally:
-            conn.close()
+            logger.error(f"添加消息到写缓冲时出错: {e}")
+
+    def _pending_by_chat(self, chat_id):
+        """获取会话中尚未落库的消息快照"""
+        if not self.write_behind:
+            return []
+        with self._pending_lock:
+            return [record for record in self._pending if record['chat_id'] == chat_id]
 
     def get_context_by_chat(self, chat_id):
         """
         基于会话ID获取对话历史
         
+        有摘要时只返回摘要和摘要之后的消息，更早的消息已包含在摘要中
+        
         Args:
             chat_id: 会话ID
             
         Returns:
             list: 包含对话历史的列表
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        if self.context_cache:
+            cached = self.context_cache.get(chat_id)
+            if cached is not None:
+                messages, bargain_count, summary = cached
+                return self._with_chat_facts(messages, bargain_count, summary)
         
         try:
-            cursor.execute(
-                """
-                SELECT role, content FROM messages 
-                WHERE chat_id = ? 
-                ORDER BY timestamp ASC
-                LIMIT ?
-                """, 
-                (chat_id, self.max_history)
+            summary, last_message_id = self._query_summary(chat_id)
+            # 先取缓冲快照再读库：读库期间刚落库的消息通过rowid去重，已包含在摘要中的消息跳过
+            pending = self._pending_by_chat(chat_id)
+            rows = self._reader().execute(SQL_SELECT_CONTEXT, (chat_id, last_message_id, self.max_history)).fetchall()
+            rows.reverse()
+            db_ids = {row[0] for row in rows}
+            messages = [{"role": role, "content": content} for _, role, content in rows]
+            messages.extend(
+                {"role": record['role'], "content": record['content']}
+                for record in pending
+                if record.get('rowid') not in db_ids and record.get('rowid', last_message_id + 1) > last_message_id
             )
+            messages = messages[-self.max_history:]
             
-            messages = [{"role": role, "content": content} for role, content in cursor.fetchall()]
-            
-            # 获取议价次数并添加到上下文中
-            bargain_count = self.get_bargain_count_by_chat(chat_id)
-            if bargain_count > 0:
-                messages.append({
-                    "role": "system", 
-                    "content": f"议价次数: {bargain_count}"
-                })
+            bargain_count = self._query_bargain_count(chat_id)
+            if self.context_cache:
+                self.context_cache.fill(chat_id, messages, bargain_count, summary)
+            messages = self._with_chat_facts(messages, bargain_count, summary)
             
         except Exception as e:
             logger.error(f"获取对话历史时出错: {e}")
+            if self.context_cache:
+                self.context_cache.cancel_load(chat_id)
             messages = []
-        finally:
-            conn.close()
         
         return messages
 
+    @staticmethod
+    def _with_chat_facts(messages, bargain_count, summary=None):
+        """将对话摘要和议价次数添加到上下文中"""
+        if summary:
+            messages.insert(0, {
+                "role": "system",
+                "content": f"对话摘要: {summary}"
+            })
+        if bargain_count > 0:
+            messages.append({
+                "role": "system", 
+                "content": f"议价次数: {bargain_count}"
+            })
+        return messages
+
     def increment_bargain_count_by_chat(self, chat_id):
         """
         基于会话ID增加议价次数
@@ -258,28 +954,21 @@ class ChatContextManager:
         Args:
             chat_id: 会话ID
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        try:
-            # 使用UPSERT语法直接基于chat_id增加议价次数
-            cursor.execute(
-                """
-                INSERT INTO chat_bargain_counts (chat_id, count, last_updated)
-                VALUES (?, 1, ?)
-                ON CONFLICT(chat_id) 
-                DO UPDATE SET count = count + 1, last_updated = ?
-                """,
-                (chat_id, datetime.now().isoformat(), datetime.now().isoformat())
-            )
-            
-            conn.commit()
-            logger.debug(f"会话 {chat_id} 议价次数已增加")
-        except Exception as e:
-            logger.error(f"增加议价次数时出错: {e}")
-            conn.rollback()
-        finally:
-            conn.close()
+        with self._write_lock:
+            conn = self._conn
+            try:
+                # 使用UPSERT语法直接基于chat_id增加议价次数
+                now = datetime.now().isoformat()
+                conn.execute(SQL_INCREMENT_BARGAIN, (chat_id, now, now))
+                
+                conn.commit()
+                logger.debug(f"会话 {chat_id} 议价次数已增加")
+            except Exception as e:
+                logger.error(f"增加议价次数时出错: {e}")
+                conn.rollback()
+                return
+        if self.context_cache:
+            self.context_cache.increment_bargain_count(chat_id)
 
     def get_bargain_count_by_chat(self, chat_id):
         """
@@ -291,19 +980,284 @@ class ChatContextManager:
         Returns:
             int: 议价次数
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
+        if self.context_cache:
+            cached = self.context_cache.get_bargain_count(chat_id)
+            if cached is not None:
+                return cached
         try:
-            cursor.execute(
-                "SELECT count FROM chat_bargain_counts WHERE chat_id = ?",
-                (chat_id,)
-            )
-            
-            result = cursor.fetchone()
-            return result[0] if result else 0
+            return self._query_bargain_count(chat_id)
         except Exception as e:
             logger.error(f"获取议价次数时出错: {e}")
             return 0
-        finally:
-            conn.close() 
\ No newline at end of file
+
+    def _query_bargain_count(self, chat_id):
+        """从数据库读取议价次数"""
+        result = self._reader().execute(SQL_SELECT_BARGAIN, (chat_id,)).fetchone()
+        return result[0] if result else 0
+
+    def save_summary_by_chat(self, chat_id, summary, last_message_id=0):
+        """
+        保存会话的滚动摘要
+        
+        Args:
+            chat_id: 会话ID
+            summary: 摘要内容
+            last_message_id: 摘要已包含的最后一条消息ID，之后的消息仍原文保留在上下文中
+        """
+        with self._write_lock:
+            conn = self._conn
+            try:
+                now = datetime.now().isoformat()
+                conn.execute(SQL_UPSERT_SUMMARY, (chat_id, summary, last_message_id, now,
+                                                  summary, last_message_id, now))
+                conn.commit()
+                logger.debug(f"会话 {chat_id} 摘要已更新")
+            except Exception as e:
+                logger.error(f"保存会话摘要时出错: {e}")
+                conn.rollback()
+                return
+        # 缓存的窗口中含有已摘要的消息，下次读取时重新加载
+        if self.context_cache:
+            self.context_cache.evict(chat_id)
+
+    def get_summary_by_chat(self, chat_id):
+        """
+        获取会话的滚动摘要
+        
+        Args:
+            chat_id: 会话ID
+            
+        Returns:
+            str: 摘要内容，不存在时返回None
+        """
+        try:
+            return self._query_summary(chat_id)[0]
+        except Exception as e:
+            logger.error(f"获取会话摘要时出错: {e}")
+            return None
+
+    def get_unsummarized_messages(self, chat_id):
+        """
+        获取更新摘要所需的输入：已有摘要和摘要之后的消息
+        
+        写缓冲中的消息会先落库，以便用消息ID标记摘要的进度
+        
+        Args:
+            chat_id: 会话ID
+            
+        Returns:
+            tuple: (已有摘要, 摘要之后的消息列表, 最后一条消息ID)，没有新消息时列表为空
+        """
+        if self.write_behind:
+            self.flush()
+        summary, last_message_id = self._query_summary(chat_id)
+        rows = self._reader().execute(SQL_SELECT_CONTEXT, (chat_id, last_message_id, self.max_history)).fetchall()
+        rows.reverse()
+        messages = [{"role": role, "content": content} for _, role, content in rows]
+        return summary, messages, rows[-1][0] if rows else last_message_id
+
+    def _query_summary(self, chat_id):
+        """从数据库读取会话摘要及其包含的最后一条消息ID"""
+        result = self._reader().execute(SQL_SELECT_SUMMARY, (chat_id,)).fetchone()
+        return (result[0], result[1]) if result else (None, 0)
+
+    def add_llm_usage(self, record):
+        """
+        记录一次大模型调用的用量，写缓冲模式下随消息批量落库，调用开销很小
+        
+        Args:
+            record: 包含 LLM_USAGE_FIELDS 中字段的字典，timestamp 为空时使用当前时间
+        """
+        record = dict(record)
+        record.setdefault('timestamp', datetime.now().isoformat())
+        if self.write_behind:
+            self._usage_pending.append(record)
+            return
+        
+        with self._write_lock:
+            try:
+                self._conn.execute(SQL_INSERT_LLM_USAGE, tuple(record.get(field) for field in LLM_USAGE_FIELDS))
+                self._conn.commit()
+            except Exception as e:
+                logger.error(f"记录大模型用量时出错: {e}")
+                self._conn.rollback()
+
+    def get_llm_usage_report(self, group_by, since=None, limit=20):
+        """
+        按维度汇总大模型用量
+        
+        Args:
+            group_by: 汇总维度（chat_id/item_id/intent/model）
+            since: 起始时间（ISO格式），为空时统计全部
+            limit: 返回的最大条数
+            
+        Returns:
+            list: 按费用降序的汇总结果
+        """
+        if group_by not in ("chat_id", "item_id", "intent", "model"):
+            raise ValueError(f"不支持的汇总维度: {group_by}")
+        if self.write_behind:
+            self.flush()
+        
+        rows = self._reader().execute(SQL_LLM_USAGE_REPORT.format(group_by=group_by), (since or "", limit)).fetchall()
+        return [
+            {
+                'key': key,
+                'calls': calls,
+                'prompt_tokens': prompt_tokens or 0,
+                'cached_tokens': cached_tokens or 0,
+                'completion_tokens': completion_tokens or 0,
+                'avg_latency_ms': avg_latency or 0.0,
+                'cost': cost or 0.0,
+            }
+            for key, calls, prompt_tokens, cached_tokens, completion_tokens, avg_latency, cost in rows
+        ]
+
+    def purge_llm_usage(self, retention_days):
+        """
+        删除超过保留天数的用量记录
+        
+        Returns:
+            int: 删除的记录数
+        """
+        cutoff = (datetime.now() - timedelta(days=retention_days)).isoformat()
+        with self._write_lock:
+            try:
+                deleted = self._conn.execute(SQL_DELETE_OLD_LLM_USAGE, (cutoff,)).rowcount
+                self._conn.commit()
+                return deleted
+            except Exception as e:
+                logger.error(f"清理大模型用量记录时出错: {e}")
+                self._conn.rollback()
+                return 0
+
+    def get_intent_samples(self):
+        """
+        获取本地意图模型的训练样本
+
+        每条带意图的助手回复与其之前连续的买家消息组成一条样本
+        （防抖合并时多条买家消息按换行拼接，与生成回复时的输入一致）。
+        本地模型自己预测的意图和回复缓存的重复标注不作为样本。
+
+        Returns:
+            list: (买家消息, 意图) 列表
+        """
+        if self.write_behind:
+            self.flush()
+
+        samples = []
+        try:
+            current_chat = None
+            user_contents = []
+            for chat_id, role, content, intent, source in self._reader().execute(SQL_SELECT_LABELED_ROWS):
+                if chat_id != current_chat:
+                    current_chat = chat_id
+                    user_contents = []
+                if role == 'user':
+                    user_contents.append(content)
+                    continue
+                if intent and user_contents and source not in UNTRAINABLE_INTENT_SOURCES:
+                    samples.append(("\n".join(user_contents), intent))
+                user_contents = []
+        except Exception as e:
+            logger.error(f"读取意图训练样本时出错: {e}")
+        return samples
+
+
+class AsyncChatContextManager:
+    """
+    异步聊天上下文管理器
+    
+    对 ChatContextManager 的异步封装，方法名与同步版本保持一致。
+    写操作提交到专用的单个写线程中按顺序执行，读操作在独立的读线程池中执行
+    （WAL模式下读不会等待写），事件循环不会因磁盘I/O而阻塞。
+    """
+
+    def __init__(self, max_history=100, db_path="data/chat_history.db", read_workers=4, manager=None):
+        """
+        初始化异步聊天上下文管理器
+        
+        Args:
+            max_history: 每个对话保留的最大消息数
+            db_path: SQLite数据库文件路径
+            read_workers: 读线程数
+            manager: 已有的同步管理器实例，为空时自动创建
+        """
+        self.manager = manager or ChatContextManager(max_history=max_history, db_path=db_path)
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ctx-writer")
+        self._readers = ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix="ctx-reader")
+
+    async def _write(self, func, *args):
+        """在写线程中执行写操作"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, func, *args)
+
+    async def _read(self, func, *args):
+        """在读线程池中执行读操作"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, func, *args)
+
+    async def save_item_info(self, item_id, item_data):
+        """保存商品信息到数据库"""
+        return await self._write(self.manager.save_item_info, item_id, item_data)
+
+    async def get_item_info(self, item_id, max_age=None):
+        """从数据库获取商品信息"""
+        return await self._read(self.manager.get_item_info, item_id, max_age)
+
+    async def add_message_by_chat(self, chat_id, user_id, item_id, role, content, intent=None, intent_source=None):
+        """基于会话ID添加新消息到对话历史"""
+        return await self._write(self.manager.add_message_by_chat, chat_id, user_id, item_id, role, content,
+                                 intent, intent_source)
+
+    async def get_context_by_chat(self, chat_id):
+        """基于会话ID获取对话历史"""
+        return await self._read(self.manager.get_context_by_chat, chat_id)
+
+    async def increment_bargain_count_by_chat(self, chat_id):
+        """基于会话ID增加议价次数"""
+        return await self._write(self.manager.increment_bargain_count_by_chat, chat_id)
+
+    async def get_bargain_count_by_chat(self, chat_id):
+        """基于会话ID获取议价次数"""
+        return await self._read(self.manager.get_bargain_count_by_chat, chat_id)
+
+    async def save_summary_by_chat(self, chat_id, summary, last_message_id=0):
+        """保存会话的滚动摘要"""
+        return await self._write(self.manager.save_summary_by_chat, chat_id, summary, last_message_id)
+
+    async def get_summary_by_chat(self, chat_id):
+        """获取会话的滚动摘要"""
+        return await self._read(self.manager.get_summary_by_chat, chat_id)
+
+    async def get_unsummarized_messages(self, chat_id):
+        """获取已有摘要和摘要之后的消息，用于增量更新摘要"""
+        return await self._read(self.manager.get_unsummarized_messages, chat_id)
+
+    def add_llm_usage(self, record):
+        """记录一次大模型调用的用量（只追加到内存缓冲，可在事件循环中直接调用）"""
+        if self.manager.write_behind:
+            self.manager.add_llm_usage(record)
+        else:
+            self._writer.submit(self.manager.add_llm_usage, record)
+
+    async def purge_llm_usage(self, retention_days):
+        """删除超过保留天数的用量记录"""
+        return await self._write(self.manager.purge_llm_usage, retention_days)
+
+    async def get_intent_samples(self):
+        """获取本地意图模型的训练样本，在后台线程中执行"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.manager.get_intent_samples)
+
+    async def archive_idle_chats(self, idle_days=30, archive_dir=None, batch_size=200):
+        """归档长期不活跃的会话，在后台线程中执行"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.manager.archive_idle_chats, idle_days, archive_dir, batch_size)
+
+    async def close(self):
+        """等待未完成的写操作后关闭数据库连接"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._writer.shutdown, True)
+        await loop.run_in_executor(None, self._readers.shutdown, True)
+        self.manager.close()
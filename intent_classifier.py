@@ -0,0 +1,226 @@
+import re
+import os
+import sys
+import json
+import math
+import argparse
+from collections import Counter
+from loguru import logger
+from dotenv import load_dotenv
+
+
+class IntentClassifier:
+    """
+    本地意图分类器
+
+    基于字符n-gram的多项式朴素贝叶斯模型，纯Python实现、只使用CPU。
+    训练数据来自消息表中已标注意图的回复及其对应的买家消息，
+    规则未命中时先用本模型判断，置信度足够高时无需再调用大模型分类。
+    """
+
+    def __init__(self, ngram_range=(1, 3), alpha=1.0):
+        """
+        初始化分类器
+
+        Args:
+            ngram_range: 字符n-gram的长度范围（含两端）
+            alpha: 拉普拉斯平滑系数
+        """
+        self.ngram_range = tuple(ngram_range)
+        self.alpha = alpha
+        self.class_counts = {}    # 意图 -> 样本数
+        self.feature_counts = {}  # 意图 -> {n-gram: 出现次数}
+        self._log_priors = {}
+        self._log_probs = {}      # 意图 -> {n-gram: 对数条件概率}
+        self._log_unseen = {}     # 意图 -> 该意图下未出现过的n-gram的对数概率
+        self._vocabulary = set()
+
+    @property
+    def labels(self):
+        """模型中的全部意图"""
+        return list(self.class_counts)
+
+    def _features(self, text):
+        """清洗文本并提取字符n-gram"""
+        text = re.sub(r'[^\w\u4e00-\u9fa5]', '', text.lower())
+        low, high = self.ngram_range
+        features = []
+        for n in range(low, high + 1):
+            features.extend(text[i:i + n] for i in range(len(text) - n + 1))
+        return features
+
+    def fit(self, samples):
+        """
+        训练模型
+
+        Args:
+            samples: (消息文本, 意图) 的可迭代对象
+
+        Returns:
+            IntentClassifier: 训练后的分类器本身
+        """
+        self.class_counts = {}
+        self.feature_counts = {}
+        for text, label in samples:
+            features = self._features(text)
+            if not features:
+                continue
+            self.class_counts[label] = self.class_counts.get(label, 0) + 1
+            self.feature_counts.setdefault(label, Counter()).update(features)
+        self._compile()
+        return self
+
+    def _compile(self):
+        """根据计数预计算先验和条件概率的对数值"""
+        total_docs = sum(self.class_counts.values())
+        vocabulary = set()
+        for counts in self.feature_counts.values():
+            vocabulary.update(counts)
+        vocab_size = len(vocabulary) or 1
+
+        self._log_priors = {}
+        self._log_probs = {}
+        self._log_unseen = {}
+        for label, doc_count in self.class_counts.items():
+            counts = self.feature_counts.get(label, {})
+            denominator = math.log(sum(counts.values()) + self.alpha * vocab_size)
+            self._log_priors[label] = math.log(doc_count / total_docs)
+            self._log_probs[label] = {
+                feature: math.log(count + self.alpha) - denominator for feature, count in counts.items()
+            }
+            self._log_unseen[label] = math.log(self.alpha) - denominator
+        self._vocabulary = vocabulary
+
+    def predict_proba(self, text):
+        """
+        计算各意图的后验概率
+
+        Args:
+            text: 消息文本
+
+        Returns:
+            dict: 意图 -> 概率，模型未训练或文本无有效字符时返回空字典
+        """
+        if not self._log_priors:
+            return {}
+        # 词表外的n-gram对各意图贡献相同，直接忽略
+        features = [f for f in self._features(text) if f in self._vocabulary]
+        if not features:
+            return {}
+
+        scores = {}
+        for label, log_prior in self._log_priors.items():
+            log_probs = self._log_probs[label]
+            unseen = self._log_unseen[label]
+            scores[label] = log_prior + sum(log_probs.get(f, unseen) for f in features)
+
+        # softmax归一化，减去最大值避免下溢
+        best = max(scores.values())
+        exp_scores = {label: math.exp(score - best) for label, score in scores.items()}
+        total = sum(exp_scores.values())
+        return {label: value / total for label, value in exp_scores.items()}
+
+    def predict(self, text):
+        """
+        预测意图
+
+        Args:
+            text: 消息文本
+
+        Returns:
+            tuple: (意图, 置信度)，无法判断时返回 (None, 0.0)
+        """
+        proba = self.predict_proba(text)
+        if not proba:
+            return None, 0.0
+        label = max(proba, key=proba.get)
+        return label, proba[label]
+
+    def save(self, path):
+        """保存模型到JSON文件（先写临时文件再替换，避免运行中读到半个文件）"""
+        model_dir = os.path.dirname(path)
+        if model_dir and not os.path.exists(model_dir):
+            os.makedirs(model_dir)
+        data = {
+            'ngram_range': list(self.ngram_range),
+            'alpha': self.alpha,
+            'class_counts': self.class_counts,
+            'feature_counts': {label: dict(counts) for label, counts in self.feature_counts.items()},
+        }
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        从JSON文件加载模型
+
+        Args:
+            path: 模型文件路径
+
+        Returns:
+            IntentClassifier: 加载的分类器
+        """
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        classifier = cls(ngram_range=data['ngram_range'], alpha=data['alpha'])
+        classifier.class_counts = data['class_counts']
+        classifier.feature_counts = {label: Counter(counts) for label, counts in data['feature_counts'].items()}
+        classifier._compile()
+        return classifier
+
+
+def train_from_db(db_path, model_path, min_samples=50):
+    """
+    用消息表中已标注意图的对话训练本地意图模型
+
+    Args:
+        db_path: 聊天历史数据库路径
+        model_path: 模型保存路径
+        min_samples: 最少训练样本数，不足时不生成模型
+
+    Returns:
+        IntentClassifier: 训练好的分类器，样本不足时返回None
+    """
+    from context_manager import ChatContextManager
+
+    manager = ChatContextManager(db_path=db_path, read_only=True)
+    try:
+        samples = manager.get_intent_samples()
+    finally:
+        manager.close()
+
+    if len(samples) < min_samples:
+        logger.warning(f"已标注样本只有 {len(samples)} 条，少于 {min_samples} 条，暂不训练本地意图模型")
+        return None
+
+    classifier = IntentClassifier().fit(samples)
+    classifier.save(model_path)
+    distribution = ", ".join(f"{label}: {count}" for label, count in classifier.class_counts.items())
+    logger.info(f"本地意图模型训练完成，共 {len(samples)} 条样本（{distribution}），已保存到 {model_path}")
+    return classifier
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="本地意图模型")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    train_parser = subparsers.add_parser("train", help="从聊天历史数据库训练模型")
+    train_parser.add_argument("--db", default="data/chat_history.db", help="聊天历史数据库路径")
+    train_parser.add_argument("--model", default=os.getenv("INTENT_MODEL_PATH", "data/intent_model.json"), help="模型保存路径")
+    train_parser.add_argument("--min-samples", type=int, default=50, help="最少训练样本数")
+
+    predict_parser = subparsers.add_parser("predict", help="用已训练的模型预测消息意图")
+    predict_parser.add_argument("text", help="消息文本")
+    predict_parser.add_argument("--model", default=os.getenv("INTENT_MODEL_PATH", "data/intent_model.json"), help="模型路径")
+
+    args = parser.parse_args()
+    if args.command == "train":
+        if train_from_db(args.db, args.model, args.min_samples) is None:
+            sys.exit(1)
+    else:
+        intent, confidence = IntentClassifier.load(args.model).predict(args.text)
+        print(f"{intent}\t{confidence:.4f}")
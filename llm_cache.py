@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, Optional
+from loguru import logger
+
+
+class LLMResponseCache:
+    """
+    大模型请求结果缓存
+
+    以模型、消息和采样参数的哈希作为键缓存生成结果，重连后消息重复投递、
+    重试等产生的完全相同的请求直接复用结果，不再消耗token。
+    相同请求并发到达时只发起一次调用，其余请求等待同一个结果；发起调用的一方被取消时，
+    等待者自行重新发起调用，不会随之取消。
+    缓存为有界LRU，可选持久化到JSONL文件，重启后继续生效；
+    文件的追加和压缩在单独的写线程中进行，不阻塞事件循环。
+    """
+
+    def __init__(self, max_entries=512, ttl=600, path=None):
+        """
+        初始化缓存
+
+        Args:
+            max_entries: 最多缓存的结果数
+            ttl: 结果有效期（秒）
+            path: 持久化文件路径，为空时只缓存在内存中
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self._entries = OrderedDict()  # 键 -> (结果, 过期时间戳)
+        self._inflight = {}            # 键 -> 进行中请求的Future
+        self._file = None
+        self._writer = None
+        self._appended = 0
+        self.hits = 0
+        self.misses = 0
+        if path:
+            self._load()
+            self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llm-cache-writer")
+
+    @staticmethod
+    def make_key(params: Dict) -> str:
+        """根据请求参数计算缓存键（不含stream等传输相关参数）"""
+        payload = json.dumps({k: v for k, v in params.items() if k != 'stream'},
+                             ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """查询缓存，未命中或已过期返回None"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        content, expires_at = entry
+        if expires_at <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return content
+
+    def put(self, key: str, content: str):
+        """写入缓存，启用持久化时同时提交到写线程追加到文件，追加过多时压缩"""
+        expires_at = time.time() + self.ttl
+        self._entries[key] = (content, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        if self._writer is None:
+            return
+        self._appended += 1
+        if self._appended > self.max_entries:
+            # 在当前线程取快照，写线程不直接遍历会被修改的缓存
+            self._appended = 0
+            self._writer.submit(self._compact, list(self._entries.items()))
+        else:
+            self._writer.submit(self._append, key, content, expires_at)
+
+    async def run(self, key: str, call: Callable[[], Awaitable[str]],
+                  cacheable: Callable[[str], bool] = lambda content: True) -> str:
+        """
+        带缓存地执行一次大模型调用
+
+        Args:
+            key: 缓存键
+            call: 实际发起调用的协程函数
+            cacheable: 判断结果是否可以缓存（如被中断的流式结果不缓存）
+
+        Returns:
+            str: 生成结果
+        """
+        while True:
+            content = self.get(key)
+            if content is not None:
+                self.hits += 1
+                return content
+            inflight = self._inflight.get(key)
+            if inflight is None:
+                break
+            # asyncio.wait 不会因等待者被取消而取消进行中的请求，只在等待者自身被取消时抛出CancelledError
+            await asyncio.wait({inflight})
+            if not inflight.cancelled():
+                self.hits += 1
+                return inflight.result()
+            # 发起请求的调用方被取消（如丢弃的投机草稿），由等待者重新发起请求
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            content = await call()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # 没有等待者时也要取走异常，避免"Future exception was never retrieved"
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+        if content and cacheable(content):
+            self.put(key, content)
+        future.set_result(content)
+        return content
+
+    def _load(self):
+        """从持久化文件加载未过期的结果，并压缩文件"""
+        now = time.time()
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            continue
+                        if record['expires_at'] > now:
+                            self._entries[record['key']] = (record['content'], record['expires_at'])
+                            self._entries.move_to_end(record['key'])
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                logger.info(f"已加载 {len(self._entries)} 条大模型结果缓存")
+            except Exception as e:
+                logger.error(f"加载大模型结果缓存时出错: {e}")
+                self._entries.clear()
+        self._compact(list(self._entries.items()))
+
+    def _append(self, key: str, content: str, expires_at: float):
+        """追加一条结果到持久化文件（在写线程中执行）"""
+        try:
+            self._file.write(json.dumps({'key': key, 'content': content, 'expires_at': expires_at},
+                                        ensure_ascii=False) + "\n")
+            self._file.flush()
+        except Exception as e:
+            logger.error(f"写入大模型结果缓存文件时出错: {e}")
+
+    def _compact(self, entries):
+        """
+        用有效结果的快照重写持久化文件（启动后在写线程中执行）
+
+        Args:
+            entries: (键, (结果, 过期时间戳)) 列表
+        """
+        try:
+            cache_dir = os.path.dirname(self.path)
+            if cache_dir and not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            if self._file is not None:
+                self._file.close()
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for key, (content, expires_at) in entries:
+                    f.write(json.dumps({'key': key, 'content': content, 'expires_at': expires_at},
+                                       ensure_ascii=False) + "\n")
+            os.replace(tmp_path, self.path)
+            self._file = open(self.path, "a", encoding="utf-8")
+        except Exception as e:
+            logger.error(f"压缩大模型结果缓存文件时出错: {e}")
+
+    def stats(self):
+        """缓存统计信息"""
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+    def close(self):
+        """等待写线程完成后关闭持久化文件"""
+        if self._writer is not None:
+            self._writer.shutdown(wait=True)
+            self._writer = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,257 @@
+import asyncio
+import random
+import time
+from typing import Callable, Dict, Optional, Tuple
+import httpx
+from openai import AsyncOpenAI, APIConnectionError, APIError, APIStatusError, APITimeoutError
+from loguru import logger
+from circuit_breaker import CircuitBreaker
+
+
+class LLMUnavailableError(Exception):
+    """大模型服务不可用（熔断中或主备均请求失败），调用方应快速降级"""
+
+
+class LLMClient:
+    """
+    大模型异步客户端
+
+    所有Agent共用一个连接池（可选HTTP/2），每次请求有独立的超时控制，
+    遇到429、5xx、超时和连接错误时按带抖动的指数退避重试。
+    """
+
+    RETRYABLE_STATUS = {408, 409, 429}
+
+    def __init__(self, api_key: Optional[str], base_url: str, timeout: float = 30.0, connect_timeout: float = 5.0,
+                 max_connections: int = 20, max_keepalive_connections: int = 10, keepalive_expiry: float = 30.0,
+                 max_retries: int = 3, backoff_base: float = 0.5, backoff_max: float = 8.0, http2: bool = True):
+        """
+        初始化客户端
+
+        Args:
+            api_key: 模型平台API Key
+            base_url: 模型接口地址
+            timeout: 单次请求超时（秒）
+            connect_timeout: 建立连接超时（秒）
+            max_connections: 连接池最大连接数
+            max_keepalive_connections: 最多保持的空闲长连接数
+            keepalive_expiry: 空闲长连接保持时间（秒）
+            max_retries: 最大重试次数
+            backoff_base: 退避基础时间（秒）
+            backoff_max: 单次退避上限（秒）
+            http2: 是否启用HTTP/2（需要安装h2）
+        """
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("未安装h2，大模型客户端使用HTTP/1.1")
+                http2 = False
+
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.http_client = httpx.AsyncClient(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+        )
+        # 重试由本类统一处理，关闭SDK内置重试
+        self.client = AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            http_client=self.http_client,
+            max_retries=0,
+        )
+
+    async def create(self, **params):
+        """
+        调用 chat.completions.create，失败时按策略重试
+
+        流式请求只在建立连接、收到响应头之前重试，已开始返回内容的流不会重试。
+        """
+        response, _ = await self.request(params)
+        return response
+
+    async def request(self, params: Dict,
+                      on_failure: Optional[Callable[[Exception, float], bool]] = None) -> Tuple[object, float]:
+        """
+        调用 chat.completions.create，失败时按策略重试
+
+        Args:
+            params: 请求参数
+            on_failure: 每次可重试的失败后调用，参数为错误和本次耗时（秒），返回False时不再重试
+
+        Returns:
+            tuple: (响应, 成功的那次尝试的开始时间)，耗时统计不包含之前失败的尝试和退避等待
+        """
+        attempt = 0
+        while True:
+            started_at = time.monotonic()
+            try:
+                return await self.client.chat.completions.create(**params), started_at
+            except (APITimeoutError, APIConnectionError, APIStatusError) as e:
+                if not self._is_retryable(e):
+                    raise
+                keep_retrying = on_failure(e, time.monotonic() - started_at) if on_failure else True
+                if attempt >= self.max_retries or not keep_retrying:
+                    raise
+                delay = self._backoff(attempt, e)
+                attempt += 1
+                logger.warning(f"大模型请求失败({e.__class__.__name__})，{delay:.2f}秒后第{attempt}次重试")
+                await asyncio.sleep(delay)
+
+    def _is_retryable(self, error: Exception) -> bool:
+        """判断错误是否可重试"""
+        if isinstance(error, APIStatusError):
+            return error.status_code in self.RETRYABLE_STATUS or error.status_code >= 500
+        return True
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        """计算退避时间：优先使用服务端的Retry-After，否则使用全抖动指数退避"""
+        if isinstance(error, APIStatusError):
+            retry_after = error.response.headers.get("retry-after")
+            if retry_after:
+                try:
+                    return min(float(retry_after), self.backoff_max)
+                except ValueError:
+                    pass
+        cap = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        return random.uniform(cap / 2, cap)
+
+    async def close(self):
+        """关闭连接池"""
+        await self.client.close()
+
+
+class MonitoredStream:
+    """
+    流式响应包装
+
+    读取中途的超时、断连和服务端错误转为 LLMUnavailableError；流读完或提前关闭时
+    向熔断器记录成功（耗时为整个生成过程），中途出错时记录失败。
+    """
+
+    def __init__(self, stream, breaker: Optional[CircuitBreaker] = None, started_at: Optional[float] = None):
+        """
+        Args:
+            stream: SDK返回的流式响应
+            breaker: 需要记录结果的熔断器，为空时只转换错误（备用服务）
+            started_at: 请求开始时间（time.monotonic）
+        """
+        self._stream = stream
+        self._breaker = breaker
+        self._started_at = started_at if started_at is not None else time.monotonic()
+        self._finished = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self._stream.__anext__()
+        except StopAsyncIteration:
+            self._finish(True)
+            raise
+        except (APIError, httpx.TransportError) as e:
+            self._finish(False)
+            raise LLMUnavailableError(f"大模型流式响应中断: {e}") from e
+
+    def _finish(self, success: bool):
+        """记录一次调用结果（只记录一次）"""
+        if self._finished or self._breaker is None:
+            self._finished = True
+            return
+        self._finished = True
+        latency = time.monotonic() - self._started_at
+        if success:
+            self._breaker.record_success(latency)
+        else:
+            self._breaker.record_failure(latency)
+
+    async def close(self):
+        """关闭流，未读完时（如安全检查提前终止）按成功记录"""
+        self._finish(True)
+        await self._stream.close()
+
+
+class FailoverLLMClient:
+    """
+    带熔断和故障转移的大模型客户端
+
+    主客户端前置熔断器：超时、连接错误、429/5xx计为失败，错误率或P95耗时超标时熔断，
+    熔断期间不再请求主服务。每次重试失败都会记录，熔断器不再闭合时停止重试，
+    直接改用备用模型/备用服务；流式响应读取中途出错同样计为失败。
+    未配置备用或备用也失败时抛出 LLMUnavailableError，由调用方返回兜底回复。
+    参数错误等不可重试的错误与服务健康无关，原样抛出。
+    """
+
+    def __init__(self, primary: LLMClient, breaker: CircuitBreaker, fallback: Optional[LLMClient] = None,
+                 fallback_model: Optional[str] = None):
+        """
+        初始化客户端
+
+        Args:
+            primary: 主客户端
+            breaker: 主客户端的熔断器
+            fallback: 备用服务的客户端，为空时备用模型使用主客户端请求
+            fallback_model: 备用模型名称，为空时使用原模型
+        """
+        self.primary = primary
+        self.breaker = breaker
+        self.fallback = fallback
+        self.fallback_model = fallback_model
+        self.fallback_calls = 0
+
+    @property
+    def has_fallback(self) -> bool:
+        """是否配置了备用模型或备用服务"""
+        return self.fallback is not None or bool(self.fallback_model)
+
+    async def create(self, **params):
+        """调用 chat.completions.create，主服务不可用时转移到备用"""
+        error = None
+        if self.breaker.allow():
+            try:
+                response, started_at = await self.primary.request(params, on_failure=self._on_primary_failure)
+            except (APITimeoutError, APIConnectionError, APIStatusError) as e:
+                if not self.primary._is_retryable(e):
+                    raise
+                error = e
+            else:
+                if params.get('stream'):
+                    return MonitoredStream(response, self.breaker, started_at)
+                self.breaker.record_success(time.monotonic() - started_at)
+                return response
+
+        if not self.has_fallback:
+            raise LLMUnavailableError("大模型服务不可用" + ("（熔断中）" if error is None else f": {error}")) from error
+
+        self.fallback_calls += 1
+        client = self.fallback or self.primary
+        fallback_params = dict(params, model=self.fallback_model) if self.fallback_model else params
+        logger.warning(f"主模型服务不可用，改用备用模型 {fallback_params['model']}")
+        try:
+            response = await client.create(**fallback_params)
+        except (APITimeoutError, APIConnectionError, APIStatusError) as e:
+            raise LLMUnavailableError(f"主备大模型服务均不可用: {e}") from e
+        return MonitoredStream(response) if params.get('stream') else response
+
+    def _on_primary_failure(self, error: Exception, latency: float) -> bool:
+        """主服务每次失败都计入熔断器，熔断器不再闭合（已熔断或正在探测）时不再重试"""
+        self.breaker.record_failure(latency)
+        return self.breaker.state == CircuitBreaker.CLOSED
+
+    def stats(self):
+        """熔断器状态和故障转移次数"""
+        return dict(self.breaker.stats(), fallback_calls=self.fallback_calls)
+
+    async def close(self):
+        """关闭主备连接池"""
+        await self.primary.close()
+        if self.fallback is not None:
+            await self.fallback.close()
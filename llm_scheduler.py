@@ -0,0 +1,238 @@
+import time
+import heapq
+import asyncio
+import itertools
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional, Tuple
+from loguru import logger
+
+
+class LLMQueueExpiredError(Exception):
+    """消息在轮到调用配额之前就会过期，已提前丢弃"""
+
+
+# 默认调度优先级，数值越小越优先：议价最先，意图分类和普通回复其次，后台摘要最后
+DEFAULT_PRIORITIES = {'price': 0, 'classify': 1, 'tech': 1, 'default': 1, 'summary': 2}
+
+# 当前大模型调用所属消息的(创建时间, 过期时间)，Unix时间戳（秒），随asyncio任务传递
+_message_window: ContextVar[Optional[Tuple[float, float]]] = ContextVar('llm_message_window', default=None)
+
+
+@contextmanager
+def message_deadline(created_at: float, expires_at: float):
+    """
+    在代码块内为大模型调用标注所属消息的时间
+
+    调度器按消息创建时间排队，预计到过期时间仍轮不到的请求提前丢弃。
+
+    用法::
+
+        with message_deadline(create_time / 1000, (create_time + expire_ms) / 1000):
+            await bot.generate_reply_with_intent(...)
+    """
+    token = _message_window.set((created_at, expires_at))
+    try:
+        yield
+    finally:
+        _message_window.reset(token)
+
+
+class TokenBucket:
+    """令牌桶：按每分钟速率匀速补充，最多积攒 burst_seconds 秒的补充量"""
+
+    def __init__(self, per_minute: float, burst_seconds: float = 5.0):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def refill(self, now: float):
+        """按经过的时间补充令牌"""
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """令牌积攒到amount还需的时间（秒），调用前需先refill"""
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+
+class LLMScheduler:
+    """
+    大模型调用调度器
+
+    用两个令牌桶分别限制每分钟请求数（RPM）和估算的每分钟token数（TPM），
+    重连后积压消息集中到达时排队发出，避免触发429。排队请求按优先级（议价最先）、
+    再按消息创建时间先后放行；每次调度时预估各请求的放行时间，
+    到消息过期时间仍轮不到的请求直接丢弃，不再占用配额。
+    请求按估算的token预扣，响应返回实际用量后再修正。
+    """
+
+    def __init__(self, rpm: int = 0, tpm: int = 0, burst_seconds: float = 5.0):
+        """
+        初始化调度器
+
+        Args:
+            rpm: 每分钟请求数上限，为0时不限制
+            tpm: 每分钟token数上限，为0时不限制
+            burst_seconds: 空闲后允许瞬时发出的配额（秒数），越小请求越平滑
+        """
+        self.requests = TokenBucket(rpm, burst_seconds) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm, burst_seconds) if tpm > 0 else None
+        self._queue = []  # 堆：(优先级, 消息创建时间, 序号, 等待项)
+        self._seq = itertools.count()
+        self._timer = None
+        self.granted = 0
+        self.queued = 0
+        self.dropped = 0
+        self.total_wait = 0.0
+
+    @property
+    def backlog(self) -> int:
+        """排队中的请求数"""
+        return sum(1 for entry in self._queue if not entry[-1]['future'].done())
+
+    async def acquire(self, intent: str, estimated_tokens: int, priority: Optional[int] = None):
+        """
+        等待调用配额
+
+        Args:
+            intent: 发起调用的Agent名称，用于确定默认优先级和统计
+            estimated_tokens: 估算的本次调用token数（提示词+最大输出）
+            priority: 优先级，为空时按 DEFAULT_PRIORITIES 取值
+
+        Raises:
+            LLMQueueExpiredError: 所属消息在轮到之前就会过期
+        """
+        now = time.time()
+        created_at, deadline = _message_window.get() or (now, None)
+        waiter = {
+            'intent': intent,
+            'tokens': estimated_tokens,
+            'deadline': deadline,
+            'enqueued_at': now,
+            'future': None,
+        }
+        # 没有排队且配额充足时直接放行
+        if not self._queue:
+            self._refill()
+            if self._wait_time(1, self._token_cost(estimated_tokens)) <= 0:
+                self._grant(waiter)
+                return
+
+        if priority is None:
+            priority = DEFAULT_PRIORITIES.get(intent, 1)
+        waiter['future'] = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, created_at, next(self._seq), waiter))
+        self.queued += 1
+        self._dispatch()
+        try:
+            await waiter['future']
+        except asyncio.CancelledError:
+            # 取消的请求从队列中移除，后面的请求不必等它
+            self._dispatch()
+            raise
+
+    def settle(self, estimated_tokens: int, actual_tokens: int):
+        """按实际token用量修正预扣的配额"""
+        if self.tokens is None:
+            return
+        self._refill()
+        self.tokens.tokens = min(self.tokens.capacity, self.tokens.tokens - (actual_tokens - estimated_tokens))
+        if actual_tokens < estimated_tokens and self._queue:
+            self._dispatch()
+
+    def _refill(self):
+        """补充两个令牌桶"""
+        now = time.monotonic()
+        for bucket in (self.requests, self.tokens):
+            if bucket is not None:
+                bucket.refill(now)
+
+    def _token_cost(self, estimated_tokens: int) -> float:
+        """排队时占用的token配额，超过令牌桶容量的请求按容量计算，避免永远轮不到"""
+        if self.tokens is None:
+            return 0
+        return min(estimated_tokens, self.tokens.capacity)
+
+    def _wait_time(self, requests: int, tokens: float) -> float:
+        """两个令牌桶分别积攒到指定数量还需的时间，取较大值"""
+        wait = 0.0
+        if self.requests is not None:
+            wait = self.requests.wait_time(requests)
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.wait_time(tokens))
+        return wait
+
+    def _grant(self, waiter: Dict):
+        """扣除配额并放行"""
+        if self.requests is not None:
+            self.requests.tokens -= 1
+        if self.tokens is not None:
+            self.tokens.tokens -= waiter['tokens']
+        self.granted += 1
+        self.total_wait += time.time() - waiter['enqueued_at']
+        if waiter['future'] is not None:
+            waiter['future'].set_result(None)
+
+    def _dispatch(self):
+        """按顺序放行配额足够的请求，丢弃预计过期的请求，并安排下一次调度"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._refill()
+        self._drop_expired()
+
+        while self._queue:
+            waiter = self._queue[0][-1]
+            if waiter['future'].done():
+                heapq.heappop(self._queue)
+                continue
+            if self._wait_time(1, self._token_cost(waiter['tokens'])) > 0:
+                break
+            heapq.heappop(self._queue)
+            self._grant(waiter)
+
+        if self._queue:
+            delay = self._wait_time(1, self._token_cost(self._queue[0][-1]['tokens']))
+            self._timer = asyncio.get_running_loop().call_later(max(delay, 0.01), self._dispatch)
+
+    def _drop_expired(self):
+        """按队列顺序累计配额预估每个请求的放行时间，过期前轮不到的请求提前丢弃"""
+        now = time.time()
+        kept = []
+        requests = tokens = 0
+        for entry in sorted(self._queue):
+            waiter = entry[-1]
+            if waiter['future'].done():
+                continue
+            cost = self._token_cost(waiter['tokens'])
+            eta = self._wait_time(requests + 1, tokens + cost)
+            if waiter['deadline'] is not None and now + eta > waiter['deadline']:
+                self.dropped += 1
+                logger.warning(f"{waiter['intent']} 请求预计 {eta:.1f}s 后才能发出，所属消息届时已过期，提前丢弃")
+                waiter['future'].set_exception(LLMQueueExpiredError(f"等待调用配额约 {eta:.1f}s，消息将过期"))
+                continue
+            requests += 1
+            tokens += cost
+            kept.append(entry)
+        # 有序列表本身满足堆的性质
+        self._queue = kept
+
+    def stats(self) -> Dict:
+        """队列状态：排队数（按意图）、最长等待时间、剩余配额、放行和丢弃次数"""
+        self._refill()
+        now = time.time()
+        waiting = [entry[-1] for entry in self._queue if not entry[-1]['future'].done()]
+        return {
+            'queued': len(waiting),
+            'queued_by_intent': dict(Counter(waiter['intent'] for waiter in waiting)),
+            'oldest_wait': max((now - waiter['enqueued_at'] for waiter in waiting), default=0.0),
+            'available_requests': self.requests.tokens if self.requests is not None else None,
+            'available_tokens': self.tokens.tokens if self.tokens is not None else None,
+            'granted': self.granted,
+            'total_queued': self.queued,
+            'dropped': self.dropped,
+            'avg_wait': self.total_wait / self.granted if self.granted else 0.0,
+        }
@@ -0,0 +1,62 @@
+import argparse
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from typing import Dict
+from dotenv import load_dotenv
+
+
+# 当前大模型调用的归属信息（会话ID、商品ID），随asyncio任务传递，由Agent记录用量时读取
+_usage_scope: ContextVar[Dict] = ContextVar('llm_usage_scope', default={})
+
+
+@contextmanager
+def usage_scope(**attrs):
+    """
+    在代码块内为大模型调用标注归属，嵌套时与外层合并
+
+    用法::
+
+        with usage_scope(chat_id=chat_id, item_id=item_id):
+            await bot.generate_reply_with_intent(...)
+    """
+    token = _usage_scope.set({**_usage_scope.get(), **attrs})
+    try:
+        yield
+    finally:
+        _usage_scope.reset(token)
+
+
+def current_scope() -> Dict:
+    """当前调用的归属信息"""
+    return _usage_scope.get()
+
+
+def print_report(db_path, group_by, days, limit):
+    """打印按会话、商品、意图或模型汇总的用量报表"""
+    from context_manager import ChatContextManager
+
+    since = (datetime.now() - timedelta(days=days)).isoformat() if days else None
+    manager = ChatContextManager(db_path=db_path, read_only=True)
+    try:
+        rows = manager.get_llm_usage_report(group_by, since=since, limit=limit)
+    finally:
+        manager.close()
+
+    title = f"最近{days}天" if days else "全部"
+    print(f"{title}按 {group_by} 汇总的大模型用量（按费用降序，前{limit}条）")
+    print(f"{group_by:<36} {'调用':>6} {'输入token':>10} {'缓存token':>10} {'输出token':>10} {'平均耗时ms':>10} {'费用(元)':>10}")
+    for row in rows:
+        print(f"{str(row['key']):<36} {row['calls']:>6} {row['prompt_tokens']:>10} {row['cached_tokens']:>10} "
+              f"{row['completion_tokens']:>10} {row['avg_latency_ms']:>10.0f} {row['cost']:>10.4f}")
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="大模型token用量报表")
+    parser.add_argument("--db", default="data/chat_history.db", help="聊天历史数据库路径")
+    parser.add_argument("--by", default="chat_id", choices=["chat_id", "item_id", "intent", "model"], help="汇总维度")
+    parser.add_argument("--days", type=int, default=7, help="统计最近多少天，0为全部")
+    parser.add_argument("--top", type=int, default=20, help="显示前多少条")
+    args = parser.parse_args()
+    print_report(args.db, args.by, args.days, args.top)
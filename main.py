@@ -3,6 +3,8 @@ import json
 import asyncio
 import time
 import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import websockets
 from loguru import logger
 from dotenv import load_dotenv
@@ -12,7 +14,12 @@ import sys
 
 from utils.xianyu_utils import generate_mid, generate_uuid, trans_cookies, generate_device_id, decrypt
 from XianyuAgent import XianyuReplyBot
-from context_manager import ChatContextManager
+from llm_client import LLMUnavailableError
+from context_manager import AsyncChatContextManager
+from reply_dispatcher import ChatDispatcher
+from reply_cache import ReplyCache
+from llm_usage import usage_scope
+from llm_scheduler import LLMQueueExpiredError, message_deadline
 
 
 class XianyuLive:
@@ -24,7 +31,8 @@ class XianyuLive:
         self.xianyu.session.cookies.update(self.cookies)  # 直接使用 session.cookies.update
         self.myid = self.cookies['unb']
         self.device_id = generate_device_id(self.myid)
-        self.context_manager = ChatContextManager()
+        self.context_manager = AsyncChatContextManager()  # 数据库读写均在后台线程执行，不阻塞事件循环
+        bot.usage_sinks.append(self.context_manager.add_llm_usage)  # 大模型用量按会话、商品、意图记录到数据库
         
         # 心跳相关配置
         self.heartbeat_interval = int(os.getenv("HEARTBEAT_INTERVAL", "15"))  # 心跳间隔，默认15秒
@@ -50,8 +58,60 @@ class XianyuLive:
         # 消息过期时间配置
         self.message_expire_time = int(os.getenv("MESSAGE_EXPIRE_TIME", "300000"))  # 消息过期时间，默认5分钟
         
+        # 流式回复：首个完整句子生成后立即发送，其余内容生成完毕后再发送
+        self.stream_reply = os.getenv("STREAM_REPLY", "false").lower() == "true"
+        
+        # 滚动摘要配置：每隔N轮对话在后台更新一次会话摘要，控制提示词长度
+        self.summary_every_turns = int(os.getenv("SUMMARY_EVERY_TURNS", "6"))  # 摘要更新间隔轮数，默认6，0为关闭
+        self.summary_tasks = {}        # chat_id -> 正在进行的摘要任务
+        
+        # 历史归档配置：定期将长期不活跃的会话归档到压缩文件，保持热数据库体积
+        self.archive_idle_days = int(os.getenv("ARCHIVE_IDLE_DAYS", "30"))  # 不活跃天数阈值，默认30天
+        self.archive_interval = int(os.getenv("ARCHIVE_INTERVAL", "21600"))  # 归档检查间隔，默认6小时，0为关闭
+        self.archive_task = None
+        self.usage_retention_days = int(os.getenv("LLM_USAGE_RETENTION_DAYS", "90"))  # 大模型用量记录保留天数，默认90天，0为不清理
+        
+        # 运行指标：定期将会话调度等指标输出到日志
+        self.metrics_log_interval = int(os.getenv("METRICS_LOG_INTERVAL", "300"))  # 指标日志间隔，默认5分钟，0为关闭
+        self.metrics_task = None
+        
+        # 商品信息定期从接口刷新，价格或描述变化时清空该商品的回复缓存
+        self.item_info_ttl = int(os.getenv("ITEM_INFO_TTL", "3600"))  # 商品信息刷新间隔，默认1小时，0为不刷新
+        
+        # 常见问题回复缓存：同一商品下相同的问题直接复用回复，议价意图不缓存
+        self.reply_cache_enabled = os.getenv("REPLY_CACHE", "true").lower() == "true"
+        self.reply_cache = ReplyCache(
+            ttl=int(os.getenv("REPLY_CACHE_TTL", "3600")),  # 缓存有效期，默认1小时
+            excluded_intents=[i.strip() for i in os.getenv("REPLY_CACHE_EXCLUDE", "price").split(",") if i.strip()],  # 不缓存的意图
+        )
+        
+        # 大模型服务不可用（熔断或主备均失败）时发送的兜底回复，为空时不回复；
+        # 不会有后续自动回复，默认文案请买家稍后重发而不是承诺马上回复
+        self.fallback_reply = os.getenv("FALLBACK_REPLY", "不好意思，刚才没能及时回复，麻烦您稍后再发一次~")
+        
         # 人工接管关键词，从环境变量读取
         self.toggle_keywords = os.getenv("TOGGLE_KEYWORDS", "。")
+        
+        # 商品信息接口等阻塞调用放到线程池中执行，避免阻塞心跳和ACK（大模型调用为异步）
+        self.reply_workers = int(os.getenv("REPLY_WORKERS", "8"))  # 阻塞调用线程数，默认8
+        self.reply_executor = ThreadPoolExecutor(max_workers=self.reply_workers, thread_name_prefix="reply")
+        
+        # 会话调度：同一会话内按顺序处理，不同会话并行，全局限制同时进行的回复数
+        self.max_concurrent_replies = int(os.getenv("MAX_CONCURRENT_REPLIES", "8"))  # 最大并发回复数，默认8
+        # 消息防抖：买家连续发送的多条消息合并为一次回复
+        self.debounce_window = float(os.getenv("DEBOUNCE_WINDOW", "2"))        # 防抖静默窗口，默认2秒，0为关闭
+        self.debounce_max_wait = float(os.getenv("DEBOUNCE_MAX_WAIT", "8"))    # 防抖最长等待，默认8秒
+        self.dispatcher = ChatDispatcher(
+            self.process_chat_job,
+            max_concurrency=self.max_concurrent_replies,
+            merge=self.merge_chat_jobs,
+            debounce_window=self.debounce_window,
+            max_debounce_wait=self.debounce_max_wait,
+        )
+        
+        # 重连后服务端可能重复投递已处理过的消息，按消息ID去重（只记录最近的消息）
+        self.seen_messages = OrderedDict()
+        self.seen_messages_limit = 10000
 
     async def refresh_token(self):
         """刷新token"""
@@ -105,6 +165,57 @@ class XianyuLive:
                 logger.error(f"Token刷新循环出错: {e}")
                 await asyncio.sleep(60)
 
+    async def archive_loop(self):
+        """历史归档循环"""
+        while True:
+            try:
+                await self.context_manager.archive_idle_chats(self.archive_idle_days)
+                if self.usage_retention_days > 0:
+                    await self.context_manager.purge_llm_usage(self.usage_retention_days)
+            except Exception as e:
+                logger.error(f"历史归档出错: {e}")
+            await asyncio.sleep(self.archive_interval)
+
+    async def metrics_loop(self):
+        """运行指标日志循环"""
+        while True:
+            await asyncio.sleep(self.metrics_log_interval)
+            try:
+                self.log_metrics()
+            except Exception as e:
+                logger.error(f"输出运行指标出错: {e}")
+
+    def log_metrics(self):
+        """输出运行指标：会话调度（全局累计及等待最久的几个活跃会话）、投机生成统计和各意图的耗时与费用"""
+        metrics = self.dispatcher.get_metrics()
+        totals = metrics['totals']
+        logger.info(
+            f"会话调度: 进行中 {metrics['in_flight']}/{metrics['max_concurrency']}，活跃会话 {metrics['active_chats']}，"
+            f"排队 {metrics['pending']}，已处理 {totals['processed']}/{totals['submitted']}"
+            f"（失败 {totals['failed']}，合并 {totals['coalesced']}），"
+            f"平均等待 {totals['avg_wait']:.2f}s，最长等待 {totals['max_wait']:.2f}s"
+        )
+        busiest = sorted(metrics['chats'].items(), key=lambda item: (item[1]['depth'], item[1]['max_wait']), reverse=True)[:3]
+        if busiest:
+            logger.info("等待最久的会话: " + "，".join(
+                f"{chat_id}（排队 {chat['depth']}，最长等待 {chat['max_wait']:.2f}s）" for chat_id, chat in busiest
+            ))
+
+        speculation = bot.get_speculation_stats()
+        if speculation['drafts']:
+            logger.info(
+                f"投机生成: 草稿 {speculation['drafts']}，采用 {speculation['used']}（命中率 {speculation['hit_rate']:.0%}），"
+                f"丢弃 {speculation['discarded']}，浪费token {speculation['wasted_prompt_tokens']}+{speculation['wasted_completion_tokens']}，"
+                f"浪费费用 {speculation['wasted_cost']:.4f}元"
+            )
+
+        for intent, stats in bot.get_intent_metrics().items():
+            logger.info(
+                f"意图 {intent}: 回复 {stats['count']} 次，耗时 平均 {stats['avg_latency']:.2f}s / "
+                f"P50 {stats['p50_latency']:.2f}s / P95 {stats['p95_latency']:.2f}s，"
+                f"token {stats['prompt_tokens']}+{stats['completion_tokens']}，费用 {stats['cost']:.4f}元（平均 {stats['avg_cost']:.4f}元）"
+            )
+
     async def send_msg(self, ws, cid, toid, text):
         text = {
             "contentType": 1,
@@ -184,6 +295,16 @@ class XianyuLive:
         await ws.send(json.dumps(msg))
         logger.info('连接注册完成')
 
+    def is_duplicate_message(self, message_id):
+        """记录消息ID，已处理过的消息返回True"""
+        if message_id in self.seen_messages:
+            self.seen_messages.move_to_end(message_id)
+            return True
+        self.seen_messages[message_id] = True
+        if len(self.seen_messages) > self.seen_messages_limit:
+            self.seen_messages.popitem(last=False)
+        return False
+
     def is_chat_message(self, message):
         """判断是否为用户聊天消息"""
         try:
@@ -355,6 +476,9 @@ class XianyuLive:
             # 判断消息类型
             if self.is_typing_status(message):
                 logger.debug("用户正在输入")
+                # 顺延该会话的防抖窗口，等待用户输入完成后再合并回复
+                typing_id = message["1"][0]["1"].split('@')[0]
+                self.dispatcher.notify_typing(typing_id)
                 return
             elif not self.is_chat_message(message):
                 logger.debug("其他非聊天消息")
@@ -380,6 +504,12 @@ class XianyuLive:
             if not item_id:
                 logger.warning("无法获取商品ID")
                 return
+            
+            # 重复投递的消息不再处理，避免重复写入上下文和重复回复
+            message_id = message["1"].get("3") or f"{chat_id}:{send_user_id}:{create_time}:{send_message}"
+            if self.is_duplicate_message(message_id):
+                logger.debug(f"重复投递的消息已忽略: {message_id}")
+                return
 
             # 检查是否为卖家（自己）发送的控制命令
             if send_user_id == self.myid:
@@ -394,63 +524,195 @@ class XianyuLive:
                         logger.info(f"🟢 已恢复会话 {chat_id} 的自动回复 (商品: {item_id})")
                     return
                 
-                # 记录卖家人工回复
-                self.context_manager.add_message_by_chat(chat_id, self.myid, item_id, "assistant", send_message)
+                # 记录卖家人工回复（同样进入会话队列，保证与用户消息的先后顺序）
+                self.dispatcher.submit(chat_id, {
+                    "role": "assistant",
+                    "item_id": item_id,
+                    "content": send_message,
+                })
                 logger.info(f"卖家人工回复 (会话: {chat_id}, 商品: {item_id}): {send_message}")
                 return
             
             logger.info(f"用户: {send_user_name} (ID: {send_user_id}), 商品: {item_id}, 会话: {chat_id}, 消息: {send_message}")
-            # 添加用户消息到上下文
-            self.context_manager.add_message_by_chat(chat_id, send_user_id, item_id, "user", send_message)
+            # 提交到会话队列，由调度器按会话顺序写入上下文并生成回复，接收、ACK和心跳不受影响
+            self.dispatcher.submit(chat_id, {
+                "role": "user",
+                "user_id": send_user_id,
+                "user_name": send_user_name,
+                "item_id": item_id,
+                "contents": [send_message],
+                "create_time": create_time,
+                "is_system": self.is_system_message(message),
+            }, aliases=(send_user_id,))
             
-            # 如果当前会话处于人工接管模式，不进行自动回复
-            if self.is_manual_mode(chat_id):
-                logger.info(f"🔴 会话 {chat_id} 处于人工接管模式，跳过自动回复")
-                return
-            if self.is_system_message(message):
-                logger.debug("系统消息，跳过处理")
-                return
-            # 从数据库中获取商品信息，如果不存在则从API获取并保存
-            item_info = self.context_manager.get_item_info(item_id)
+        except Exception as e:
+            logger.error(f"处理消息时发生错误: {str(e)}")
+            logger.debug(f"原始消息: {message_data}")
+
+    def merge_chat_jobs(self, job, next_job):
+        """合并同一会话中连续的用户消息，返回None表示不可合并"""
+        if job["role"] != "user" or next_job["role"] != "user":
+            return None
+        if job["is_system"] or next_job["is_system"] or job["item_id"] != next_job["item_id"]:
+            return None
+        merged = dict(job)
+        merged["contents"] = job["contents"] + next_job["contents"]
+        return merged
+
+    async def process_chat_job(self, chat_id, job):
+        """处理会话队列中的单个任务，同一会话的任务严格按顺序执行"""
+        item_id = job["item_id"]
+        if job["role"] == "assistant":
+            await self.context_manager.add_message_by_chat(chat_id, self.myid, item_id, "assistant", job["content"])
+            return
+        
+        # 添加用户消息到上下文（防抖合并的消息逐条保存）
+        for content in job["contents"]:
+            await self.context_manager.add_message_by_chat(chat_id, job["user_id"], item_id, "user", content)
+        
+        # 如果当前会话处于人工接管模式，不进行自动回复
+        if self.is_manual_mode(chat_id):
+            logger.info(f"🔴 会话 {chat_id} 处于人工接管模式，跳过自动回复")
+            return
+        if job["is_system"]:
+            logger.debug("系统消息，跳过处理")
+            return
+        
+        if len(job["contents"]) > 1:
+            logger.info(f"会话 {chat_id} 合并 {len(job['contents'])} 条连续消息生成一次回复")
+        await self.reply_to_message(chat_id, job["user_id"], job["user_name"], item_id, "\n".join(job["contents"]),
+                                    create_time=job["create_time"])
+
+    async def reply_to_message(self, chat_id, send_user_id, send_user_name, item_id, send_message, create_time=None):
+        """
+        生成并发送自动回复，阻塞的接口调用在线程池中执行
+
+        create_time 为（合并消息中最早一条的）消息创建时间（毫秒），用于调用配额排队和过期丢弃
+        """
+        loop = asyncio.get_running_loop()
+        sent_parts = []
+        try:
+            # 从数据库中获取商品信息，如果不存在或已超过刷新间隔则从API获取并保存
+            item_info = await self.context_manager.get_item_info(item_id, max_age=self.item_info_ttl)
             if not item_info:
                 logger.info(f"从API获取商品信息: {item_id}")
-                api_result = self.xianyu.get_item_info(item_id)
+                api_result = await loop.run_in_executor(self.reply_executor, self.xianyu.get_item_info, item_id)
                 if 'data' in api_result and 'itemDO' in api_result['data']:
                     item_info = api_result['data']['itemDO']
-                    # 保存商品信息到数据库
-                    self.context_manager.save_item_info(item_id, item_info)
+                    # 保存商品信息到数据库，价格或描述变化时清空该商品的回复缓存
+                    if await self.context_manager.save_item_info(item_id, item_info):
+                        self.reply_cache.invalidate(item_id)
                 else:
-                    logger.warning(f"获取商品信息失败: {api_result}")
-                    return
+                    # 刷新失败时继续使用数据库中的旧信息
+                    item_info = await self.context_manager.get_item_info(item_id)
+                    if not item_info:
+                        logger.warning(f"获取商品信息失败: {api_result}")
+                        return
+                    logger.warning(f"刷新商品信息失败，使用数据库中的商品信息: {api_result}")
             else:
                 logger.info(f"从数据库获取商品信息: {item_id}")
                 
             item_description = f"{item_info['desc']};当前商品售卖价格为:{str(item_info['soldPrice'])}"
             
             # 获取完整的对话上下文
-            context = self.context_manager.get_context_by_chat(chat_id)
-            # 生成回复
-            bot_reply = bot.generate_reply(
-                send_message,
-                item_description,
-                context=context
-            )
+            context = await self.context_manager.get_context_by_chat(chat_id)
+            
+            # 流式模式下首个完整句子生成后立即发送
+            on_first_sentence = None
+            if self.stream_reply:
+                async def on_first_sentence(text):
+                    await self.send_msg(self.ws, chat_id, send_user_id, text.strip())
+                    sent_parts.append(text)
+                    logger.info(f"机器人回复(首句): {text.strip()}")
+            
+            # 生成回复，常见问题优先使用缓存
+            cached = self.reply_cache.get(item_id, send_message) if self.reply_cache_enabled else None
+            if cached is not None:
+                bot_reply, intent = cached
+                intent_source = 'cache'
+                logger.info(f"命中回复缓存: {send_message}")
+            else:
+                created_at = create_time / 1000 if create_time else time.time()
+                expires_at = created_at + self.message_expire_time / 1000
+                with usage_scope(chat_id=chat_id, item_id=item_id), message_deadline(created_at, expires_at):
+                    bot_reply, intent, intent_source = await bot.generate_reply_with_intent(
+                        send_message,
+                        item_description,
+                        context,
+                        on_first_sentence=on_first_sentence
+                    )
+                # 被安全过滤替换的回复不缓存，否则同一问题的后续买家都会收到安全提醒
+                if self.reply_cache_enabled and bot.safety_filter.allows(bot_reply):
+                    self.reply_cache.put(item_id, send_message, bot_reply, intent)
+            
+            # 去掉已提前发送的部分；若后续内容被安全过滤替换，则发送过滤后的提示
+            sent_text = "".join(sent_parts)
+            if sent_text and bot_reply.startswith(sent_text):
+                remaining_reply = bot_reply[len(sent_text):]
+            else:
+                remaining_reply = bot_reply
+            bot_reply = sent_text + remaining_reply
             
             # 检查是否为价格意图，如果是则增加议价次数
-            if bot.last_intent == "price":
-                self.context_manager.increment_bargain_count_by_chat(chat_id)
-                bargain_count = self.context_manager.get_bargain_count_by_chat(chat_id)
+            if intent == "price":
+                await self.context_manager.increment_bargain_count_by_chat(chat_id)
+                bargain_count = await self.context_manager.get_bargain_count_by_chat(chat_id)
                 logger.info(f"用户 {send_user_name} 对商品 {item_id} 的议价次数: {bargain_count}")
             
-            # 添加机器人回复到上下文
-            self.context_manager.add_message_by_chat(chat_id, self.myid, item_id, "assistant", bot_reply)
+            # 添加机器人回复到上下文，意图及其来源作为本地意图模型的训练标注
+            await self.context_manager.add_message_by_chat(chat_id, self.myid, item_id, "assistant", bot_reply,
+                                                           intent, intent_source)
             
             logger.info(f"机器人回复: {bot_reply}")
-            await self.send_msg(websocket, chat_id, send_user_id, bot_reply)
+            # 生成期间可能已重连，使用当前的WebSocket连接发送
+            if remaining_reply.strip():
+                await self.send_msg(self.ws, chat_id, send_user_id, remaining_reply.strip())
             
+            # 上下文只包含摘要之后的消息，加上本次回复即为未摘要的消息数
+            unsummarized = sum(1 for msg in context if msg['role'] in ('user', 'assistant')) + 1
+            self.schedule_summary(chat_id, item_description, unsummarized)
+            
+        except LLMQueueExpiredError as e:
+            # 调用配额排队期间消息会过期，与过期消息一样不再回复
+            logger.warning(f"调用配额不足，消息过期前无法回复，已丢弃 (会话: {chat_id}): {e}，队列状态: {bot.get_scheduler_stats()}")
+        except LLMUnavailableError as e:
+            # 大模型服务不可用时快速降级，不让买家一直等待；已发出首句时不再补发
+            logger.error(f"大模型服务不可用 (会话: {chat_id}): {str(e)}")
+            if self.fallback_reply and not sent_parts:
+                await self.send_msg(self.ws, chat_id, send_user_id, self.fallback_reply)
+                await self.context_manager.add_message_by_chat(chat_id, self.myid, item_id, "assistant", self.fallback_reply)
+                logger.info(f"已发送兜底回复: {self.fallback_reply}")
         except Exception as e:
-            logger.error(f"处理消息时发生错误: {str(e)}")
-            logger.debug(f"原始消息: {message_data}")
+            logger.error(f"生成回复时发生错误 (会话: {chat_id}): {str(e)}")
+
+    def schedule_summary(self, chat_id, item_description, unsummarized):
+        """
+        摘要之后的消息达到间隔轮数（一问一答为一轮）后在后台刷新会话摘要
+        
+        未摘要的消息数由数据库中的摘要进度得出，重启或摘要失败后下一次回复会重新触发
+        """
+        if self.summary_every_turns <= 0 or chat_id in self.summary_tasks:
+            return
+        if unsummarized < self.summary_every_turns * 2:
+            return
+        task = asyncio.create_task(self.refresh_summary(chat_id, item_description))
+        self.summary_tasks[chat_id] = task
+        task.add_done_callback(lambda _: self.summary_tasks.pop(chat_id, None))
+
+    async def refresh_summary(self, chat_id, item_description):
+        """生成并保存会话摘要，不阻塞回复流程"""
+        try:
+            # 只发送已有摘要之后的新消息
+            previous_summary, messages, last_message_id = await self.context_manager.get_unsummarized_messages(chat_id)
+            if not messages:
+                return
+            with usage_scope(chat_id=chat_id):
+                summary = await bot.summarize(item_description, previous_summary, messages)
+            if summary:
+                await self.context_manager.save_summary_by_chat(chat_id, summary, last_message_id)
+                logger.info(f"会话 {chat_id} 摘要已更新: {summary}")
+        except Exception as e:
+            logger.error(f"更新会话摘要时出错 (会话: {chat_id}): {e}")
 
     async def send_heartbeat(self, ws):
         """发送心跳包并等待响应"""
@@ -508,6 +770,13 @@ class XianyuLive:
         return False
 
     async def main(self):
+        # 启动历史归档任务（与连接无关，只启动一次）
+        if self.archive_interval > 0 and not self.archive_task:
+            self.archive_task = asyncio.create_task(self.archive_loop())
+        # 启动运行指标日志任务
+        if self.metrics_log_interval > 0 and not self.metrics_task:
+            self.metrics_task = asyncio.create_task(self.metrics_loop())
+        
         while True:
             try:
                 # 重置连接重启标志
@@ -0,0 +1,125 @@
+import os
+import json
+from collections import deque
+from typing import Dict, Optional
+from loguru import logger
+
+
+# 各模型参考单价（元/千token），以模型平台最新价格为准，可在配置文件的 pricing 中覆盖
+DEFAULT_MODEL_PRICING = {
+    'qwen-max': {'input': 0.0024, 'output': 0.0096},
+    'qwen-plus': {'input': 0.0008, 'output': 0.002},
+    'qwen-turbo': {'input': 0.0003, 'output': 0.0006},
+}
+
+
+def load_model_profiles(path: Optional[str]) -> Dict:
+    """
+    加载各Agent的模型配置
+
+    配置文件格式::
+
+        {
+            "agents": {
+                "classify": {"model": "qwen-turbo", "max_tokens": 16, "temperature": 0.1},
+                "default": {"model": "qwen-turbo"},
+                "price": {"model": "qwen-max", "priority": 0}
+            },
+            "pricing": {"qwen-turbo": {"input": 0.0003, "output": 0.0006}}
+        }
+
+    未配置的Agent使用 MODEL_NAME、max_tokens=500 和Agent自身的默认温度。
+    priority 为调用配额排队时的优先级（数值越小越优先），未配置时议价优先、摘要最后。
+
+    Args:
+        path: 配置文件路径，文件不存在时返回空配置
+
+    Returns:
+        dict: {'agents': {Agent名称: 配置}, 'pricing': {模型: 单价}}
+    """
+    profiles = {'agents': {}, 'pricing': dict(DEFAULT_MODEL_PRICING)}
+    if not path or not os.path.exists(path):
+        return profiles
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        profiles['agents'] = data.get('agents', {})
+        profiles['pricing'].update(data.get('pricing', {}))
+        logger.info(f"已加载模型配置: {path}，{ {name: p.get('model') for name, p in profiles['agents'].items()} }")
+    except Exception as e:
+        logger.error(f"加载模型配置时出错，使用默认配置: {e}")
+    return profiles
+
+
+def estimate_cost(pricing: Dict, model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    """按单价估算一次调用的费用（元），未配置单价的模型返回0"""
+    price = pricing.get(model)
+    if not price:
+        return 0.0
+    return (prompt_tokens * price.get('input', 0.0) + completion_tokens * price.get('output', 0.0)) / 1000
+
+
+class IntentMetrics:
+    """
+    按意图统计回复耗时和费用
+
+    保留每个意图最近的耗时样本用于计算分位数，调用次数、token和费用累计统计。
+    """
+
+    def __init__(self, window=500):
+        """
+        Args:
+            window: 每个意图保留的最近耗时样本数
+        """
+        self.window = window
+        self._stats = {}
+
+    def record(self, intent: str, latency: float, prompt_tokens: int = 0, completion_tokens: int = 0, cost: float = 0.0):
+        """记录一次回复"""
+        stats = self._stats.get(intent)
+        if stats is None:
+            stats = self._stats[intent] = {
+                'count': 0,
+                'total_latency': 0.0,
+                'latencies': deque(maxlen=self.window),
+                'prompt_tokens': 0,
+                'completion_tokens': 0,
+                'cost': 0.0,
+            }
+        stats['count'] += 1
+        stats['total_latency'] += latency
+        stats['latencies'].append(latency)
+        stats['prompt_tokens'] += prompt_tokens
+        stats['completion_tokens'] += completion_tokens
+        stats['cost'] += cost
+
+    @staticmethod
+    def _percentile(sorted_values, ratio):
+        """已排序样本的分位数"""
+        if not sorted_values:
+            return 0.0
+        index = min(len(sorted_values) - 1, int(ratio * len(sorted_values)))
+        return sorted_values[index]
+
+    def snapshot(self) -> Dict[str, Dict]:
+        """
+        获取统计结果
+
+        Returns:
+            dict: 意图 -> 次数、平均/P50/P95耗时、token和费用
+        """
+        result = {}
+        for intent, stats in self._stats.items():
+            latencies = sorted(stats['latencies'])
+            count = stats['count']
+            result[intent] = {
+                'count': count,
+                'avg_latency': stats['total_latency'] / count,
+                'p50_latency': self._percentile(latencies, 0.5),
+                'p95_latency': self._percentile(latencies, 0.95),
+                'prompt_tokens': stats['prompt_tokens'],
+                'completion_tokens': stats['completion_tokens'],
+                'cost': stats['cost'],
+                'avg_cost': stats['cost'] / count,
+            }
+        return result
@@ -0,0 +1,151 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from types import MappingProxyType
+from typing import Dict, Mapping, Optional
+from loguru import logger
+
+
+class PromptSnapshot:
+    """
+    提示词快照
+
+    一次加载得到的全部提示词，加载后不可修改。
+    版本号单调递增，便于在日志中确认某次回复使用的提示词版本。
+    """
+
+    __slots__ = ('version', 'prompts', 'loaded_at')
+
+    def __init__(self, version: int, prompts: Dict[str, str]):
+        self.version = version
+        self.prompts = MappingProxyType(dict(prompts))
+        self.loaded_at = time.time()
+
+    def __getitem__(self, name: str) -> str:
+        return self.prompts[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.prompts
+
+
+# 当前回复固定使用的提示词快照，asyncio任务各自持有一份
+_pinned_snapshot: ContextVar[Optional[PromptSnapshot]] = ContextVar('pinned_prompt_snapshot', default=None)
+
+
+class PromptRegistry:
+    """
+    提示词注册表
+
+    从提示词目录加载提示词并生成不可变快照，按时间间隔检查文件修改时间，
+    有修改时重新加载并整体替换快照（单次赋值，读取方不会看到加载到一半的状态）。
+    未修改的文件直接复用已读取的内容，加载失败时保留当前快照。
+    一次回复开始时通过 pinned() 固定快照，期间提示词更新不影响进行中的回复。
+    """
+
+    def __init__(self, prompt_dir: str, files: Mapping[str, str], defaults: Optional[Mapping[str, str]] = None,
+                 check_interval: float = 2.0):
+        """
+        初始化注册表并加载提示词
+
+        Args:
+            prompt_dir: 提示词目录
+            files: 提示词名称 -> 文件名
+            defaults: 可选提示词的默认内容，文件不存在时使用，未列出的提示词文件必须存在
+            check_interval: 检查文件修改的最小间隔（秒），为0时每次获取都检查
+        """
+        self.prompt_dir = prompt_dir
+        self.files = dict(files)
+        self.defaults = dict(defaults or {})
+        self.check_interval = check_interval
+        self._file_cache = {}  # 路径 -> ((修改时间, 大小), 内容)
+        self._signature = None
+        self._snapshot = None
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+        if not self.reload():
+            raise RuntimeError(f"加载提示词失败: {prompt_dir}")
+
+    def _stat_signature(self):
+        """所有提示词文件的(修改时间, 大小)，文件不存在时为None"""
+        signature = {}
+        for name, filename in self.files.items():
+            path = os.path.join(self.prompt_dir, filename)
+            try:
+                stat = os.stat(path)
+                signature[name] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                signature[name] = None
+        return signature
+
+    def _read(self, name: str, stat_key) -> str:
+        """读取提示词文件，文件未修改时复用缓存内容"""
+        path = os.path.join(self.prompt_dir, self.files[name])
+        if stat_key is None:
+            if name in self.defaults:
+                return self.defaults[name]
+            raise FileNotFoundError(path)
+
+        cached = self._file_cache.get(path)
+        if cached is not None and cached[0] == stat_key:
+            return cached[1]
+        with open(path, "r", encoding="utf-8") as f:
+            content = f.read()
+        self._file_cache[path] = (stat_key, content)
+        logger.debug(f"已加载提示词 {name}，长度: {len(content)} 字符")
+        return content
+
+    def reload(self, force: bool = False) -> bool:
+        """
+        检查并重新加载提示词
+
+        Args:
+            force: 为True时即使文件未修改也生成新版本
+
+        Returns:
+            bool: 当前快照是否可用（加载失败且没有旧快照时为False）
+        """
+        with self._lock:
+            self._last_check = time.monotonic()
+            signature = self._stat_signature()
+            if not force and signature == self._signature and self._snapshot is not None:
+                return True
+            try:
+                prompts = {name: self._read(name, stat_key) for name, stat_key in signature.items()}
+            except Exception as e:
+                logger.error(f"加载提示词时出错，继续使用当前版本: {e}")
+                return self._snapshot is not None
+
+            version = self._snapshot.version + 1 if self._snapshot else 1
+            self._signature = signature
+            self._snapshot = PromptSnapshot(version, prompts)
+            logger.info(f"提示词已加载，版本: {version}")
+            return True
+
+    def current(self) -> PromptSnapshot:
+        """获取最新的提示词快照，距上次检查超过间隔时先检查文件是否修改"""
+        if time.monotonic() - self._last_check >= self.check_interval:
+            self.reload()
+        return self._snapshot
+
+    def active(self) -> PromptSnapshot:
+        """获取当前回复固定的快照，未固定时返回最新快照"""
+        return _pinned_snapshot.get() or self.current()
+
+    @contextmanager
+    def pinned(self):
+        """
+        在一次回复内固定提示词快照
+
+        已固定时沿用外层快照，嵌套调用（如生成回复时的意图分类）使用同一版本。
+        """
+        if _pinned_snapshot.get() is not None:
+            yield _pinned_snapshot.get()
+            return
+        snapshot = self.current()
+        token = _pinned_snapshot.set(snapshot)
+        try:
+            yield snapshot
+        finally:
+            _pinned_snapshot.reset(token)
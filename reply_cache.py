@@ -0,0 +1,122 @@
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+
+
+class ReplyCache:
+    """
+    商品级常见问题回复缓存
+
+    同一商品下不同买家经常问相同的问题（"包邮吗"、"还在吗"、"成色怎么样"），
+    按商品ID和归一化后的消息文本缓存回复，命中时跳过意图识别和回复生成。
+    只缓存疑问句（"好的"、"可以"这类应答的含义依赖上下文），缓存条目有过期时间，
+    商品价格或描述变化时清空该商品的缓存，议价等依赖会话状态的意图不缓存。
+    """
+
+    # 归一化时去掉的字符：标点、空白以及句尾语气词
+    STRIP_PATTERN = re.compile(r'[^\w\u4e00-\u9fa5]|_')
+    TRAILING_PARTICLES = re.compile(r'[呢吧啊呀哈嘛哦噢]+$')
+    # 疑问句特征
+    QUESTION_PATTERN = re.compile(r'[吗么?？]|什么|怎么|怎样|多少|多久|几|哪|是否|有没有|能不能|可不可以|[是有能会]不[是有能会]')
+
+    def __init__(self, ttl=3600, max_items=1000, max_entries_per_item=50, excluded_intents=('price',)):
+        """
+        初始化回复缓存
+
+        Args:
+            ttl: 缓存条目有效期（秒）
+            max_items: 最多缓存的商品数，超出时淘汰最久未访问的商品
+            max_entries_per_item: 每个商品最多缓存的问题数
+            excluded_intents: 不缓存的意图
+        """
+        self.ttl = ttl
+        self.max_items = max_items
+        self.max_entries_per_item = max_entries_per_item
+        self.excluded_intents = set(excluded_intents)
+        self._items = OrderedDict()  # item_id -> OrderedDict[归一化文本 -> (回复, 意图, 过期时间)]
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def normalize(cls, text):
+        """归一化消息文本：全角转半角、小写、去掉标点空白和句尾语气词"""
+        text = unicodedata.normalize("NFKC", text).lower()
+        text = cls.STRIP_PATTERN.sub('', text)
+        return cls.TRAILING_PARTICLES.sub('', text) or text
+
+    def cacheable(self, message):
+        """消息是否适合使用缓存（疑问句）"""
+        return bool(self.QUESTION_PATTERN.search(unicodedata.normalize("NFKC", message)))
+
+    def get(self, item_id, message):
+        """
+        查询缓存的回复
+
+        Args:
+            item_id: 商品ID
+            message: 买家消息
+
+        Returns:
+            tuple: (回复, 意图)，未命中或已过期时返回None
+        """
+        if not self.cacheable(message):
+            return None
+        key = self.normalize(message)
+        entries = self._items.get(item_id)
+        entry = entries.get(key) if entries is not None and key else None
+        if entry is None:
+            self.misses += 1
+            return None
+
+        reply, intent, expires_at = entry
+        if expires_at <= time.monotonic():
+            del entries[key]
+            self.misses += 1
+            return None
+
+        entries.move_to_end(key)
+        self._items.move_to_end(item_id)
+        self.hits += 1
+        return reply, intent
+
+    def put(self, item_id, message, reply, intent):
+        """
+        缓存一条回复，排除的意图和非疑问句不缓存
+
+        Returns:
+            bool: 是否已缓存
+        """
+        if intent in self.excluded_intents or not reply or not self.cacheable(message):
+            return False
+        key = self.normalize(message)
+        if not key:
+            return False
+
+        entries = self._items.get(item_id)
+        if entries is None:
+            entries = self._items[item_id] = OrderedDict()
+        entries[key] = (reply, intent, time.monotonic() + self.ttl)
+        entries.move_to_end(key)
+        self._items.move_to_end(item_id)
+
+        while len(entries) > self.max_entries_per_item:
+            entries.popitem(last=False)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+        return True
+
+    def invalidate(self, item_id):
+        """清空商品的缓存（商品价格或描述变化时调用）"""
+        self._items.pop(item_id, None)
+
+    def stats(self):
+        """缓存统计信息"""
+        total = self.hits + self.misses
+        return {
+            'items': len(self._items),
+            'entries': sum(len(entries) for entries in self._items.values()),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,213 @@
+import asyncio
+import time
+from collections import deque
+from loguru import logger
+
+
+class ChatDispatcher:
+    """
+    会话级回复调度器
+
+    按会话ID维护独立的FIFO队列：同一会话内的消息严格按到达顺序串行处理，
+    不同会话之间并行处理，并通过全局信号量限制同时进行中的回复（大模型调用）数量。
+    同时记录队列深度和排队等待时间（全局累计，以及当前活跃会话各自的统计，会话队列清空后移除），
+    便于根据模型配额调整并发上限。
+
+    配置了合并函数时启用防抖：会话内首个任务会等待一个静默窗口（期间有新消息或
+    正在输入状态则顺延，最长不超过max_debounce_wait），窗口内连续到达的任务合并为一个处理。
+    """
+
+    def __init__(self, handler, max_concurrency=8, merge=None, debounce_window=0.0, max_debounce_wait=0.0):
+        """
+        初始化调度器
+
+        Args:
+            handler: 异步处理函数，签名为 handler(chat_id, job)
+            max_concurrency: 全局最大并发处理数
+            merge: 任务合并函数，签名为 merge(job, next_job)，返回合并后的任务，无法合并时返回None
+            debounce_window: 防抖静默窗口（秒），为0时不做防抖
+            max_debounce_wait: 防抖最长等待时间（秒），从首个任务入队开始计算
+        """
+        self.handler = handler
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.merge = merge
+        self.debounce_window = debounce_window
+        self.max_debounce_wait = max(max_debounce_wait, debounce_window)
+        self.queues = {}         # chat_id -> deque[(job, 入队时间)]
+        self.workers = {}        # chat_id -> 正在运行的会话worker任务
+        self.stats = {}          # chat_id -> 活跃会话的队列统计信息，worker退出时移除
+        self.totals = self._new_stats()  # 所有会话累计的统计信息
+        self.last_activity = {}  # chat_id -> 最近一次消息或输入状态的时间
+        self.aliases = {}        # 别名(如用户ID) -> chat_id，用于匹配正在输入状态
+        self.in_flight = 0
+
+    def submit(self, chat_id, job, aliases=()):
+        """
+        提交一个任务到指定会话的队列
+
+        Args:
+            chat_id: 会话ID
+            job: 任务数据，原样传递给handler
+            aliases: 该会话的其他标识（如用户ID），正在输入状态可通过这些标识匹配到会话
+        """
+        queue = self.queues.setdefault(chat_id, deque())
+        now = time.monotonic()
+        queue.append((job, now))
+        self.last_activity[chat_id] = now
+        for alias in aliases:
+            self.aliases[alias] = chat_id
+
+        for stats in (self._get_stats(chat_id), self.totals):
+            stats['submitted'] += 1
+            stats['max_depth'] = max(stats['max_depth'], len(queue))
+
+        # 每个会话最多一个worker，保证会话内顺序
+        if chat_id not in self.workers:
+            self.workers[chat_id] = asyncio.create_task(self._worker(chat_id))
+
+    def notify_typing(self, key):
+        """
+        记录会话的正在输入状态，顺延该会话的防抖窗口
+
+        Args:
+            key: 会话ID或提交任务时登记的别名
+
+        Returns:
+            bool: 是否匹配到有待处理任务的会话
+        """
+        chat_id = key if key in self.queues else self.aliases.get(key)
+        if chat_id is None or chat_id not in self.queues:
+            return False
+        self.last_activity[chat_id] = time.monotonic()
+        return True
+
+    async def _worker(self, chat_id):
+        """会话worker，依次处理该会话队列中的任务，队列清空后退出"""
+        queue = self.queues[chat_id]
+        stats = self._get_stats(chat_id)
+        try:
+            while queue:
+                job, enqueued_at = queue[0]
+                if self.merge is not None and self.debounce_window > 0:
+                    await self._wait_quiet(chat_id, enqueued_at)
+                queue.popleft()
+                if self.merge is not None:
+                    job = self._coalesce(queue, job, stats)
+                async with self.semaphore:
+                    wait_time = time.monotonic() - enqueued_at
+                    for counters in (stats, self.totals):
+                        counters['processed'] += 1
+                        counters['total_wait'] += wait_time
+                        counters['max_wait'] = max(counters['max_wait'], wait_time)
+                        counters['last_wait'] = wait_time
+                    logger.debug(f"会话 {chat_id} 任务开始处理，排队等待 {wait_time:.3f}s，剩余队列深度 {len(queue)}")
+
+                    self.in_flight += 1
+                    try:
+                        await self.handler(chat_id, job)
+                    except Exception as e:
+                        stats['failed'] += 1
+                        self.totals['failed'] += 1
+                        logger.error(f"会话 {chat_id} 任务处理出错: {e}")
+                    finally:
+                        self.in_flight -= 1
+        finally:
+            # 队列已空（或任务被取消），清理worker和空队列，会话统计只保留在全局累计中
+            self.workers.pop(chat_id, None)
+            if not queue:
+                self.queues.pop(chat_id, None)
+                self.stats.pop(chat_id, None)
+                self.last_activity.pop(chat_id, None)
+                self.aliases = {alias: cid for alias, cid in self.aliases.items() if cid != chat_id}
+
+    async def _wait_quiet(self, chat_id, enqueued_at):
+        """等待会话进入静默状态（防抖窗口内无新消息和输入状态），或达到最长等待时间"""
+        deadline = enqueued_at + self.max_debounce_wait
+        while True:
+            quiet_at = self.last_activity.get(chat_id, enqueued_at) + self.debounce_window
+            wake_at = min(quiet_at, deadline)
+            delay = wake_at - time.monotonic()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    def _coalesce(self, queue, job, stats):
+        """将队列头部可合并的连续任务合并到当前任务中"""
+        merged_count = 0
+        while queue:
+            merged = self.merge(job, queue[0][0])
+            if merged is None:
+                break
+            queue.popleft()
+            job = merged
+            merged_count += 1
+        if merged_count:
+            stats['coalesced'] += merged_count
+            self.totals['coalesced'] += merged_count
+            logger.debug(f"防抖合并 {merged_count + 1} 条消息为一次处理")
+        return job
+
+    @staticmethod
+    def _new_stats():
+        """空的统计信息"""
+        return {
+            'submitted': 0,
+            'processed': 0,
+            'failed': 0,
+            'coalesced': 0,
+            'max_depth': 0,
+            'total_wait': 0.0,
+            'max_wait': 0.0,
+            'last_wait': 0.0,
+        }
+
+    def _get_stats(self, chat_id):
+        """获取（必要时创建）会话统计信息"""
+        stats = self.stats.get(chat_id)
+        if stats is None:
+            stats = self._new_stats()
+            self.stats[chat_id] = stats
+        return stats
+
+    def get_metrics(self, chat_id=None):
+        """
+        获取调度指标
+
+        Args:
+            chat_id: 会话ID，为空时返回全局累计指标及当前活跃会话的指标
+
+        Returns:
+            dict: 队列深度、等待时间等统计信息
+        """
+        if chat_id is not None:
+            return self._chat_metrics(chat_id)
+
+        return {
+            'max_concurrency': self.max_concurrency,
+            'in_flight': self.in_flight,
+            'active_chats': len(self.workers),
+            'pending': sum(len(queue) for queue in self.queues.values()),
+            'totals': self._summarize(self.totals),
+            'chats': {cid: self._chat_metrics(cid) for cid in self.stats},
+        }
+
+    def _chat_metrics(self, chat_id):
+        """单个会话的指标，已结束的会话返回空统计"""
+        return dict(self._summarize(self.stats.get(chat_id) or self._new_stats()),
+                    depth=len(self.queues.get(chat_id, ())))
+
+    @staticmethod
+    def _summarize(stats):
+        """将统计信息整理为指标"""
+        processed = stats['processed']
+        return {
+            'max_depth': stats['max_depth'],
+            'submitted': stats['submitted'],
+            'processed': processed,
+            'failed': stats['failed'],
+            'coalesced': stats['coalesced'],
+            'avg_wait': stats['total_wait'] / processed if processed else 0.0,
+            'max_wait': stats['max_wait'],
+            'last_wait': stats['last_wait'],
+        }
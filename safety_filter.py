@@ -0,0 +1,171 @@
+import unicodedata
+from functools import lru_cache
+from typing import Dict, Optional
+from loguru import logger
+from utils.matcher import KeywordAutomaton
+from utils.config_watcher import JsonConfigWatcher
+
+
+# 内置安全规则，可通过规则文件覆盖，格式相同
+DEFAULT_SAFETY_RULES = {
+    "phrases": ["微信", "QQ", "支付宝", "银行卡", "线下"],
+    "reply": "[安全提醒]请通过平台沟通",
+}
+
+# 句子和分句标点重置匹配：违规词不跨句、跨分句匹配，避免"平台支付，宝贝当天发出"误判为"支付宝"
+BREAK_CHARS = frozenset("。！？!?；;，,、：:\n…~～")
+# 违规词中间最多跳过的连续间隔符（空白、"-"、"·"等），更长的间隔视为不相关的两段文字
+MAX_SEPARATORS = 3
+
+
+@lru_cache(maxsize=8192)
+def normalize_char(char: str) -> str:
+    """
+    归一化单个字符
+
+    全角转半角、兼容字符转标准字符（NFKC）并忽略大小写，
+    空白、标点、符号和控制字符视为间隔符，归一化为空串（断句标点由 BREAK_CHARS 单独处理）。
+    """
+    folded = unicodedata.normalize('NFKC', char).casefold()
+    return "".join(c for c in folded if unicodedata.category(c)[0] not in 'ZPSC')
+
+
+def normalize_text(text: str) -> str:
+    """归一化文本（用于违规词本身）"""
+    return "".join(normalize_char(char) for char in text)
+
+
+class FilteredText(str):
+    """已通过安全检查的文本，记录检查时的规则版本，规则未变化时无需再次检查"""
+
+    __slots__ = ('rules_version',)
+
+    def __new__(cls, text: str, rules_version: int):
+        obj = super().__new__(cls, text)
+        obj.rules_version = rules_version
+        return obj
+
+
+class SafetyScanner:
+    """
+    增量安全检查
+
+    逐段读入流式生成的文本，违规词在最后一个字符到达时即被发现，
+    已读入的文本不再重复扫描。违规词中间的空白和符号（最多 MAX_SEPARATORS 个）会被跳过，
+    遇到断句标点时重新开始匹配。
+    settled 记录自动机最近一次回到初始状态时已读入的字符数，此前的文本不会与后续文本组成违规词，
+    流式生成时只有这部分可以提前发送。
+    """
+
+    def __init__(self, automaton: KeywordAutomaton, rules_version: int):
+        self._automaton = automaton
+        self._state = 0
+        self._gap = 0  # 当前连续跳过的间隔符数
+        self._fed = 0
+        self.settled = 0
+        self.rules_version = rules_version
+        self.blocked: Optional[str] = None  # 命中的违规词
+
+    def feed(self, text: str) -> bool:
+        """
+        读入新增文本
+
+        Returns:
+            bool: 目前为止是否出现违规内容
+        """
+        if self.blocked is not None:
+            return True
+        automaton = self._automaton
+        state = self._state
+        gap = self._gap
+        fed = self._fed
+        settled = self.settled
+        for char in text:
+            fed += 1
+            normalized = normalize_char(char) if char not in BREAK_CHARS else ""
+            if not normalized:
+                gap += 1
+                if char in BREAK_CHARS or gap > MAX_SEPARATORS:
+                    state = 0
+            else:
+                gap = 0
+                for c in normalized:
+                    state = automaton.step(state, c)
+                    hits = automaton.matches(state)
+                    if hits:
+                        self.blocked = hits[0][1]
+                        return True
+            if state == 0:
+                settled = fed
+        self._state = state
+        self._gap = gap
+        self._fed = fed
+        self.settled = settled
+        return False
+
+    def result(self, text: str) -> str:
+        """读入的全部文本未违规时标记为已检查，违规时原样返回，交由过滤器替换"""
+        return text if self.blocked is not None else FilteredText(text, self.rules_version)
+
+
+class SafetyFilter:
+    """
+    安全过滤器
+
+    违规词归一化后编译为一个Aho-Corasick自动机，对回复只扫描一遍，
+    可识别全角字符、大小写变体以及用空格、符号隔开的违规词（如"微 信"、"Ｑ-Ｑ"），
+    违规词不跨句子和分句匹配。
+    规则文件修改后自动重新加载，流式生成时通过 scanner() 增量检查。
+    """
+
+    def __init__(self, rules_path: Optional[str] = None, reload_interval: float = 1.0):
+        """
+        Args:
+            rules_path: 规则配置文件（JSON：{"phrases": [...], "reply": "..."}），不存在时使用内置规则
+            reload_interval: 检查规则文件是否修改的最小间隔（秒）
+        """
+        self.version = 0
+        self._set_rules(DEFAULT_SAFETY_RULES)
+        self._rules_file = JsonConfigWatcher(rules_path, self._apply_rules_file, reload_interval, name="安全规则")
+        self._rules_file.reload()
+
+    def _set_rules(self, rules: Dict):
+        """编译规则并整体替换，进行中的检查继续使用原规则"""
+        phrases = rules.get("phrases", [])
+        automaton = KeywordAutomaton({normalize_text(phrase): phrase for phrase in phrases if normalize_text(phrase)})
+        self.reply = rules.get("reply", DEFAULT_SAFETY_RULES["reply"])
+        self.phrases = list(phrases)
+        self._automaton = automaton
+        self.version += 1
+
+    def _apply_rules_file(self, rules: Dict):
+        """应用规则文件中的规则"""
+        self._set_rules(rules)
+        logger.info(f"已加载安全规则: {self._rules_file.path}，违规词 {len(self.phrases)} 个")
+
+    def scanner(self) -> SafetyScanner:
+        """创建增量检查器，用于流式生成"""
+        self._rules_file.check()
+        return SafetyScanner(self._automaton, self.version)
+
+    def find(self, text: str) -> Optional[str]:
+        """返回文本中命中的违规词，未命中返回None"""
+        scanner = self.scanner()
+        scanner.feed(text)
+        return scanner.blocked
+
+    def allows(self, text: str) -> bool:
+        """文本是否未含违规内容（不记录日志，用于判断结果能否缓存等）"""
+        if isinstance(text, FilteredText) and text.rules_version == self.version:
+            return True
+        return self.find(text) is None
+
+    def __call__(self, text: str) -> str:
+        """过滤回复：含违规内容时替换为安全提醒，已在当前规则下检查过的文本直接返回"""
+        if isinstance(text, FilteredText) and text.rules_version == self.version:
+            return text
+        scanner = self.scanner()
+        if scanner.feed(text):
+            logger.warning(f"回复中检测到违规内容: {scanner.blocked}")
+            return self.reply
+        return scanner.result(text)
@@ -0,0 +1,158 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from openai import APITimeoutError, BadRequestError
+
+import circuit_breaker
+from circuit_breaker import CircuitBreaker
+from llm_client import FailoverLLMClient, LLMClient, LLMUnavailableError
+
+REQUEST = httpx.Request("POST", "https://llm.test/v1/chat/completions")
+
+
+class FakeClock:
+    """可手动推进的 time.monotonic"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(circuit_breaker.time, "monotonic", fake)
+    return fake
+
+
+def test_trips_on_error_rate_and_recovers_after_probe(clock):
+    breaker = CircuitBreaker(window=4, min_calls=4, error_rate=0.5, open_seconds=30)
+    for ok in (True, False, True, False):
+        assert breaker.allow()
+        breaker.record_success(0.1) if ok else breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+    # 冷却后只放行一个探测请求
+    clock.now += 30
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+    breaker.record_success(0.1)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+
+def test_failed_probe_reopens(clock):
+    breaker = CircuitBreaker(window=2, min_calls=2, open_seconds=30)
+    breaker.record_failure()
+    breaker.record_failure()
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.trips == 2
+    assert not breaker.allow()
+
+
+def test_trips_on_slow_p95(clock):
+    breaker = CircuitBreaker(window=5, min_calls=5, latency_p95=10)
+    for latency in (1, 1, 1, 1, 12):
+        breaker.record_success(latency)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def make_primary(outcomes, max_retries=3):
+    """按顺序返回或抛出 outcomes 的主客户端（退避时间为0）"""
+    client = LLMClient("test", "https://llm.test/v1", max_retries=max_retries, backoff_base=0, backoff_max=0, http2=False)
+    calls = []
+
+    async def create(**params):
+        calls.append(params)
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    client.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    return client, calls
+
+
+def test_every_failed_attempt_counts_and_retries_stop_when_open():
+    primary, calls = make_primary([APITimeoutError(REQUEST)] * 4)
+    breaker = CircuitBreaker(window=2, min_calls=2)
+    client = FailoverLLMClient(primary, breaker)
+    with pytest.raises(LLMUnavailableError):
+        asyncio.run(client.create(model="m", messages=[]))
+    # 第二次失败即熔断，不再用完全部重试
+    assert len(calls) == 2
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_success_latency_excludes_failed_attempts(monkeypatch):
+    primary, calls = make_primary([APITimeoutError(REQUEST), "ok"])
+    breaker = CircuitBreaker(window=10, min_calls=10)
+    client = FailoverLLMClient(primary, breaker)
+
+    monkeypatch.setattr(primary, "_backoff", lambda attempt, error: 0.2)
+    assert asyncio.run(client.create(model="m", messages=[])) == "ok"
+    successes = [latency for ok, latency in breaker._results if ok]
+    assert len(successes) == 1 and successes[0] < 0.1
+
+
+def test_non_retryable_errors_are_not_counted():
+    response = httpx.Response(400, request=REQUEST)
+    primary, calls = make_primary([BadRequestError("bad", response=response, body=None)])
+    breaker = CircuitBreaker()
+    with pytest.raises(BadRequestError):
+        asyncio.run(FailoverLLMClient(primary, breaker).create(model="m", messages=[]))
+    assert breaker.stats()['calls'] == 0
+
+
+def test_fallback_model_used_when_open(clock):
+    primary, calls = make_primary(["fallback reply"])
+    breaker = CircuitBreaker(window=1, min_calls=1)
+    breaker.record_failure()
+    client = FailoverLLMClient(primary, breaker, fallback_model="small")
+    assert asyncio.run(client.create(model="large", messages=[])) == "fallback reply"
+    assert calls[0]['model'] == "small"
+    assert client.fallback_calls == 1
+
+
+def test_stream_errors_are_recorded_and_converted():
+    class Stream:
+        def __init__(self):
+            self.sent = False
+
+        def __aiter__(self):
+            return self
+
+        async def __anext__(self):
+            if self.sent:
+                raise httpx.ReadTimeout("read timeout")
+            self.sent = True
+            return "chunk"
+
+        async def close(self):
+            pass
+
+    primary, _ = make_primary([Stream()])
+    breaker = CircuitBreaker(window=10, min_calls=10)
+
+    async def consume():
+        stream = await FailoverLLMClient(primary, breaker).create(model="m", messages=[], stream=True)
+        chunks = []
+        try:
+            async for chunk in stream:
+                chunks.append(chunk)
+        finally:
+            await stream.close()
+        return chunks
+
+    with pytest.raises(LLMUnavailableError):
+        asyncio.run(consume())
+    assert breaker.stats()['calls'] == 1 and breaker.stats()['error_rate'] == 1.0
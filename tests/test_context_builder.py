@@ -0,0 +1,57 @@
+from XianyuAgent import ContextBuilder
+
+
+def messages(count, content="消息{}"):
+    """交替的买家/助手消息"""
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": content.format(i)} for i in range(count)]
+
+
+def test_short_history_is_kept_verbatim():
+    context = messages(3) + [{"role": "system", "content": "议价次数: 2"}]
+    assert ContextBuilder().build(context) == "\n".join([
+        "user: 消息0",
+        "assistant: 消息1",
+        "user: 消息2",
+        "system: 议价次数: 2",
+    ])
+
+
+def test_older_messages_are_shortened_to_snippets():
+    context = messages(4, content="第{}条" + "很长的内容" * 10)
+    lines = ContextBuilder(recent_turns=2, snippet_chars=5).build(context).split("\n")
+    assert lines[0] == "user: 第0条很长…"
+    assert lines[1] == "assistant: 第1条很长…"
+    assert lines[2:] == [f"{msg['role']}: {msg['content']}" for msg in context[2:]]
+
+
+def test_history_fits_the_token_budget():
+    builder = ContextBuilder(token_budget=60, recent_turns=100)
+    context = messages(30) + [{"role": "system", "content": "议价次数: 3"}]
+    history = builder.build(context)
+    lines = history.split("\n")
+    assert lines[0].startswith("（更早的") and lines[0].endswith("条消息已省略）")
+    assert lines[-2] == "assistant: 消息29"
+    assert lines[-1] == "system: 议价次数: 3"
+    kept = lines[1:-1]
+    omitted = int(lines[0][len("（更早的"):-len("条消息已省略）")])
+    assert omitted + len(kept) == 30
+    assert sum(builder.estimate_tokens(line) + 1 for line in kept) <= 60 - builder.estimate_tokens(lines[-1])
+
+
+def test_latest_message_is_always_kept():
+    context = messages(2) + [{"role": "user", "content": "超长" * 100}]
+    history = ContextBuilder(token_budget=20).build(context)
+    assert history.startswith("（更早的2条消息已省略）\nuser: 超长")
+    assert history.endswith("…")
+
+
+def test_summary_is_sent_before_later_messages():
+    context = [{"role": "system", "content": ContextBuilder.SUMMARY_PREFIX + "买家想要蓝色款"}] + messages(2)
+    assert ContextBuilder().build(context) == "【对话摘要】买家想要蓝色款\nuser: 消息0\nassistant: 消息1"
+    assert ContextBuilder.extract_summary(messages(2)) == ""
+
+
+def test_estimate_tokens():
+    assert ContextBuilder.estimate_tokens("") == 0
+    assert ContextBuilder.estimate_tokens("你好") == 2
+    assert ContextBuilder.estimate_tokens("hello world") == 3
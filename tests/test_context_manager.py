@@ -0,0 +1,166 @@
+import os
+import shutil
+import time
+
+from context_manager import ChatContextManager
+
+
+def open_manager(tmp_path, **kwargs):
+    """在临时目录中打开上下文管理器，后台刷新间隔足够长，只在测试显式调用时落库"""
+    kwargs.setdefault('flush_interval', 3600)
+    return ChatContextManager(db_path=str(tmp_path / "chat.db"), **kwargs)
+
+
+def crash(manager):
+    """模拟进程崩溃：停止后台刷新线程，不落库也不清理日志"""
+    manager.flush = lambda: 0
+    manager._closed = True
+    manager._flush_event.set()
+    manager._flush_thread.join()
+    manager._journal.close()
+    manager._conn.close()
+
+
+def stored_contents(manager, chat_id):
+    """数据库中会话的消息内容（按写入顺序）"""
+    rows = manager._conn.execute("SELECT content FROM messages WHERE chat_id = ? ORDER BY id", (chat_id,))
+    return [row[0] for row in rows]
+
+
+def test_replays_unflushed_messages_after_crash(tmp_path):
+    manager = open_manager(tmp_path)
+    for i in range(5):
+        manager.add_message_by_chat("c1", "u1", "i1", "user", f"m{i}")
+    crash(manager)
+
+    manager = open_manager(tmp_path)
+    try:
+        assert stored_contents(manager, "c1") == [f"m{i}" for i in range(5)]
+        assert os.path.getsize(manager.journal_path) == 0
+    finally:
+        manager.close()
+
+
+def test_replay_skips_messages_already_flushed(tmp_path):
+    manager = open_manager(tmp_path)
+    for i in range(3):
+        manager.add_message_by_chat("c1", "u1", "i1", "user", f"m{i}")
+    # 崩溃发生在落库事务提交之后、日志清理之前：日志中仍有已落库的消息
+    stale_journal = str(tmp_path / "stale.jsonl")
+    shutil.copy(manager.journal_path, stale_journal)
+    assert manager.flush() == 3
+    manager.add_message_by_chat("c1", "u1", "i1", "assistant", "m3")
+    with open(stale_journal, "a", encoding="utf-8") as f, open(manager.journal_path, encoding="utf-8") as journal:
+        f.write(journal.read())
+    crash(manager)
+    os.replace(stale_journal, manager.journal_path)
+
+    manager = open_manager(tmp_path)
+    try:
+        assert stored_contents(manager, "c1") == ["m0", "m1", "m2", "m3"]
+    finally:
+        manager.close()
+
+
+def test_context_has_no_duplicates_while_flushing(tmp_path):
+    manager = open_manager(tmp_path)
+    try:
+        manager.add_message_by_chat("c1", "u1", "i1", "user", "m0")
+        manager.flush()
+        manager.add_message_by_chat("c1", "u1", "i1", "user", "m1")
+        manager.context_cache.evict("c1")
+        assert [msg['content'] for msg in manager.get_context_by_chat("c1")] == ["m0", "m1"]
+        manager.flush()
+        manager.context_cache.evict("c1")
+        assert [msg['content'] for msg in manager.get_context_by_chat("c1")] == ["m0", "m1"]
+    finally:
+        manager.close()
+
+
+def test_read_only_open_leaves_journal_untouched(tmp_path):
+    manager = open_manager(tmp_path)
+    try:
+        manager.add_message_by_chat("c1", "u1", "i1", "user", "pending")
+        with open(manager.journal_path, encoding="utf-8") as f:
+            journal = f.read()
+
+        reader = ChatContextManager(db_path=manager.db_path, read_only=True)
+        reader.get_intent_samples()
+        reader.close()
+
+        with open(manager.journal_path, encoding="utf-8") as f:
+            assert f.read() == journal
+        assert stored_contents(manager, "c1") == []
+    finally:
+        manager.close()
+
+
+def test_intent_samples_skip_local_labels(tmp_path):
+    manager = open_manager(tmp_path)
+    try:
+        for chat_id, source in (("c1", "rule"), ("c2", "local"), ("c3", "llm"), ("c4", None)):
+            manager.add_message_by_chat(chat_id, "u1", "i1", "user", f"问题{chat_id}")
+            manager.add_message_by_chat(chat_id, "me", "i1", "assistant", "回复", intent="tech", intent_source=source)
+        assert sorted(manager.get_intent_samples()) == [("问题c1", "tech"), ("问题c3", "tech"), ("问题c4", "tech")]
+    finally:
+        manager.close()
+
+
+def test_context_keeps_messages_after_summary(tmp_path):
+    manager = open_manager(tmp_path)
+    try:
+        for i in range(4):
+            manager.add_message_by_chat("c1", "u1", "i1", "user", f"m{i}")
+        summary, messages, last_message_id = manager.get_unsummarized_messages("c1")
+        assert summary is None and len(messages) == 4
+        manager.add_message_by_chat("c1", "u1", "i1", "user", "m4")
+        manager.save_summary_by_chat("c1", "摘要", last_message_id)
+
+        context = manager.get_context_by_chat("c1")
+        assert [msg['content'] for msg in context] == ["对话摘要: 摘要", "m4"]
+        assert manager.get_unsummarized_messages("c1")[1] == [{"role": "user", "content": "m4"}]
+    finally:
+        manager.close()
+
+
+def test_next_summary_starts_after_previous_one(tmp_path):
+    manager = open_manager(tmp_path)
+    try:
+        for i in range(3):
+            manager.add_message_by_chat("c1", "u1", "i1", "user", f"m{i}")
+        _, _, last_message_id = manager.get_unsummarized_messages("c1")
+        manager.save_summary_by_chat("c1", "摘要1", last_message_id)
+        manager.add_message_by_chat("c1", "me", "i1", "assistant", "m3")
+
+        summary, messages, new_last_id = manager.get_unsummarized_messages("c1")
+        assert summary == "摘要1"
+        assert messages == [{"role": "assistant", "content": "m3"}]
+        assert new_last_id > last_message_id
+    finally:
+        manager.close()
+
+
+def test_flush_thread_survives_journal_errors(tmp_path):
+    manager = open_manager(tmp_path, flush_interval=0.01)
+    try:
+        rewrite_journal = manager._rewrite_journal
+        failures = []
+
+        def failing_rewrite():
+            if not failures:
+                failures.append(1)
+                raise OSError("No space left on device")
+            rewrite_journal()
+
+        manager._rewrite_journal = failing_rewrite
+        manager.add_message_by_chat("c1", "u1", "i1", "user", "m0")
+        deadline = time.monotonic() + 5
+        while (not failures or os.path.getsize(manager.journal_path)) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        manager.add_message_by_chat("c1", "u1", "i1", "user", "m1")
+        manager.flush()
+
+        assert failures and manager._flush_thread.is_alive()
+        assert stored_contents(manager, "c1") == ["m0", "m1"]
+    finally:
+        manager.close()
@@ -0,0 +1,53 @@
+from context_manager import ChatContextManager
+from intent_classifier import IntentClassifier, train_from_db
+
+SAMPLES = [
+    ("能便宜点吗", "price"),
+    ("最低多少钱", "price"),
+    ("可以再优惠一点吗", "price"),
+    ("便宜一点卖吗", "price"),
+    ("这个支持蓝牙吗", "tech"),
+    ("电池能用多久", "tech"),
+    ("支持什么型号的充电器", "tech"),
+    ("屏幕是什么分辨率", "tech"),
+    ("在吗", "default"),
+    ("什么时候发货", "default"),
+    ("包邮吗", "default"),
+    ("还在吗", "default"),
+]
+
+
+def test_predicts_labels_of_similar_messages():
+    classifier = IntentClassifier().fit(SAMPLES)
+    assert classifier.predict("再便宜点吧")[0] == "price"
+    assert classifier.predict("支持蓝牙5.0吗")[0] == "tech"
+    assert classifier.predict("明天发货吗")[0] == "default"
+
+
+def test_unknown_text_has_no_prediction():
+    assert IntentClassifier().fit(SAMPLES).predict("😀😀") == (None, 0.0)
+    assert IntentClassifier().predict("便宜点") == (None, 0.0)
+
+
+def test_saved_model_predicts_the_same(tmp_path):
+    classifier = IntentClassifier().fit(SAMPLES)
+    path = str(tmp_path / "model" / "intent_model.json")
+    classifier.save(path)
+    loaded = IntentClassifier.load(path)
+    for text in ("最低多少", "电池多久", "包邮不"):
+        assert loaded.predict(text) == classifier.predict(text)
+
+
+def test_train_from_db_requires_enough_samples(tmp_path):
+    db_path = str(tmp_path / "chat.db")
+    model_path = str(tmp_path / "intent_model.json")
+    manager = ChatContextManager(db_path=db_path)
+    for i, (text, intent) in enumerate(SAMPLES):
+        manager.add_message_by_chat(f"c{i}", "u1", "i1", "user", text)
+        manager.add_message_by_chat(f"c{i}", "me", "i1", "assistant", "回复", intent=intent, intent_source="llm")
+    manager.close()
+
+    assert train_from_db(db_path, model_path, min_samples=len(SAMPLES) + 1) is None
+    classifier = train_from_db(db_path, model_path, min_samples=len(SAMPLES))
+    assert classifier.class_counts == {"price": 4, "tech": 4, "default": 4}
+    assert IntentClassifier.load(model_path).predict("能便宜吗")[0] == "price"
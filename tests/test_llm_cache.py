@@ -0,0 +1,125 @@
+import asyncio
+
+import pytest
+
+from llm_cache import LLMResponseCache
+
+
+def counting_call(results, started=None, release=None):
+    """按顺序返回 results 的调用，started/release 用于控制调用进行中的时机"""
+    calls = []
+
+    async def call():
+        calls.append(1)
+        if started is not None:
+            started.set()
+        if release is not None:
+            await release.wait()
+        return results[len(calls) - 1]
+
+    return call, calls
+
+
+def test_concurrent_identical_requests_share_one_call():
+    async def scenario():
+        cache = LLMResponseCache()
+        release = asyncio.Event()
+        call, calls = counting_call(["回复"], release=release)
+        tasks = [asyncio.create_task(cache.run("k", call)) for _ in range(3)]
+        await asyncio.sleep(0)
+        release.set()
+        return await asyncio.gather(*tasks), calls, cache
+
+    results, calls, cache = asyncio.run(scenario())
+    assert results == ["回复"] * 3
+    assert len(calls) == 1
+    assert cache.get("k") == "回复"
+    assert cache.stats()['hits'] == 2 and cache.stats()['misses'] == 1
+
+
+def test_cancelled_leader_does_not_cancel_waiters():
+    async def scenario():
+        cache = LLMResponseCache()
+        started, release = asyncio.Event(), asyncio.Event()
+        call, calls = counting_call(["草稿", "回复"], started=started, release=release)
+        leader = asyncio.create_task(cache.run("k", call))
+        await started.wait()
+        waiter = asyncio.create_task(cache.run("k", call))
+        await asyncio.sleep(0)
+        leader.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await waiter, calls
+
+    result, calls = asyncio.run(scenario())
+    assert result == "回复"
+    assert len(calls) == 2
+
+
+def test_cancelled_waiter_does_not_cancel_leader():
+    async def scenario():
+        cache = LLMResponseCache()
+        started, release = asyncio.Event(), asyncio.Event()
+        call, calls = counting_call(["回复"], started=started, release=release)
+        leader = asyncio.create_task(cache.run("k", call))
+        await started.wait()
+        waiter = asyncio.create_task(cache.run("k", call))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        return await leader, calls
+
+    result, calls = asyncio.run(scenario())
+    assert result == "回复"
+    assert len(calls) == 1
+
+
+def test_failed_call_is_shared_and_not_cached():
+    async def scenario():
+        cache = LLMResponseCache()
+        release = asyncio.Event()
+
+        async def call():
+            await release.wait()
+            raise RuntimeError("upstream error")
+
+        tasks = [asyncio.create_task(cache.run("k", call)) for _ in range(2)]
+        await asyncio.sleep(0)
+        release.set()
+        return await asyncio.gather(*tasks, return_exceptions=True), cache
+
+    results, cache = asyncio.run(scenario())
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert cache.get("k") is None
+
+
+def test_uncacheable_results_are_not_stored():
+    async def scenario():
+        cache = LLMResponseCache()
+        call, _ = counting_call(["被截断"])
+        await cache.run("k", call, cacheable=lambda content: False)
+        return cache
+
+    assert asyncio.run(scenario()).get("k") is None
+
+
+def test_persisted_results_survive_restart(tmp_path):
+    path = str(tmp_path / "llm_cache.jsonl")
+
+    async def fill():
+        cache = LLMResponseCache(path=path)
+        call, _ = counting_call(["回复"])
+        await cache.run("k", call)
+        cache.close()
+
+    asyncio.run(fill())
+    cache = LLMResponseCache(path=path)
+    try:
+        assert cache.get("k") == "回复"
+    finally:
+        cache.close()
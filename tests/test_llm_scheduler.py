@@ -0,0 +1,87 @@
+import asyncio
+import time
+
+import pytest
+
+from llm_scheduler import LLMQueueExpiredError, LLMScheduler, message_deadline
+
+
+async def acquire_for_message(scheduler, intent, expires_in, order=None):
+    """以一条 expires_in 秒后过期的消息的名义等待配额"""
+    now = time.time()
+    with message_deadline(now, now + expires_in):
+        await scheduler.acquire(intent, 100)
+    if order is not None:
+        order.append(intent)
+
+
+def test_request_that_would_expire_is_dropped():
+    async def scenario():
+        scheduler = LLMScheduler(rpm=60, burst_seconds=1)
+        await scheduler.acquire('default', 100)
+        started = time.monotonic()
+        # 下一个配额约1秒后才有，消息0.3秒后过期：不必等待，直接丢弃
+        with pytest.raises(LLMQueueExpiredError):
+            await acquire_for_message(scheduler, 'default', 0.3)
+        assert time.monotonic() - started < 0.1
+        return scheduler
+
+    stats = asyncio.run(scenario()).stats()
+    assert stats['dropped'] == 1 and stats['queued'] == 0 and stats['granted'] == 1
+
+
+def test_only_requests_behind_the_deadline_are_dropped():
+    async def scenario():
+        scheduler = LLMScheduler(rpm=600, burst_seconds=0.1)
+        await scheduler.acquire('default', 100)
+        # 配额每0.1秒一个：第一个请求约0.1秒后放行，第二个约0.2秒后，已超过其0.15秒的期限
+        results = await asyncio.gather(
+            acquire_for_message(scheduler, 'default', 1.0),
+            acquire_for_message(scheduler, 'tech', 0.15),
+            return_exceptions=True,
+        )
+        return scheduler, results
+
+    scheduler, results = asyncio.run(scenario())
+    assert results[0] is None
+    assert isinstance(results[1], LLMQueueExpiredError)
+    assert scheduler.stats()['dropped'] == 1 and scheduler.stats()['granted'] == 2
+
+
+def test_bargaining_goes_first_when_queued():
+    async def scenario():
+        scheduler = LLMScheduler(rpm=600, burst_seconds=0.1)
+        await scheduler.acquire('default', 100)
+        order = []
+        summary = asyncio.create_task(acquire_for_message(scheduler, 'summary', 10, order))
+        default = asyncio.create_task(acquire_for_message(scheduler, 'default', 10, order))
+        await asyncio.sleep(0)
+        price = asyncio.create_task(acquire_for_message(scheduler, 'price', 10, order))
+        await asyncio.gather(summary, default, price)
+        return order
+
+    assert asyncio.run(scenario()) == ['price', 'default', 'summary']
+
+
+def test_cancelled_request_frees_its_place():
+    async def scenario():
+        scheduler = LLMScheduler(rpm=600, burst_seconds=0.1)
+        await scheduler.acquire('default', 100)
+        first = asyncio.create_task(scheduler.acquire('default', 100))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        await scheduler.acquire('default', 100)
+        return scheduler
+
+    stats = asyncio.run(scenario()).stats()
+    assert stats['queued'] == 0 and stats['granted'] == 2
+
+
+def test_token_budget_is_corrected_by_actual_usage():
+    # 容量1000 token：预扣800，实际只用了300，退回500
+    scheduler = LLMScheduler(tpm=6000, burst_seconds=10)
+    asyncio.run(scheduler.acquire('default', 800))
+    scheduler.settle(800, 300)
+    assert scheduler.stats()['available_tokens'] == pytest.approx(700, abs=1)
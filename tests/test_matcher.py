@@ -0,0 +1,74 @@
+import json
+import os
+import re
+
+import pytest
+
+from utils.matcher import KeywordAutomaton, RuleMatcher
+from XianyuAgent import DEFAULT_INTENT_RULES, IntentRouter
+
+RULES = {
+    'tech': {'keywords': ['参数', '型号'], 'patterns': [r'和.+比']},
+    'price': {'keywords': ['便宜', '价'], 'patterns': [r'\d+元', r'能少\d+']},
+    'shipping': {'keywords': ['发货', '快递']},
+}
+
+
+def naive_match(rules, text):
+    """逐条按优先级检查规则，作为编译结果的参照"""
+    for intent, rule in rules.items():
+        if any(keyword in text for keyword in rule.get('keywords', [])):
+            return intent
+        if any(re.search(pattern, text) for pattern in rule.get('patterns', [])):
+            return intent
+    return None
+
+
+def test_automaton_finds_overlapping_keywords():
+    automaton = KeywordAutomaton({'he': 1, 'she': 2, 'his': 3, 'hers': 4})
+    assert sorted((end, keyword) for end, keyword, _ in automaton.finditer("ushers")) == [
+        (4, 'he'), (4, 'she'), (6, 'hers'),
+    ]
+    assert automaton.values("this") == {3}
+
+
+@pytest.mark.parametrize("text", [
+    "能便宜点吗",
+    "这个型号多少价",
+    "和新款比怎么样100元",
+    "100元能发货吗",
+    "能少20吗",
+    "什么时候发货",
+    "快递和顺丰比哪个快",
+    "你好",
+    "",
+])
+def test_compiled_rules_match_naive_priority_order(text):
+    assert RuleMatcher(RULES).match(text) == naive_match(RULES, text)
+
+
+def test_higher_priority_pattern_beats_lower_keyword():
+    # 价格关键词先出现，但技术的正则优先级更高
+    assert RuleMatcher(RULES).match("便宜的和贵的比") == 'tech'
+
+
+def test_rules_without_patterns_or_keywords():
+    matcher = RuleMatcher({'shipping': {'keywords': ['发货']}, 'price': {'patterns': [r'\d+元']}})
+    assert matcher.match("50元今天发货吗") == 'shipping'
+    assert matcher.match("50元") == 'price'
+    assert RuleMatcher({}).match("任意文本") is None
+
+
+def test_router_reloads_rules_file(tmp_path):
+    rules_path = tmp_path / "intent_rules.json"
+    router = IntentRouter(None, rules_path=str(rules_path), reload_interval=0)
+    assert router.rules == DEFAULT_INTENT_RULES
+    assert router.match("什么时候发货？") is None
+
+    rules_path.write_text(json.dumps(RULES, ensure_ascii=False), encoding="utf-8")
+    assert router.match("什么时候发货？") == 'shipping'
+
+    # 文件损坏时保留当前规则
+    rules_path.write_text("{", encoding="utf-8")
+    os.utime(rules_path, (1, 1))
+    assert router.match_with_source("什么时候发货？") == ('shipping', 'rule')
@@ -0,0 +1,68 @@
+import pytest
+
+import reply_cache
+from reply_cache import ReplyCache
+
+
+@pytest.mark.parametrize("asked, repeated", [
+    ("包邮吗？", "包邮吗"),
+    ("包邮吗", "包 邮 吗 ？！"),
+    ("ＯＫ吗", "ok吗"),
+    ("成色怎么样呢", "成色怎么样"),
+])
+def test_same_question_in_other_words_hits(asked, repeated):
+    cache = ReplyCache()
+    assert cache.put("i1", asked, "包邮的", "default")
+    assert cache.get("i1", repeated) == ("包邮的", "default")
+
+
+def test_cache_is_per_item():
+    cache = ReplyCache()
+    cache.put("i1", "包邮吗", "包邮的", "default")
+    assert cache.get("i2", "包邮吗") is None
+
+
+@pytest.mark.parametrize("message, intent", [
+    ("好的", "default"),        # 应答的含义依赖上下文
+    ("能便宜点吗", "price"),    # 议价依赖会话状态
+])
+def test_context_dependent_messages_are_not_cached(message, intent):
+    cache = ReplyCache()
+    assert not cache.put("i1", message, "回复", intent)
+    assert cache.get("i1", message) is None
+
+
+def test_entries_expire(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(reply_cache.time, "monotonic", lambda: now[0])
+    cache = ReplyCache(ttl=10)
+    cache.put("i1", "包邮吗", "包邮的", "default")
+    now[0] += 9
+    assert cache.get("i1", "包邮吗") is not None
+    now[0] += 1
+    assert cache.get("i1", "包邮吗") is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_item_change_invalidates_its_replies():
+    cache = ReplyCache()
+    cache.put("i1", "多少钱能卖？", "100元", "default")
+    cache.put("i2", "多少钱能卖？", "200元", "default")
+    cache.invalidate("i1")
+    assert cache.get("i1", "多少钱能卖？") is None
+    assert cache.get("i2", "多少钱能卖？") == ("200元", "default")
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = ReplyCache(max_items=2, max_entries_per_item=2)
+    cache.put("i1", "包邮吗", "a", "default")
+    cache.put("i1", "还在吗", "b", "default")
+    cache.get("i1", "包邮吗")
+    cache.put("i1", "几成新？", "c", "default")
+    assert cache.get("i1", "还在吗") is None
+    assert cache.get("i1", "包邮吗") == ("a", "default")
+
+    cache.put("i2", "包邮吗", "d", "default")
+    cache.put("i3", "包邮吗", "e", "default")
+    assert cache.get("i1", "包邮吗") is None
+    assert cache.stats()['items'] == 2
@@ -0,0 +1,118 @@
+import asyncio
+import time
+
+from reply_dispatcher import ChatDispatcher
+
+
+def merge_texts(job, next_job):
+    """测试用合并函数：文本任务合并，其他任务不合并"""
+    if isinstance(job, str) and isinstance(next_job, str):
+        return job + "\n" + next_job
+    return None
+
+
+def test_jobs_in_a_chat_run_in_order():
+    handled = []
+
+    async def handler(chat_id, job):
+        # 越早提交的任务处理越慢，顺序错乱时会先完成后面的任务
+        await asyncio.sleep(0.01 * (5 - job))
+        handled.append((chat_id, job))
+
+    async def run():
+        dispatcher = ChatDispatcher(handler, max_concurrency=4)
+        for i in range(5):
+            dispatcher.submit("c1", i)
+            dispatcher.submit("c2", i)
+        while dispatcher.workers:
+            await asyncio.sleep(0.01)
+        return dispatcher
+
+    dispatcher = asyncio.run(run())
+    assert [job for chat_id, job in handled if chat_id == "c1"] == list(range(5))
+    assert [job for chat_id, job in handled if chat_id == "c2"] == list(range(5))
+    assert dispatcher.get_metrics()['totals']['processed'] == 10
+
+
+def test_concurrency_limit_spans_chats():
+    running = []
+    peak = []
+
+    async def handler(chat_id, job):
+        running.append(chat_id)
+        peak.append(len(running))
+        await asyncio.sleep(0.01)
+        running.remove(chat_id)
+
+    async def run():
+        dispatcher = ChatDispatcher(handler, max_concurrency=2)
+        for i in range(6):
+            dispatcher.submit(f"c{i}", i)
+        while dispatcher.workers:
+            await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    assert len(peak) == 6 and max(peak) == 2
+
+
+def test_burst_is_merged_into_one_job():
+    handled = []
+
+    async def handler(chat_id, job):
+        handled.append(job)
+
+    async def run():
+        dispatcher = ChatDispatcher(handler, merge=merge_texts, debounce_window=0.05, max_debounce_wait=1.0)
+        for text in ("在吗", "这个还有吗", "能便宜点吗"):
+            dispatcher.submit("c1", text)
+            await asyncio.sleep(0.01)
+        # 不可合并的任务保持顺序，单独处理
+        dispatcher.submit("c1", {"role": "assistant"})
+        while dispatcher.workers:
+            await asyncio.sleep(0.01)
+        return dispatcher
+
+    dispatcher = asyncio.run(run())
+    assert handled == ["在吗\n这个还有吗\n能便宜点吗", {"role": "assistant"}]
+    assert dispatcher.get_metrics()['totals']['coalesced'] == 2
+
+
+def test_typing_extends_debounce_until_max_wait():
+    handled = []
+
+    async def handler(chat_id, job):
+        handled.append((job, time.monotonic()))
+
+    async def run():
+        dispatcher = ChatDispatcher(handler, merge=merge_texts, debounce_window=0.05, max_debounce_wait=0.2)
+        started = time.monotonic()
+        dispatcher.submit("c1", "在吗", aliases=["u1"])
+        # 买家一直在输入，防抖窗口不断顺延，直到达到最长等待时间
+        while dispatcher.workers:
+            dispatcher.notify_typing("u1")
+            await asyncio.sleep(0.01)
+        return started
+
+    started = asyncio.run(run())
+    assert [job for job, _ in handled] == ["在吗"]
+    assert handled[0][1] - started >= 0.2
+
+
+def test_idle_chat_stats_are_dropped():
+    async def handler(chat_id, job):
+        if job == "bad":
+            raise ValueError(job)
+
+    async def run():
+        dispatcher = ChatDispatcher(handler)
+        dispatcher.submit("c1", "ok")
+        dispatcher.submit("c1", "bad")
+        while dispatcher.workers:
+            await asyncio.sleep(0.01)
+        return dispatcher
+
+    dispatcher = asyncio.run(run())
+    metrics = dispatcher.get_metrics()
+    assert dispatcher.stats == {} and metrics['chats'] == {}
+    assert metrics['totals']['submitted'] == 2
+    assert metrics['totals']['failed'] == 1
@@ -0,0 +1,105 @@
+import asyncio
+import json
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from safety_filter import FilteredText, SafetyFilter
+from XianyuAgent import BaseAgent
+
+BLOCKED = SafetyFilter().reply
+
+
+@pytest.mark.parametrize("text, phrase", [
+    ("加我微信聊", "微信"),
+    ("加我微 信聊", "微信"),
+    ("加我Ｑ-Ｑ", "QQ"),
+    ("可以走 支·付·宝 吗", "支付宝"),
+])
+def test_blocks_obfuscated_phrases(text, phrase):
+    assert SafetyFilter().find(text) == phrase
+    assert SafetyFilter()(text) == BLOCKED
+
+
+@pytest.mark.parametrize("text", [
+    "请在平台支付，宝贝当天发出",
+    "这款是有线，下单即发",
+    "微   -   信",  # 间隔符过多，视为不相关的两段文字
+])
+def test_phrases_do_not_span_clauses(text):
+    safety_filter = SafetyFilter()
+    assert safety_filter.find(text) is None
+    assert safety_filter(text) == text
+
+
+def test_checked_text_is_not_scanned_again():
+    safety_filter = SafetyFilter()
+    checked = safety_filter("好的，马上发货")
+    assert isinstance(checked, FilteredText)
+    assert safety_filter.allows(checked)
+
+
+def test_rules_file_is_reloaded(tmp_path):
+    rules_path = tmp_path / "safety_rules.json"
+    rules_path.write_text(json.dumps({"phrases": ["闲鱼外"], "reply": "请在平台内交易"}), encoding="utf-8")
+    safety_filter = SafetyFilter(rules_path=str(rules_path), reload_interval=0)
+    assert safety_filter("去闲鱼外交易") == "请在平台内交易"
+    assert safety_filter.find("加微信") is None
+
+    rules_path.write_text(json.dumps({"phrases": ["微信"]}), encoding="utf-8")
+    os.utime(rules_path, (1, 1))
+    assert safety_filter.find("加微信") == "微信"
+
+
+def stream_chunks(parts):
+    """模拟流式响应"""
+    class Stream:
+        def __init__(self):
+            self.parts = list(parts)
+
+        def __aiter__(self):
+            return self
+
+        async def __anext__(self):
+            if not self.parts:
+                raise StopAsyncIteration
+            return SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=SimpleNamespace(content=self.parts.pop(0)))])
+
+        async def close(self):
+            pass
+
+    return Stream()
+
+
+def run_stream(parts):
+    """流式生成，返回(最终文本, 提前发送的句子)"""
+    async def create(**params):
+        return stream_chunks(parts)
+
+    agent = BaseAgent(SimpleNamespace(create=create), None, "default", SafetyFilter())
+    sent = []
+
+    async def on_first_sentence(text):
+        sent.append(text)
+
+    result = asyncio.run(agent._stream_llm({"model": "test"}, on_first_sentence))
+    return agent.safety_filter(result), sent
+
+
+def test_stream_sends_first_sentence_early():
+    reply, sent = run_stream(["平台支付，", "宝贝当天发。", "有问题随时问"])
+    assert sent == ["平台支付，宝贝当天发。"]
+    assert reply == "平台支付，宝贝当天发。有问题随时问"
+
+
+def test_stream_holds_sentence_ending_in_partial_phrase():
+    reply, sent = run_stream(["好的~可以加", "微", " 信"])
+    assert sent == ["好的~"]
+    assert reply == BLOCKED
+
+
+def test_stream_blocks_phrase_split_across_chunks():
+    reply, sent = run_stream(["您好！加我", "Ｑ", "-Q联系"])
+    assert sent == ["您好！"]
+    assert reply == BLOCKED
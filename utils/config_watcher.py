@@ -0,0 +1,61 @@
+import os
+import json
+import time
+from typing import Callable, Dict, Optional
+from loguru import logger
+
+
+class JsonConfigWatcher:
+    """
+    按修改时间热加载的JSON配置文件
+
+    每隔 reload_interval 秒最多检查一次文件的修改时间，有修改时读取并交给 apply 处理，
+    文件不存在或加载失败时保留当前配置。
+    """
+
+    def __init__(self, path: Optional[str], apply: Callable[[Dict], None], reload_interval: float = 1.0,
+                 name: str = "配置"):
+        """
+        Args:
+            path: 配置文件路径，为空时不加载
+            apply: 应用新配置的函数，抛出异常时视为加载失败
+            reload_interval: 检查文件是否修改的最小间隔（秒）
+            name: 配置名称，用于日志
+        """
+        self.path = path
+        self.apply = apply
+        self.reload_interval = reload_interval
+        self.name = name
+        self._mtime = None
+        self._last_check = 0.0
+
+    def check(self):
+        """距上次检查超过间隔时检查文件是否修改"""
+        if time.monotonic() - self._last_check >= self.reload_interval:
+            self.reload()
+
+    def reload(self) -> bool:
+        """
+        文件有修改时重新加载
+
+        Returns:
+            bool: 是否加载了新配置
+        """
+        self._last_check = time.monotonic()
+        if not self.path:
+            return False
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return False
+        if mtime == self._mtime:
+            return False
+        self._mtime = mtime
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                config = json.load(f)
+            self.apply(config)
+            return True
+        except Exception as e:
+            logger.error(f"加载{self.name}时出错，继续使用当前{self.name}: {e}")
+            return False
@@ -0,0 +1,151 @@
+import re
+from collections import deque
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+class KeywordAutomaton:
+    """
+    Aho-Corasick多模式匹配自动机
+
+    所有关键词编译为一个自动机，对文本只需扫描一遍，
+    匹配耗时与关键词数量无关。每个关键词可以关联一个值（如所属意图）。
+    """
+
+    def __init__(self, keywords: Optional[Dict[str, object]] = None):
+        """
+        初始化自动机
+
+        Args:
+            keywords: 关键词 -> 关联值，为空时需调用 add 和 build
+        """
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[Tuple[str, object]]] = [[]]
+        if keywords:
+            for keyword, value in keywords.items():
+                self.add(keyword, value)
+            self.build()
+
+    def add(self, keyword: str, value: object = None):
+        """添加关键词（添加完毕后需调用 build）"""
+        if not keyword:
+            return
+        state = 0
+        for char in keyword:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            state = next_state
+        self._output[state].append((keyword, keyword if value is None else value))
+
+    def build(self):
+        """按广度优先构建失败指针，并合并失败链上的输出"""
+        # 根节点的子节点失败指针均指向根节点
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def step(self, state: int, char: str) -> int:
+        """从状态state读入一个字符后的状态，用于逐字符增量匹配（如流式文本）"""
+        goto, fail = self._goto, self._fail
+        while state and char not in goto[state]:
+            state = fail[state]
+        return goto[state].get(char, 0)
+
+    def matches(self, state: int) -> List[Tuple[str, object]]:
+        """到达状态state时命中的(关键词, 关联值)"""
+        return self._output[state]
+
+    def finditer(self, text: str) -> Iterator[Tuple[int, str, object]]:
+        """
+        查找文本中出现的所有关键词
+
+        Yields:
+            tuple: (结束位置, 关键词, 关联值)
+        """
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        for index, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for keyword, value in output[state]:
+                yield index + 1, keyword, value
+
+    def values(self, text: str) -> set:
+        """文本中命中的关键词所关联的值集合"""
+        return {value for _, _, value in self.finditer(text)}
+
+
+class RuleMatcher:
+    """
+    按优先级编译的意图规则
+
+    关键词编译为一个Aho-Corasick自动机，正则编译为一个带命名分组的组合正则，
+    组合正则中按优先级依次尝试各意图，返回结果与逐条按优先级检查一致。
+    """
+
+    def __init__(self, rules: Dict[str, Dict[str, List[str]]]):
+        """
+        编译规则
+
+        Args:
+            rules: 意图 -> {'keywords': [...], 'patterns': [...]}，字典顺序即优先级
+        """
+        self.priority = list(rules)
+        self._rank = {intent: rank for rank, intent in enumerate(self.priority)}
+
+        self._keywords = KeywordAutomaton()
+        for intent, rule in rules.items():
+            for keyword in rule.get('keywords', []):
+                self._keywords.add(keyword, intent)
+        self._keywords.build()
+
+        # ^(?:.*?(?P<g0>...)|.*?(?P<g1>...)) 会先在整段文本中尝试高优先级意图，失败后才尝试下一个
+        branches = []
+        self._groups = {}
+        for intent, rule in rules.items():
+            patterns = rule.get('patterns', [])
+            if not patterns:
+                continue
+            group = f"g{len(self._groups)}"
+            self._groups[group] = intent
+            alternatives = "|".join(f"(?:{pattern})" for pattern in patterns)
+            branches.append(f".*?(?P<{group}>{alternatives})")
+        self._pattern = re.compile("^(?:" + "|".join(branches) + ")", re.DOTALL) if branches else None
+
+    def match(self, text: str) -> Optional[str]:
+        """
+        返回文本命中的最高优先级意图
+
+        Args:
+            text: 已清洗的消息文本
+
+        Returns:
+            str: 意图，未命中任何规则时返回None
+        """
+        best = None
+        keyword_hits = self._keywords.values(text)
+        if keyword_hits:
+            best = min(keyword_hits, key=self._rank.__getitem__)
+            if self._rank[best] == 0:
+                return best
+
+        if self._pattern is not None:
+            match = self._pattern.match(text)
+            if match:
+                intent = next(self._groups[group] for group in self._groups if match.group(group) is not None)
+                if best is None or self._rank[intent] < self._rank[best]:
+                    best = intent
+        return best